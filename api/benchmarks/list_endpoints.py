@@ -0,0 +1,95 @@
+"""Requests per second of the list endpoints with a per-request engine (the old behaviour) vs. the shared engine.
+
+Run from the project root:
+    uv run --frozen python -m benchmarks.list_endpoints --seconds 5
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from template_matching_api.api import dependencies
+from template_matching_api.db import create_async_db_engine
+from template_matching_api.db_model import Base, DocumentTemplate, Workspace
+from template_matching_api.main import app
+from template_matching_api.settings import Settings
+
+LIST_ENDPOINTS = (
+    "/api/document-template/",
+    "/api/workspace/",
+    "/api/template-matching-job/",
+)
+
+
+def seed(db_url: str, num_rows: int) -> None:
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine).begin() as session:
+        session.add_all(
+            DocumentTemplate(
+                name=f"template_{idx}",
+                template_filename=f"template_{idx}.jpg",
+                template_file_type="image/jpeg",
+                uploaded_at=datetime.now(),
+            )
+            for idx in range(num_rows)
+        )
+        session.add_all(
+            Workspace(name=f"workspace_{idx}", data_specification={"file_type": "PDF"})
+            for idx in range(num_rows)
+        )
+    engine.dispose()
+
+
+def requests_per_second(client: TestClient, path: str, seconds: float) -> float:
+    num_requests = 0
+    started = time.perf_counter()
+    while (elapsed := time.perf_counter() - started) < seconds:
+        resp = client.get(path)
+        assert resp.status_code == 200, resp.text
+        num_requests += 1
+    return num_requests / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=3.0, help="Duration of each measurement")
+    parser.add_argument("--rows", type=int, default=20, help="Rows seeded into each listed table")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = f"sqlite+pysqlite:///{Path(tmp_dir) / 'bench.db'}"
+        seed(db_url, args.rows)
+
+        settings = Settings(db_url=db_url)
+        shared_engine = create_async_db_engine(settings)
+        shared_session_maker = async_sessionmaker(bind=shared_engine, expire_on_commit=False)
+
+        def per_request_session_maker() -> async_sessionmaker[AsyncSession]:
+            # What every request used to pay for: a new engine, a cold pool and SQL echoed to stdout
+            return async_sessionmaker(bind=create_async_engine(settings.get_async_db_url(), echo=True))
+
+        print(f"{'endpoint':<32}{'per-request engine':>20}{'shared engine':>16}{'speedup':>10}")
+        with TestClient(app) as client, open(os.devnull, "w") as devnull:
+            for path in LIST_ENDPOINTS:
+                app.dependency_overrides[dependencies.get_async_session_maker] = per_request_session_maker
+                with contextlib.redirect_stdout(devnull):
+                    baseline = requests_per_second(client, path, args.seconds)
+                app.dependency_overrides[dependencies.get_async_session_maker] = lambda: shared_session_maker
+                shared = requests_per_second(client, path, args.seconds)
+                print(f"{path:<32}{baseline:>16.1f} r/s{shared:>12.1f} r/s{shared / baseline:>9.1f}x")
+            app.dependency_overrides.clear()
+            assert client.portal is not None
+            client.portal.call(shared_engine.dispose)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Throughput of the NCC matching engine in samples per second and CPU core.
+
+A synthetic corpus of random grayscale samples, a fraction of them containing the template at one of its pyramid
+scales, is written to a temporary directory and matched like the job worker does (`NccMatchingEngine.template_results`,
+loading the samples included). NumPy's FFTs run on a single core, so CPU time rather than wall time is used for the
+per core figure.
+
+Run from the project root:
+    uv run --frozen python -m benchmarks.matching_engine --samples 512 --size 256 --template-size 64 --threshold 0.9
+"""
+import argparse
+import io
+import tempfile
+import time
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.derivatives import PYRAMID_NAME, UNVERSIONED, build_pyramid
+from template_matching_api.jobs.matching_engine import NccMatchingEngine
+from template_matching_api.sample_corpus import LocalSampleCorpus
+from template_matching_api.tests.storage import InMemoryTemplateStorage
+
+
+def seed_corpus(
+    corpus: LocalSampleCorpus, pyramid: list[npt.NDArray[np.float32]], num_samples: int, size: int, match_ratio: float
+) -> None:
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_samples):
+        image = rng.random((size, size), dtype=np.float32)
+        if rng.random() < match_ratio:
+            level = pyramid[int(rng.integers(0, min(len(pyramid), 2)))]
+            y, x = rng.integers(0, size - level.shape[0] + 1), rng.integers(0, size - level.shape[1] + 1)
+            image[y:y + level.shape[0], x:x + level.shape[1]] = level
+        images.append(image)
+    corpus.add_samples(FileType.IMAGE, date.today(), list(range(1, num_samples + 1)), images)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=512)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--template-size", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--levels", type=int, default=2)
+    parser.add_argument("--threshold", type=float, default=None)
+    parser.add_argument("--match-ratio", type=float, default=0.2)
+    args = parser.parse_args()
+
+    pyramid = build_pyramid(np.random.default_rng(1).random((args.template_size,) * 2, dtype=np.float32))
+    buffer = io.BytesIO()
+    levels: dict[str, Any] = {f"level_{idx}": level for idx, level in enumerate(pyramid)}
+    np.savez(buffer, **levels)
+    template_storage = InMemoryTemplateStorage()
+    template_storage.save_derivative(1, UNVERSIONED, PYRAMID_NAME, buffer.getvalue())
+    template = DocumentTemplate(
+        id=1,
+        name="template",
+        template_filename="template.png",
+        template_file_type="image/png",
+        uploaded_at=datetime.now(),
+    )
+    data_specification = DataSpecification(file_type=FileType.IMAGE, date_from=date.today(), date_to=date.today())
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus = LocalSampleCorpus(Path(tmp_dir))
+        seed_corpus(corpus, pyramid, args.samples, args.size, args.match_ratio)
+        print(
+            f"samples={args.samples}x{args.size}px template={args.template_size}px levels={args.levels} "
+            f"threshold={args.threshold}"
+        )
+        print(f"{'batch':>6} {'seconds':>9} {'samples/s':>11} {'samples/s/core':>15} {'matched':>8}")
+        for batch_size in args.batch_size:
+            engine = NccMatchingEngine(template_storage, corpus, batch_size, args.levels, args.threshold)
+            started, cpu_started = time.perf_counter(), time.process_time()
+            columns = engine.template_results(template, data_specification)
+            seconds, cpu_seconds = time.perf_counter() - started, time.process_time() - cpu_started
+            matched = int((columns.score >= (args.threshold or 0.9)).sum())
+            print(
+                f"{batch_size:>6} {seconds:>9.2f} {columns.num_results / seconds:>11.1f} "
+                f"{columns.num_results / cpu_seconds:>15.1f} {matched:>8}"
+            )
+
+
+if __name__ == '__main__':
+    main()
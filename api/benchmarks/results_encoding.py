@@ -0,0 +1,92 @@
+"""Generating and serializing job results, per sample Pydantic models versus NumPy result columns.
+
+The model path is what the API did before results were stored as columns: a Python loop builds one
+`ExtendedSampleResult` per sample, and the response is validated and dumped model by model. The columnar path
+generates the columns vectorized, stores them like the job worker does, and encodes the memory-mapped columns
+the way `GET /template-matching-job/{id}/results` does.
+
+Run from the project root:
+    uv run --frozen python -m benchmarks.results_encoding --samples 10000 100000 1000000
+"""
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, TypeVar
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.template_matching_job import TemplateMatchingJobResults
+from template_matching_api.db_model import TemplateMatchingJob
+from template_matching_api.jobs.template_matching_job import (
+    mock_job_result_columns,
+    mock_job_results_with_data_spec,
+)
+from template_matching_api.result_storage import JobResultStorage, encode_results
+
+_T = TypeVar("_T")
+
+
+def measure(func: Callable[[], _T], with_memory: bool) -> tuple[_T, float, int]:
+    """Result, seconds and (if `with_memory`) peak traced bytes of one call"""
+    if not with_memory:
+        started = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - started, 0
+    tracemalloc.start()
+    try:
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        return result, elapsed, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def model_path(job: TemplateMatchingJob, samples_per_template: int) -> bytes:
+    results = mock_job_results_with_data_spec(job, DataSpecification(), num_samples=samples_per_template)
+    # Like FastAPI's response handling: validate against the response model, dump to JSON types, encode
+    validated = TemplateMatchingJobResults.model_validate(results, from_attributes=True)
+    return json.dumps(validated.model_dump(mode="json")).encode()
+
+
+def columnar_path(storage: JobResultStorage, template_ids: list[int], samples_per_template: int) -> bytes:
+    storage.save(1, "run", mock_job_result_columns(template_ids, DataSpecification(), samples_per_template))
+    return encode_results(storage.load(1, "run"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--templates", type=int, default=10)
+    parser.add_argument("--memory", action="store_true", help="also report peak memory, traced in a separate run")
+    args = parser.parse_args()
+
+    template_ids = list(range(1, args.templates + 1))
+    job = TemplateMatchingJob(id=1)
+    job.document_template_ids = template_ids
+
+    print(f"{'samples':>10} {'path':>9} {'seconds':>9} {'samples/s':>12} {'MiB out':>8} {'peak MiB':>9}")
+    for num_samples in args.samples:
+        samples_per_template = max(num_samples // args.templates, 1)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            storage = JobResultStorage(root=Path(tmp_dir))
+            paths: dict[str, Callable[[], bytes]] = {
+                "models": lambda: model_path(job, samples_per_template),
+                "columnar": lambda: columnar_path(storage, template_ids, samples_per_template),
+            }
+            timings = {}
+            for name, path in paths.items():
+                body, elapsed, _ = measure(path, with_memory=False)
+                peak = measure(path, with_memory=True)[2] if args.memory else 0
+                timings[name] = elapsed
+                print(
+                    f"{num_samples:>10} {name:>9} {elapsed:>9.3f} {num_samples / elapsed:>12,.0f} "
+                    f"{len(body) / 2**20:>8.1f} {peak / 2**20 if args.memory else float('nan'):>9.1f}"
+                )
+        print(f"{'':>10} {'speedup':>9} {timings['models'] / timings['columnar']:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Repeated template downloads with and without the in-process LRU template cache.
+
+Template ids are drawn from a Zipf distribution, so a small set of hot templates gets most of the downloads.
+The `local` backend hides its filesystem path (like an object store would), so downloads go through
+`TemplateStorage.iter_range` and can be served by the cache.
+
+Run from the project root:
+    uv run --frozen python -m benchmarks.template_cache --backend local --cache-mb 64
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from sqlalchemy import NullPool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncEngine, AsyncSession
+
+from template_matching_api.api import dependencies
+from template_matching_api.db_model import Base, DocumentTemplate
+from template_matching_api.file_storage import CachedTemplateStorage, DocumentTemplateStorage, TemplateStorage
+from template_matching_api.main import app
+from template_matching_api.tests.storage import InMemoryTemplateStorage
+
+
+class ObjectStoreLikeStorage(DocumentTemplateStorage):
+    def local_path(self, template_id: int) -> Path | None:
+        return None
+
+
+async def seed(engine: AsyncEngine, session_maker: async_sessionmaker[AsyncSession], num_templates: int) -> list[int]:
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+    async with session_maker.begin() as session:
+        templates = [
+            DocumentTemplate(
+                name=f"template_{idx}",
+                template_filename=f"template_{idx}.jpg",
+                template_file_type="image/jpeg",
+                uploaded_at=datetime.now(),
+            )
+            for idx in range(num_templates)
+        ]
+        session.add_all(templates)
+        await session.flush()
+        return [template.id for template in templates]
+
+
+def downloads_per_second(
+    storage: TemplateStorage, template_ids: list[int], num_downloads: int, zipf_s: float
+) -> float:
+    weights = [1 / rank**zipf_s for rank in range(1, len(template_ids) + 1)]
+    picks = random.Random(0).choices(template_ids, weights=weights, k=num_downloads)
+    app.dependency_overrides[dependencies.get_template_storage] = lambda: storage
+    with TestClient(app) as client:
+        started = time.perf_counter()
+        for template_id in picks:
+            resp = client.get(f"/api/document-template/{template_id}/download")
+            assert resp.status_code == 200, resp.text
+        return num_downloads / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["local", "memory"], default="local")
+    parser.add_argument("--templates", type=int, default=200)
+    parser.add_argument("--template-kb", type=int, default=512)
+    parser.add_argument("--downloads", type=int, default=2_000)
+    parser.add_argument("--cache-mb", type=int, default=32)
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{Path(tmp_dir) / 'bench.db'}", poolclass=NullPool)
+        session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+        template_ids = asyncio.run(seed(engine, session_maker, args.templates))
+        app.dependency_overrides[dependencies.get_async_session_maker] = lambda: session_maker
+
+        backend: TemplateStorage = (
+            ObjectStoreLikeStorage(root=Path(tmp_dir)) if args.backend == "local" else InMemoryTemplateStorage()
+        )
+        for template_id in template_ids:
+            backend.save(template_id, random.randbytes(args.template_kb * 1024))
+
+        uncached = downloads_per_second(backend, template_ids, args.downloads, args.zipf_s)
+        cached_storage = CachedTemplateStorage(backend, max_bytes=args.cache_mb * 1024 * 1024)
+        cached = downloads_per_second(cached_storage, template_ids, args.downloads, args.zipf_s)
+        app.dependency_overrides.clear()
+
+    stats = cached_storage.stats()
+    print(f"backend={args.backend} templates={args.templates}x{args.template_kb}KiB cache={args.cache_mb}MiB")
+    print(f"uncached: {uncached:>8.1f} downloads/s")
+    print(f"cached:   {cached:>8.1f} downloads/s ({cached / uncached:.2f}x)")
+    print(
+        f"hits={stats.hits} misses={stats.misses} evictions={stats.evictions} "
+        f"hit ratio={stats.hits / max(stats.hits + stats.misses, 1):.1%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 from fastapi import APIRouter
-from template_matching_api.api.endpoints import document_template, template_matching_job, workspace
+from template_matching_api.api.endpoints import document_template, template_matching_job, template_upload, workspace
 
 api_router = APIRouter()
 api_router.include_router(document_template.router, prefix="/document-template", tags=["document-templates"])
+api_router.include_router(template_upload.router, prefix="/template-upload", tags=["document-templates"])
 api_router.include_router(template_matching_job.router, prefix="/template-matching-job", tags=["template-matching"])
 api_router.include_router(workspace.router, prefix="/workspace", tags=["workspace"])
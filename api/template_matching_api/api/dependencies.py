@@ -1,16 +1,93 @@
-from typing import Generator
+from concurrent.futures import Executor
+from functools import cache
+from typing import AsyncGenerator, Generator
 
 from fastapi import Depends
+from sqlalchemy import Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker, Session
 
-from template_matching_api.db import get_db
+from template_matching_api.db import get_async_db, get_db, make_read_only
+from template_matching_api.derivatives import get_process_pool
+from template_matching_api.file_storage import (
+    AsyncDocumentTemplateStorage,
+    TemplateStorage,
+    create_template_storage,
+)
+from template_matching_api.job_events import JobEventBroker
+from template_matching_api.result_storage import JobResultStorage, create_result_storage
+from template_matching_api.settings import get_settings
 
 
-def get_session_maker() -> sessionmaker[Session]:
-    engine = get_db()
+@cache
+def _session_maker_for(engine: Engine) -> sessionmaker[Session]:
     return sessionmaker(bind=engine)
 
 
+@cache
+def _async_session_maker_for(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    # Objects stay usable after commit, lazy refreshes are not possible outside of the session's greenlet
+    return async_sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def get_session_maker() -> sessionmaker[Session]:
+    return _session_maker_for(get_db())
+
+
 def get_session(session_maker: sessionmaker[Session] = Depends(get_session_maker)) -> Generator[Session, None, None]:
     with session_maker.begin() as session:
         yield session
+
+
+def get_read_only_session(
+    session_maker: sessionmaker[Session] = Depends(get_session_maker),
+) -> Generator[Session, None, None]:
+    # Only ever issues SELECTs (pysqlite does not even emit BEGIN for them), writes raise `ReadOnlySessionError`, and
+    # closing the session just returns the connection to the pool.
+    with session_maker(autoflush=False) as session:
+        make_read_only(session)
+        yield session
+
+
+def get_async_session_maker() -> async_sessionmaker[AsyncSession]:
+    return _async_session_maker_for(get_async_db())
+
+
+async def get_async_session(
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+) -> AsyncGenerator[AsyncSession, None]:
+    async with session_maker.begin() as session:
+        yield session
+
+
+async def get_async_read_only_session(
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+) -> AsyncGenerator[AsyncSession, None]:
+    async with session_maker(autoflush=False) as session:
+        make_read_only(session.sync_session)
+        yield session
+
+
+@cache
+def get_template_storage() -> TemplateStorage:
+    return create_template_storage(get_settings())
+
+
+def get_async_template_storage(
+    storage: TemplateStorage = Depends(get_template_storage),
+) -> AsyncDocumentTemplateStorage:
+    return AsyncDocumentTemplateStorage(storage)
+
+
+@cache
+def get_result_storage() -> JobResultStorage:
+    return create_result_storage(get_settings())
+
+
+@cache
+def get_job_event_broker() -> JobEventBroker:
+    return JobEventBroker(get_settings().job_events_poll_interval_seconds)
+
+
+def get_derivative_executor() -> Executor:
+    return get_process_pool()
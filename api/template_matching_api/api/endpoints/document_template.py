@@ -1,37 +1,211 @@
+import asyncio
 import json
+import os
+import re
+from concurrent.futures import Executor
 from datetime import datetime
+from email.utils import formatdate
+from typing import AsyncIterator, Sequence
+from urllib.parse import quote
 
-from fastapi import APIRouter, Depends, status, UploadFile, File, Form, HTTPException
-from fastapi.responses import Response
+from fastapi import APIRouter, BackgroundTasks, Depends, status, UploadFile, File, Form, Header, HTTPException, Query
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import select, func
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
-from template_matching_api.api.dependencies import get_session, get_session_maker
+from template_matching_api.api.dependencies import (
+    get_async_read_only_session,
+    get_async_session,
+    get_async_session_maker,
+    get_async_template_storage,
+    get_derivative_executor,
+)
 from template_matching_api.api_models.document_template import (
+    DocumentTemplateBatchIn,
+    DocumentTemplateBatchItem,
     DocumentTemplateOut,
     DocumentTemplateIn,
     DocumentTemplateUpdate,
 )
-from template_matching_api.db import session_scope
 from template_matching_api.db_model import DocumentTemplate
-from template_matching_api.file_storage import DocumentTemplateStorage
+from template_matching_api.derivatives import (
+    THUMBNAIL_MEDIA_TYPE,
+    UNVERSIONED,
+    UnsupportedImageError,
+    closest_thumbnail_size,
+    store_derivatives,
+    store_derivatives_in_background,
+    thumbnail_name,
+)
+from template_matching_api.file_storage import AsyncDocumentTemplateStorage, TemplateTooLargeError
+from template_matching_api.jobs.memoization import invalidate_memoized_results
+from template_matching_api.settings import Settings, get_settings
 
 router = APIRouter()
 
+_SINGLE_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+# Thumbnails loaded (or regenerated) concurrently while streaming a batch
+_BATCH_CONCURRENCY = 16
 
-@router.get("/", status_code=status.HTTP_200_OK)
-def list_document_templates(
-    session: Session = Depends(get_session),
+
+async def _iter_upload_chunks(file: UploadFile, chunk_size: int) -> AsyncIterator[bytes]:
+    while chunk := await file.read(chunk_size):
+        yield chunk
+
+
+async def _store_uploaded_file(
+    template: DocumentTemplate,
+    file: UploadFile,
+    template_storage: AsyncDocumentTemplateStorage,
+    settings: Settings,
+    background_tasks: BackgroundTasks,
+    executor: Executor,
+) -> None:
+    try:
+        stored = await template_storage.save_stream(
+            template.id,
+            _iter_upload_chunks(file, settings.template_upload_chunk_size),
+            max_size=settings.template_max_size,
+        )
+    except TemplateTooLargeError as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+    template.template_sha256 = stored.sha256
+    template.template_size = stored.size
+    background_tasks.add_task(
+        store_derivatives_in_background,
+        template_storage,
+        executor,
+        template.id,
+        stored.sha256,
+        template.template_file_type,
+    )
+
+
+def _content_disposition(filename: str) -> str:
+    quoted_filename = quote(filename)
+    if quoted_filename != filename:
+        return f"attachment; filename*=utf-8''{quoted_filename}"
+    return f'attachment; filename="{filename}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+
+def _parse_single_range(http_range: str, file_size: int) -> tuple[int, int] | None:
+    """Parse `bytes=start-end`, `bytes=start-` or `bytes=-suffix` into a half-open [start, end) interval.
+
+    Returns None for anything else (multiple ranges, other units), the full file is served in that case.
+    Raises `HTTPException(416)` if the range cannot be satisfied.
+    """
+    match = _SINGLE_RANGE_PATTERN.match(http_range.replace(" ", ""))
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        start, end = max(file_size - int(last), 0), file_size
+    else:
+        start, end = int(first), min(int(last) + 1, file_size) if last else file_size
+    if start >= file_size or start >= end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{file_size}"},
+        )
+    return start, end
+
+
+async def _select_document_templates(
+    session: AsyncSession, template_ids: Sequence[int] | None = None
 ) -> list[DocumentTemplateOut]:
-    document_templates = session.scalars(select(DocumentTemplate))
+    query = select(DocumentTemplate)
+    if template_ids is not None:
+        query = query.where(DocumentTemplate.id.in_(template_ids))
+    document_templates = await session.scalars(query)
     return [DocumentTemplateOut.model_validate(dt) for dt in document_templates]
 
 
+async def _load_thumbnail(
+    template_storage: AsyncDocumentTemplateStorage, executor: Executor, template_id: int, version: str, size: int
+) -> bytes:
+    name = thumbnail_name(size)
+    try:
+        return await template_storage.load_derivative(template_id, version, name)
+    except FileNotFoundError:
+        # Not generated yet, or lost, e.g. templates uploaded before derivatives existed
+        return (await store_derivatives(template_storage, executor, template_id, version))[name]
+
+
+async def _load_batch_thumbnail(
+    template_storage: AsyncDocumentTemplateStorage, executor: Executor, template: DocumentTemplateOut, size: int
+) -> bytes:
+    try:
+        return await _load_thumbnail(
+            template_storage, executor, template.id, template.template_sha256 or UNVERSIONED, size
+        )
+    except (FileNotFoundError, UnsupportedImageError):
+        return b""
+
+
+async def _iter_batch_frames(
+    templates: list[DocumentTemplateOut],
+    template_storage: AsyncDocumentTemplateStorage,
+    executor: Executor,
+    thumbnail_size: int,
+) -> AsyncIterator[bytes]:
+    for offset in range(0, len(templates), _BATCH_CONCURRENCY):
+        window = templates[offset : offset + _BATCH_CONCURRENCY]
+        thumbnails = await asyncio.gather(
+            *(_load_batch_thumbnail(template_storage, executor, template, thumbnail_size) for template in window)
+        )
+        for template, thumbnail in zip(window, thumbnails):
+            metadata = DocumentTemplateBatchItem(
+                template=template, thumbnail_media_type=THUMBNAIL_MEDIA_TYPE if thumbnail else None
+            ).model_dump_json().encode()
+            yield b"".join((len(metadata).to_bytes(4, "big"), metadata, len(thumbnail).to_bytes(4, "big"), thumbnail))
+
+
+@router.get("/", status_code=status.HTTP_200_OK)
+async def list_document_templates(
+    session: AsyncSession = Depends(get_async_read_only_session),
+) -> list[DocumentTemplateOut]:
+    return await _select_document_templates(session)
+
+
+@router.post(
+    "/batch",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={status.HTTP_200_OK: {"content": {"application/octet-stream": {}}}},
+)
+async def batch_document_templates(
+    batch: DocumentTemplateBatchIn,
+    session: AsyncSession = Depends(get_async_read_only_session),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    executor: Executor = Depends(get_derivative_executor),
+) -> StreamingResponse:
+    """Metadata and thumbnails of several templates in a single response, e.g. for a page of the template list.
+
+    The body is one frame per existing template, in the requested order: a big-endian uint32 length followed by a
+    `DocumentTemplateBatchItem` JSON document, then a big-endian uint32 length followed by the thumbnail bytes (length
+    0 if no thumbnail could be made). Unknown ids are skipped.
+    """
+    templates_by_id = {template.id: template for template in await _select_document_templates(session, batch.ids)}
+    templates = [
+        templates_by_id[template_id] for template_id in dict.fromkeys(batch.ids) if template_id in templates_by_id
+    ]
+    return StreamingResponse(
+        _iter_batch_frames(templates, template_storage, executor, closest_thumbnail_size(batch.thumbnail_size)),
+        media_type="application/octet-stream",
+    )
+
+
 @router.get("/{template_id}", status_code=status.HTTP_200_OK)
-def get_document_template(
-    template_id: int, session: Session = Depends(get_session)
+async def get_document_template(
+    template_id: int, session: AsyncSession = Depends(get_async_read_only_session)
 ) -> DocumentTemplateOut:
-    template = session.scalar(
+    template = await session.scalar(
         select(DocumentTemplate).where(DocumentTemplate.id == template_id)
     )
     if template is None:
@@ -40,10 +214,14 @@ def get_document_template(
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def create_document_template(
+async def create_document_template(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     json_body: str = Form(...),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    settings: Settings = Depends(get_settings),
+    executor: Executor = Depends(get_derivative_executor),
 ) -> DocumentTemplateOut:
     body = json.loads(json_body)
     body["template_filename"] = file.filename
@@ -51,21 +229,19 @@ def create_document_template(
     body["uploaded_at"] = datetime.now()
     template = DocumentTemplate(**DocumentTemplateIn(**body).model_dump())
     session.add(template)
-    session.flush()
-    session.refresh(template)
-    template_id = template.id
-    template_storage = DocumentTemplateStorage()
-    template_storage.save(template_id, file.file.read())
+    await session.flush()
+    await session.refresh(template)
+    await _store_uploaded_file(template, file, template_storage, settings, background_tasks, executor)
     return DocumentTemplateOut.model_validate(template)
 
 
 @router.put("/{template_id}", status_code=status.HTTP_204_NO_CONTENT)
-def update_document_template(
+async def update_document_template(
     template_id: int,
     template_update: DocumentTemplateUpdate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> None:
-    template = session.scalar(
+    template = await session.scalar(
         select(DocumentTemplate).where(DocumentTemplate.id == template_id)
     )
     if template is None:
@@ -75,14 +251,19 @@ def update_document_template(
     for key, value in update_data.items():
         if hasattr(template, key):
             setattr(template, key, value)
-    session.commit()
 
 
 @router.post("/{template_id}/upload", status_code=status.HTTP_204_NO_CONTENT)
-def upload_document_template(
-    template_id: int, file: UploadFile, session: Session = Depends(get_session)
+async def upload_document_template(
+    template_id: int,
+    file: UploadFile,
+    background_tasks: BackgroundTasks,
+    session: AsyncSession = Depends(get_async_session),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    settings: Settings = Depends(get_settings),
+    executor: Executor = Depends(get_derivative_executor),
 ) -> None:
-    template = session.scalar(
+    template = await session.scalar(
         select(DocumentTemplate).where(DocumentTemplate.id == template_id)
     )
     if template is None:
@@ -93,40 +274,143 @@ def upload_document_template(
     template.template_filename = file.filename
     template.template_file_type = file.headers.get("Content-Type", "image")
     template.uploaded_at = func.now()
-    DocumentTemplateStorage().save(template_id, file.file.read())
+    await _store_uploaded_file(template, file, template_storage, settings, background_tasks, executor)
+    await invalidate_memoized_results(session, template_id)
 
 
-@router.get("/{template_id}/download", status_code=status.HTTP_200_OK)
-def download_document_template(
-    template_id: int, session: Session = Depends(get_session)
+@router.get(
+    "/{template_id}/download",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_206_PARTIAL_CONTENT: {"description": "Requested byte range of the template file"},
+        status.HTTP_304_NOT_MODIFIED: {"description": "Template file matches `If-None-Match`"},
+    },
+)
+async def download_document_template(
+    template_id: int,
+    range_header: str | None = Header(None, alias="Range"),
+    if_none_match: str | None = Header(None),
+    session: AsyncSession = Depends(get_async_read_only_session),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
 ) -> Response:
-    try:
-        filename, file_type = session.execute(
+    template = (
+        await session.execute(
             select(
-                DocumentTemplate.template_filename, DocumentTemplate.template_file_type
+                DocumentTemplate.template_filename,
+                DocumentTemplate.template_file_type,
+                DocumentTemplate.template_sha256,
+                DocumentTemplate.uploaded_at,
             ).where(DocumentTemplate.id == template_id)
-        ).one()
-        template_storage = DocumentTemplateStorage()
-        file_bytes = template_storage.load(template_id)
-        headers = {"Content-Disposition": f"attachment; filename={filename}"}
-        return Response(content=file_bytes, media_type=file_type, headers=headers)
+        )
+    ).one_or_none()
+    if template is None:
+        raise HTTPException(status_code=404)
+
+    # no-cache: clients may keep the body but have to revalidate it, the file can be re-uploaded under the same URL
+    headers = {
+        "Cache-Control": "no-cache",
+        "Last-Modified": formatdate(template.uploaded_at.timestamp(), usegmt=True),
+    }
+    if template.template_sha256 is not None:
+        headers["ETag"] = f'"{template.template_sha256}"'
+        if if_none_match is not None and _etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    headers["Content-Disposition"] = _content_disposition(template.template_filename)
+
+    try:
+        local_path = template_storage.local_path(template_id)
+        if local_path is not None:
+            # Streamed straight from the file (or via `http.response.pathsend` where the server supports it),
+            # FileResponse also handles Range/If-Range requests
+            stat_result = await run_in_threadpool(os.stat, local_path)
+            return FileResponse(
+                local_path,
+                stat_result=stat_result,
+                media_type=template.template_file_type,
+                headers=headers,
+            )
+        file_size = await template_storage.size(template_id)
     except FileNotFoundError:
         raise HTTPException(status_code=404)
 
+    headers["Accept-Ranges"] = "bytes"
+    byte_range = _parse_single_range(range_header, file_size) if range_header else None
+    if byte_range is None:
+        return StreamingResponse(
+            template_storage.iter_range(template_id),
+            media_type=template.template_file_type,
+            headers=headers | {"Content-Length": str(file_size)},
+        )
+    start, end = byte_range
+    return StreamingResponse(
+        template_storage.iter_range(template_id, start, end),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=template.template_file_type,
+        headers=headers | {
+            "Content-Length": str(end - start),
+            "Content-Range": f"bytes {start}-{end - 1}/{file_size}",
+        },
+    )
+
+
+@router.get(
+    "/{template_id}/thumbnail",
+    status_code=status.HTTP_200_OK,
+    response_class=Response,
+    responses={
+        status.HTTP_200_OK: {"content": {THUMBNAIL_MEDIA_TYPE: {}}},
+        status.HTTP_304_NOT_MODIFIED: {"description": "Thumbnail matches `If-None-Match`"},
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE: {"description": "Template file is not a supported image"},
+    },
+)
+async def get_document_template_thumbnail(
+    template_id: int,
+    size: int = Query(256, gt=0, description="Thumbnails are at least this large, up to the largest one generated"),
+    if_none_match: str | None = Header(None),
+    session: AsyncSession = Depends(get_async_read_only_session),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    executor: Executor = Depends(get_derivative_executor),
+) -> Response:
+    template = (
+        await session.execute(
+            select(DocumentTemplate.template_sha256).where(DocumentTemplate.id == template_id)
+        )
+    ).one_or_none()
+    if template is None:
+        raise HTTPException(status_code=404)
+
+    version = template.template_sha256 or UNVERSIONED
+    thumbnail_size = closest_thumbnail_size(size)
+    headers = {"Cache-Control": "no-cache", "ETag": f'"{version}-{thumbnail_size}"'}
+    if if_none_match is not None and _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    try:
+        thumbnail = await _load_thumbnail(template_storage, executor, template_id, version, thumbnail_size)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404)
+    except UnsupportedImageError:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Template file is not a supported image"
+        )
+    return Response(thumbnail, media_type=THUMBNAIL_MEDIA_TYPE, headers=headers)
+
 
 @router.delete("/{template_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_document_template(
-    template_id: int, session_maker: sessionmaker[Session] = Depends(get_session_maker)
+async def delete_document_template(
+    template_id: int,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
 ) -> None:
     try:
-        with session_scope(session_maker) as session:
-            template = session.scalar(
+        async with session_maker.begin() as session:
+            template = await session.scalar(
                 select(DocumentTemplate).where(DocumentTemplate.id == template_id)
             )
             if template is None:
                 raise HTTPException(status_code=404)
 
-            session.delete(template)
-        DocumentTemplateStorage().delete(template_id)
+            await session.delete(template)
+        await template_storage.delete(template_id)
     except FileNotFoundError:
         raise HTTPException(status_code=404)
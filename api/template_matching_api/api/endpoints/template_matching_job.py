@@ -1,123 +1,417 @@
-import random
-import uuid
+from datetime import date, timedelta
+from typing import Literal
 
-from fastapi import APIRouter, Depends, HTTPException, status
+import anyio
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, status
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy import select
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import joinedload, selectinload
+from starlette.concurrency import run_in_threadpool
 
-from template_matching_api.api.dependencies import get_session
+from template_matching_api.api.dependencies import (
+    get_async_read_only_session,
+    get_async_session,
+    get_async_session_maker,
+    get_job_event_broker,
+    get_result_storage,
+)
+from template_matching_api.api_models.sample import FileType
 from template_matching_api.api_models.template_matching_job import (
     TemplateMatchingJobOut,
     TemplateMatchingJobIn,
     JobState,
     TemplateMatchingJobResults,
+    TemplateMatchingJobResultStats,
+    TemplateMatchingJobShardOut,
+    WorkspaceQueueMetrics,
+)
+from template_matching_api.db_model import TemplateMatchingJob, TemplateMatchingJobShard, Workspace
+from template_matching_api.job_events import (
+    FINISHED_JOB_STATES,
+    JobEventBroker,
+    Topic,
+    iter_sse_events,
+    wait_for_job_state,
 )
-from template_matching_api.db_model import TemplateMatchingJob, Workspace
-from template_matching_api.api_models.data_specification import DataSpecification
-from template_matching_api.jobs.template_matching_job import mock_job_results_with_data_spec
+from template_matching_api.jobs.memoization import submit_job_with_memoization
+from template_matching_api.jobs.queue import cancel_job
+from template_matching_api.jobs.scheduler import workspace_queue_metrics
+from template_matching_api.result_queries import InvalidCursorError, ResultPage, ResultQuery, select_results
+from template_matching_api.result_stats import StatsQuery, compute_result_stats
+from template_matching_api.result_storage import (
+    ENCODE_CHUNK_ROWS,
+    JobResultColumns,
+    JobResultStorage,
+    ResultsNotFoundError,
+    count_rows,
+    encode_results,
+    iter_ndjson_results,
+)
+from template_matching_api.settings import Settings, get_settings
 
 router = APIRouter()
 
-
-def submit_job(job: TemplateMatchingJob) -> None:
-    job.job_id = str(uuid.uuid4())
-    job.job_state = random.choice(list(JobState))
+# Everything `TemplateMatchingJobOut` touches, relationships cannot be lazy loaded on an `AsyncSession`
+JOB_OUT_LOAD_OPTIONS = (
+    selectinload(TemplateMatchingJob.workspace),
+    selectinload(TemplateMatchingJob.document_templates),
+)
 
 
 @router.get("/", status_code=status.HTTP_200_OK)
-def list_template_matching_jobs(
-    session: Session = Depends(get_session),
+async def list_template_matching_jobs(
+    session: AsyncSession = Depends(get_async_read_only_session),
 ) -> list[TemplateMatchingJobOut]:
     jobs = (
-        session.scalars(
+        await session.scalars(
             select(TemplateMatchingJob).options(
-                joinedload(TemplateMatchingJob.document_templates)
+                joinedload(TemplateMatchingJob.document_templates),
+                selectinload(TemplateMatchingJob.workspace),
             )
         )
-        .unique()
-        .all()
-    )
+    ).unique().all()
     return [TemplateMatchingJobOut.model_validate(job) for job in jobs]
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def create_template_matching_job(
+async def create_template_matching_job(
     template_matching_job_in: TemplateMatchingJobIn,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
+    result_storage: JobResultStorage = Depends(get_result_storage),
 ) -> TemplateMatchingJobOut:
     if template_matching_job_in.workspace_id is None:
         raise HTTPException(status_code=404, detail="Workspace not found")
     
-    workspace = session.get(Workspace, template_matching_job_in.workspace_id)
+    workspace = await session.get(Workspace, template_matching_job_in.workspace_id)
     if workspace is None:
         raise HTTPException(status_code=404, detail="Workspace not found")
 
     job = TemplateMatchingJob(**template_matching_job_in.model_dump())
     session.add(job)
-    session.flush()
-    session.refresh(job)
-    submit_job(job)
+    await session.flush()
+    await session.refresh(job, ["created_at", "workspace", "document_templates"])
+    await submit_job_with_memoization(session, job, result_storage)
     return TemplateMatchingJobOut.model_validate(job)
 
 
-@router.get("/{template_matching_job_id}", status_code=status.HTTP_200_OK)
-def get_template_matching_job(
-    template_matching_job_id: int, session: Session = Depends(get_session)
+def get_event_topic(job_id: int | None = None, workspace_id: int | None = None) -> Topic:
+    if (job_id is None) == (workspace_id is None):
+        raise HTTPException(status_code=422, detail="Exactly one of job_id and workspace_id is required")
+    return Topic(job_id=job_id, workspace_id=workspace_id)
+
+
+# Declared before the routes of single jobs, which would match the paths too
+@router.get(
+    "/events",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"text/event-stream": {}},
+            "description": "A `job` event with a `TemplateMatchingJobEvent` whenever the state or progress of the job, "
+            "or of a job of the workspace, changes",
+        }
+    },
+)
+async def stream_template_matching_job_events(
+    topic: Topic = Depends(get_event_topic),
+    broker: JobEventBroker = Depends(get_job_event_broker),
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    settings: Settings = Depends(get_settings),
+) -> StreamingResponse:
+    # No session is held while streaming, the events are loaded by the broker for all subscribers at once
+    return StreamingResponse(
+        iter_sse_events(broker, session_maker, topic, settings.job_events_keepalive_seconds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/events/ws")
+async def template_matching_job_events_websocket(
+    websocket: WebSocket,
+    job_id: int | None = None,
+    workspace_id: int | None = None,
+    broker: JobEventBroker = Depends(get_job_event_broker),
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+) -> None:
+    """Like `GET /events`, every message is a `TemplateMatchingJobEvent`"""
+    if (job_id is None) == (workspace_id is None):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Exactly one of job_id and workspace_id")
+        return
+    await websocket.accept()
+
+    async with anyio.create_task_group() as task_group:
+        async def close_on_disconnect() -> None:
+            # Messages of the client are ignored
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+            task_group.cancel_scope.cancel()
+
+        task_group.start_soon(close_on_disconnect)
+        async with broker.subscribe(session_maker, Topic(job_id=job_id, workspace_id=workspace_id)) as subscription:
+            while True:
+                for event in await subscription.next_events():
+                    await websocket.send_text(event.model_dump_json())
+
+
+@router.get("/queue-metrics", status_code=status.HTTP_200_OK)
+async def get_job_queue_metrics(
+    window_seconds: float = Query(default=3600, gt=0, description="Wait times of the jobs started this recently"),
+    session: AsyncSession = Depends(get_async_read_only_session),
+) -> list[WorkspaceQueueMetrics]:
+    return await workspace_queue_metrics(session, timedelta(seconds=window_seconds))
+
+
+async def _load_job_out(
+    session_maker: async_sessionmaker[AsyncSession], template_matching_job_id: int
 ) -> TemplateMatchingJobOut:
-    job = session.scalar(
-        select(TemplateMatchingJob).where(
-            TemplateMatchingJob.id == template_matching_job_id
+    async with session_maker(autoflush=False) as session:
+        job = await session.scalar(
+            select(TemplateMatchingJob)
+            .where(TemplateMatchingJob.id == template_matching_job_id)
+            .options(*JOB_OUT_LOAD_OPTIONS)
         )
+        if job is None:
+            raise HTTPException(status_code=404)
+        return TemplateMatchingJobOut.model_validate(job)
+
+
+@router.get("/{template_matching_job_id}", status_code=status.HTTP_200_OK)
+async def get_template_matching_job(
+    template_matching_job_id: int,
+    wait_for_state: JobState | None = Query(
+        default=None,
+        description="Respond once the job is in this state or has finished, or when `timeout` expires (long polling)",
+    ),
+    timeout: float = Query(default=30.0, gt=0, description="Seconds to wait for `wait_for_state` at most"),
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    broker: JobEventBroker = Depends(get_job_event_broker),
+    settings: Settings = Depends(get_settings),
+) -> TemplateMatchingJobOut:
+    # Sessions only for loading the job, none is held while waiting
+    job = await _load_job_out(session_maker, template_matching_job_id)
+    if wait_for_state is None or job.job_state == wait_for_state or job.job_state in FINISHED_JOB_STATES:
+        return job
+
+    await wait_for_job_state(
+        broker,
+        session_maker,
+        template_matching_job_id,
+        wait_for_state,
+        min(timeout, settings.job_wait_max_timeout_seconds),
     )
-    if job is None:
-        raise HTTPException(status_code=404)
+    return await _load_job_out(session_maker, template_matching_job_id)
 
-    return TemplateMatchingJobOut.model_validate(job)
 
+@router.get("/{template_matching_job_id}/shards", status_code=status.HTTP_200_OK)
+async def list_template_matching_job_shards(
+    template_matching_job_id: int, session: AsyncSession = Depends(get_async_read_only_session)
+) -> list[TemplateMatchingJobShardOut]:
+    """Progress of the current run, templates with reusable results of earlier runs are not part of any shard"""
+    job = await session.get(TemplateMatchingJob, template_matching_job_id)
+    if job is None:
+        raise HTTPException(status_code=404)
 
-@router.get("/{template_matching_job_id}/results", status_code=status.HTTP_200_OK)
-def get_template_matching_job_results(
-    template_matching_job_id: int, session: Session = Depends(get_session)
-) -> TemplateMatchingJobResults:
-    job = session.scalar(
-        select(TemplateMatchingJob).where(
-            TemplateMatchingJob.id == template_matching_job_id
+    shards = await session.scalars(
+        select(TemplateMatchingJobShard)
+        .where(
+            TemplateMatchingJobShard.template_matching_job_id == job.id,
+            TemplateMatchingJobShard.run_id == job.job_id,
         )
+        .order_by(TemplateMatchingJobShard.shard_index)
     )
-    if job is None or job.job_state != JobState.SUCCEEDED:
+    return [TemplateMatchingJobShardOut.model_validate(shard) for shard in shards]
+
+
+async def _load_job_results(
+    template_matching_job_id: int, session: AsyncSession, result_storage: JobResultStorage
+) -> tuple[str, JobResultColumns]:
+    job = await session.get(TemplateMatchingJob, template_matching_job_id)
+    if job is None or job.job_state != JobState.SUCCEEDED or job.job_id is None:
         raise HTTPException(status_code=404)
 
-    data_spec_model = (
-        DataSpecification.model_validate(job.workspace.data_specification)
-        if job.workspace and job.workspace.data_specification
-        else DataSpecification()
+    try:
+        return job.job_id, await run_in_threadpool(result_storage.load, job.id, job.job_id)
+    except ResultsNotFoundError:
+        raise HTTPException(status_code=404, detail="Results of the job are not available")
+
+
+def get_result_query(
+    top_k: int | None = Query(default=None, ge=1, description="Only the best scoring sample results per template"),
+    min_score: float | None = None,
+    file_type: FileType | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> ResultQuery:
+    return ResultQuery(top_k=top_k, min_score=min_score, file_type=file_type, date_from=date_from, date_to=date_to)
+
+
+async def _select_job_results(
+    template_matching_job_id: int,
+    query: ResultQuery,
+    cursor: str | None,
+    limit: int | None,
+    session: AsyncSession,
+    result_storage: JobResultStorage,
+) -> tuple[JobResultColumns, ResultPage]:
+    run_id, columns = await _load_job_results(template_matching_job_id, session, result_storage)
+    try:
+        # The selection of a page is computed up front, the rows are only rendered while responding
+        page = await run_in_threadpool(select_results, columns, query, run_id, cursor, limit)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return columns, page
+
+
+def _page_headers(page: ResultPage) -> dict[str, str]:
+    return {"X-Next-Cursor": page.next_cursor} if page.next_cursor is not None else {}
+
+
+@router.get(
+    "/{template_matching_job_id}/results",
+    status_code=status.HTTP_200_OK,
+    response_model=TemplateMatchingJobResults,
+    responses={
+        status.HTTP_200_OK: {
+            "headers": {"X-Next-Cursor": {"description": "`cursor` of the next page, missing on the last page"}}
+        }
+    },
+)
+async def get_template_matching_job_results(
+    template_matching_job_id: int,
+    query: ResultQuery = Depends(get_result_query),
+    cursor: str | None = None,
+    limit: int | None = Query(default=None, ge=1, description="Sample results per page"),
+    session: AsyncSession = Depends(get_async_read_only_session),
+    result_storage: JobResultStorage = Depends(get_result_storage),
+) -> Response:
+    columns, page = await _select_job_results(
+        template_matching_job_id, query, cursor, limit, session, result_storage
+    )
+    # Serialized straight from the stored columns, the response model only documents the schema
+    return Response(
+        content=await run_in_threadpool(encode_results, columns, page.selection),
+        media_type="application/json",
+        headers=_page_headers(page),
     )
 
-    return mock_job_results_with_data_spec(job, data_spec_model)
+
+@router.get(
+    "/{template_matching_job_id}/results/stream",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "content": {"application/x-ndjson": {}},
+            "description": "One sample result (`record=sample`) or one chunk of the sample results of a template "
+            "(`record=chunk`, a `TemplateMatchingJobTempLateResults`) per line",
+        }
+    },
+)
+async def stream_template_matching_job_results(
+    template_matching_job_id: int,
+    record: Literal["sample", "chunk"] = "chunk",
+    chunk_size: int = Query(default=1000, ge=1, le=ENCODE_CHUNK_ROWS),
+    query: ResultQuery = Depends(get_result_query),
+    cursor: str | None = None,
+    limit: int | None = Query(default=None, ge=1, description="Sample results per page"),
+    session: AsyncSession = Depends(get_async_read_only_session),
+    result_storage: JobResultStorage = Depends(get_result_storage),
+) -> StreamingResponse:
+    columns, page = await _select_job_results(
+        template_matching_job_id, query, cursor, limit, session, result_storage
+    )
+    # Lines are rendered from the memory-mapped columns as the client reads them, a client closing the
+    # connection early stops the rendering
+    return StreamingResponse(
+        iter_ndjson_results(columns, page.selection, record, chunk_size),
+        media_type="application/x-ndjson",
+        headers={
+            "X-Result-Count": str(sum(count_rows(rows) for _template_id, rows in page.selection)),
+            "X-Total-Run-Time": str(columns.total_run_time),
+            **_page_headers(page),
+        },
+    )
+
+
+@router.get(
+    "/{template_matching_job_id}/results/stats",
+    status_code=status.HTTP_200_OK,
+    response_model=TemplateMatchingJobResultStats,
+)
+async def get_template_matching_job_result_stats(
+    template_matching_job_id: int,
+    bins: int = Query(default=10, ge=1, le=1000, description="Score histogram bins"),
+    percentiles: list[float] = Query(default=[50.0, 90.0, 99.0], max_length=100),
+    range_min: float = Query(default=0.0, description="Lower edge of the score histograms"),
+    range_max: float = Query(default=1.0, description="Upper edge of the score histograms"),
+    session: AsyncSession = Depends(get_async_read_only_session),
+    result_storage: JobResultStorage = Depends(get_result_storage),
+) -> Response:
+    if range_max <= range_min:
+        raise HTTPException(status_code=422, detail="range_max must be greater than range_min")
+    if any(not 0 <= percentile <= 100 for percentile in percentiles):
+        raise HTTPException(status_code=422, detail="Percentiles must be between 0 and 100")
+    query = StatsQuery(bins=bins, percentiles=tuple(percentiles), range_min=range_min, range_max=range_max)
+
+    run_id, columns = await _load_job_results(template_matching_job_id, session, result_storage)
+    # Results of a run never change, the statistics are computed once per run and query
+    cache_name = query.cache_name()
+    stats_json = await run_in_threadpool(result_storage.load_aggregate, template_matching_job_id, run_id, cache_name)
+    if stats_json is None:
+        stats = await run_in_threadpool(compute_result_stats, columns, query)
+        stats_json = stats.model_dump_json().encode()
+        await run_in_threadpool(result_storage.save_aggregate, template_matching_job_id, run_id, cache_name, stats_json)
+    return Response(content=stats_json, media_type="application/json")
 
 
 @router.post(
     "/{template_matching_job_id}/submit", status_code=status.HTTP_204_NO_CONTENT
 )
-def rerun_template_matching_job(
-    template_matching_job_id: int, session: Session = Depends(get_session)
+async def rerun_template_matching_job(
+    template_matching_job_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    result_storage: JobResultStorage = Depends(get_result_storage),
 ) -> None:
-    job = session.scalar(
-        select(TemplateMatchingJob).where(
-            TemplateMatchingJob.id == template_matching_job_id
-        )
+    job = await session.scalar(
+        select(TemplateMatchingJob)
+        .where(TemplateMatchingJob.id == template_matching_job_id)
+        .options(*JOB_OUT_LOAD_OPTIONS)
     )
     if job is None:
         raise HTTPException(status_code=404)
 
-    submit_job(job)
+    await submit_job_with_memoization(session, job, result_storage)
+
+
+@router.post("/{template_matching_job_id}/cancel", status_code=status.HTTP_200_OK)
+async def cancel_template_matching_job(
+    template_matching_job_id: int, session: AsyncSession = Depends(get_async_session)
+) -> TemplateMatchingJobOut:
+    """Cancel a submitted or running job, its worker stops after the shard it is computing"""
+    if not await session.run_sync(cancel_job, template_matching_job_id):
+        if await session.get(TemplateMatchingJob, template_matching_job_id) is None:
+            raise HTTPException(status_code=404)
+        raise HTTPException(status_code=409, detail="Template matching job is not submitted or running")
+
+    job = await session.scalar(
+        select(TemplateMatchingJob)
+        .where(TemplateMatchingJob.id == template_matching_job_id)
+        .options(*JOB_OUT_LOAD_OPTIONS)
+        .execution_options(populate_existing=True)
+    )
+    return TemplateMatchingJobOut.model_validate(job)
 
 
 @router.delete("/{template_matching_job_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_template_matching_job(
-    template_matching_job_id: int, session: Session = Depends(get_session)
+async def delete_template_matching_job(
+    template_matching_job_id: int,
+    session: AsyncSession = Depends(get_async_session),
+    result_storage: JobResultStorage = Depends(get_result_storage),
 ) -> None:
-    job = session.scalar(
+    job = await session.scalar(
         select(TemplateMatchingJob).where(
             TemplateMatchingJob.id == template_matching_job_id
         )
@@ -125,4 +419,6 @@ def delete_template_matching_job(
     if job is None:
         raise HTTPException(status_code=404)
 
-    session.delete(job)
+    await session.delete(job)
+    await session.flush()
+    await run_in_threadpool(result_storage.delete, template_matching_job_id)
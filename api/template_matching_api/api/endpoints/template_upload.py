@@ -0,0 +1,242 @@
+"""Resumable uploads of large template files.
+
+`POST /` creates an upload, `PATCH /{upload_id}` writes the body at the `Upload-Offset` request header and
+`HEAD /{upload_id}` tells where to resume after a dropped connection. `POST /{upload_id}/finalize` turns the complete
+upload into a document template. Chunks go straight to the template storage, nothing is reassembled in memory.
+"""
+import uuid
+from concurrent.futures import Executor
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Request, status
+from fastapi.responses import Response
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from template_matching_api.api.dependencies import (
+    get_async_session_maker,
+    get_async_template_storage,
+    get_derivative_executor,
+)
+from template_matching_api.api_models.document_template import DocumentTemplateOut
+from template_matching_api.api_models.template_upload import TemplateUploadIn, TemplateUploadOut
+from template_matching_api.db_model import DocumentTemplate, TemplateUpload
+from template_matching_api.derivatives import store_derivatives_in_background
+from template_matching_api.file_storage import (
+    AsyncDocumentTemplateStorage,
+    TemplateTooLargeError,
+    UploadInProgressError,
+)
+from template_matching_api.jobs.memoization import invalidate_memoized_results
+from template_matching_api.settings import Settings, get_settings
+from template_matching_api.template_uploads import expire_template_uploads
+
+router = APIRouter()
+
+
+def _offset_headers(upload: TemplateUpload) -> dict[str, str]:
+    return {
+        "Upload-Offset": str(upload.offset),
+        "Upload-Length": str(upload.total_size),
+        "Cache-Control": "no-store",
+    }
+
+
+async def _get_active_upload(session: AsyncSession, upload_id: str) -> TemplateUpload:
+    upload = await session.scalar(select(TemplateUpload).where(TemplateUpload.id == upload_id))
+    if upload is None:
+        raise HTTPException(status_code=404)
+    if upload.expires_at < datetime.now():
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Upload expired")
+    return upload
+
+
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def create_template_upload(
+    upload_in: TemplateUploadIn,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    settings: Settings = Depends(get_settings),
+) -> TemplateUploadOut:
+    if upload_in.total_size > settings.template_max_size:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=str(TemplateTooLargeError(settings.template_max_size)),
+        )
+    await expire_template_uploads(session_maker, template_storage)
+
+    async with session_maker.begin() as session:
+        if upload_in.template_id is not None and await session.get(DocumentTemplate, upload_in.template_id) is None:
+            raise HTTPException(status_code=404)
+        upload = TemplateUpload(
+            id=uuid.uuid4().hex,
+            offset=0,
+            expires_at=datetime.now() + timedelta(seconds=settings.template_upload_expiry_seconds),
+            **upload_in.model_dump(),
+        )
+        session.add(upload)
+        await session.flush()
+        await session.refresh(upload)
+    return TemplateUploadOut.model_validate(upload)
+
+
+@router.get("/{upload_id}", status_code=status.HTTP_200_OK)
+async def get_template_upload(
+    upload_id: str,
+    response: Response,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+) -> TemplateUploadOut:
+    async with session_maker() as session:
+        upload = await _get_active_upload(session, upload_id)
+    response.headers.update(_offset_headers(upload))
+    return TemplateUploadOut.model_validate(upload)
+
+
+@router.head("/{upload_id}", status_code=status.HTTP_200_OK)
+async def get_template_upload_offset(
+    upload_id: str,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+) -> Response:
+    async with session_maker() as session:
+        upload = await _get_active_upload(session, upload_id)
+    return Response(headers=_offset_headers(upload))
+
+
+@router.patch(
+    "/{upload_id}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    responses={status.HTTP_409_CONFLICT: {"description": "`Upload-Offset` does not match the current offset"}},
+)
+async def write_template_upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., ge=0),
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    settings: Settings = Depends(get_settings),
+) -> Response:
+    # No transaction is kept open while the body is transferred
+    async with session_maker() as session:
+        upload = await _get_active_upload(session, upload_id)
+    if upload_offset != upload.offset:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Upload-Offset does not match the current offset of the upload",
+            headers=_offset_headers(upload),
+        )
+    async with session_maker.begin() as session:
+        # Extended before the chunk is written, so that expiring uploads never removes one being written to
+        touched = await session.execute(
+            update(TemplateUpload)
+            .where(TemplateUpload.id == upload_id, TemplateUpload.expires_at >= datetime.now())
+            .values(expires_at=datetime.now() + timedelta(seconds=settings.template_upload_expiry_seconds))
+            .returning(TemplateUpload.id)
+        )
+        if touched.scalar_one_or_none() is None:
+            raise HTTPException(status_code=status.HTTP_410_GONE, detail="Upload expired")
+
+    try:
+        written = await template_storage.write_upload_chunk(
+            upload_id, upload_offset, request.stream(), max_size=upload.total_size - upload_offset
+        )
+    except TemplateTooLargeError:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Chunk exceeds the declared upload size"
+        )
+    except UploadInProgressError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+    async with session_maker.begin() as session:
+        # Only advances from the offset the chunk was written at, a concurrent chunk for the same offset loses
+        result = await session.execute(
+            update(TemplateUpload)
+            .where(TemplateUpload.id == upload_id, TemplateUpload.offset == upload_offset)
+            .values(
+                offset=upload_offset + written,
+                expires_at=datetime.now() + timedelta(seconds=settings.template_upload_expiry_seconds),
+            )
+            .returning(TemplateUpload)
+        )
+        updated_upload = result.scalar_one_or_none()
+    if updated_upload is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload was modified concurrently")
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_offset_headers(updated_upload))
+
+
+@router.post("/{upload_id}/finalize", status_code=status.HTTP_201_CREATED)
+async def finalize_template_upload(
+    upload_id: str,
+    background_tasks: BackgroundTasks,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+    executor: Executor = Depends(get_derivative_executor),
+) -> DocumentTemplateOut:
+    created_template_id: int | None = None
+    try:
+        async with session_maker.begin() as session:
+            upload = await _get_active_upload(session, upload_id)
+            if upload.offset != upload.total_size:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail=f"Upload is incomplete, {upload.offset} of {upload.total_size} bytes received",
+                    headers=_offset_headers(upload),
+                )
+            # Claims the upload, of concurrent finalizations only one deletes the row
+            claimed = await session.execute(
+                delete(TemplateUpload).where(TemplateUpload.id == upload_id).returning(TemplateUpload.id)
+            )
+            if claimed.scalar_one_or_none() is None:
+                raise HTTPException(status_code=404)
+
+            if upload.template_id is None:
+                template = DocumentTemplate(name=upload.name)
+                session.add(template)
+            else:
+                existing_template = await session.get(DocumentTemplate, upload.template_id)
+                if existing_template is None:
+                    raise HTTPException(status_code=404, detail="Template of the upload was deleted")
+                template = existing_template
+            template.template_filename = upload.template_filename
+            template.template_file_type = upload.template_file_type
+            template.uploaded_at = datetime.now()
+            await session.flush()
+            # The file is only moved into place once the template exists, a failure rolls the claim back
+            stored = await template_storage.finalize_upload(upload_id, template.id, upload.total_size)
+            if upload.template_id is None:
+                created_template_id = template.id
+            template.template_sha256 = stored.sha256
+            template.template_size = stored.size
+            if upload.template_id is not None:
+                await invalidate_memoized_results(session, upload.template_id)
+            await session.flush()
+            await session.refresh(template)
+    except BaseException:
+        # The file was moved into a template whose row is rolled back, e.g. because the commit failed
+        if created_template_id is not None:
+            await template_storage.delete(created_template_id)
+        raise
+
+    background_tasks.add_task(
+        store_derivatives_in_background,
+        template_storage,
+        executor,
+        template.id,
+        stored.sha256,
+        template.template_file_type,
+    )
+    return DocumentTemplateOut.model_validate(template)
+
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_template_upload(
+    upload_id: str,
+    session_maker: async_sessionmaker[AsyncSession] = Depends(get_async_session_maker),
+    template_storage: AsyncDocumentTemplateStorage = Depends(get_async_template_storage),
+) -> None:
+    async with session_maker.begin() as session:
+        deleted = await session.execute(
+            delete(TemplateUpload).where(TemplateUpload.id == upload_id).returning(TemplateUpload.id)
+        )
+        if deleted.scalar_one_or_none() is None:
+            raise HTTPException(status_code=404)
+    await template_storage.delete_upload(upload_id)
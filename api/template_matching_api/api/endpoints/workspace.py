@@ -1,9 +1,9 @@
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from template_matching_api.api.dependencies import get_session
+from template_matching_api.api.dependencies import get_async_read_only_session, get_async_session
 from template_matching_api.api_models.workspace import (
     WorkspaceIn,
     WorkspaceOut,
@@ -16,18 +16,18 @@ router = APIRouter()
 
 
 @router.get("/", status_code=status.HTTP_200_OK)
-def list_workspaces(
-    session: Session = Depends(get_session),
+async def list_workspaces(
+    session: AsyncSession = Depends(get_async_read_only_session),
 ) -> list[WorkspaceOut]:
-    workspaces = session.scalars(select(Workspace))
+    workspaces = await session.scalars(select(Workspace))
     return [WorkspaceOut.model_validate(ws) for ws in workspaces]
 
 
 @router.get("/{workspace_id}", status_code=status.HTTP_200_OK)
-def get_workspace(
-    workspace_id: int, session: Session = Depends(get_session)
+async def get_workspace(
+    workspace_id: int, session: AsyncSession = Depends(get_async_read_only_session)
 ) -> WorkspaceOut:
-    workspace = session.scalar(
+    workspace = await session.scalar(
         select(Workspace).where(Workspace.id == workspace_id)
     )
     if workspace is None:
@@ -36,26 +36,29 @@ def get_workspace(
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-def create_workspace(
+async def create_workspace(
     workspace_in: WorkspaceIn,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     ) -> WorkspaceOut:
     workspace = Workspace(
         name=workspace_in.name,
-        data_specification=workspace_in.data_specification.model_dump(mode="json")
+        data_specification=workspace_in.data_specification.model_dump(mode="json"),
+        max_concurrent_jobs=workspace_in.max_concurrent_jobs,
+        job_weight=workspace_in.job_weight,
     )
     session.add(workspace)
-    session.flush()
+    await session.flush()
+    await session.refresh(workspace)
     return WorkspaceOut.model_validate(workspace)
 
 
 @router.patch("/{workspace_id}", status_code=status.HTTP_204_NO_CONTENT)
-def update_workspace(
+async def update_workspace(
     workspace_id: int,
     update: WorkspaceUpdate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     ) -> None:
-    workspace = session.scalar(
+    workspace = await session.scalar(
         select(Workspace).where(Workspace.id == workspace_id)
     )
     if workspace is None:
@@ -65,13 +68,17 @@ def update_workspace(
         workspace.name = update.name
     if update.data_specification is not None:
         workspace.data_specification = update.data_specification.model_dump(mode="json")
+    if "max_concurrent_jobs" in update.model_fields_set:
+        workspace.max_concurrent_jobs = update.max_concurrent_jobs
+    if update.job_weight is not None:
+        workspace.job_weight = update.job_weight
 
 
 @router.delete("/{workspace_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_workspace(workspace_id: int, session: Session = Depends(get_session)) -> None:
-    workspace = session.scalar(select(Workspace).where(Workspace.id == workspace_id))
+async def delete_workspace(workspace_id: int, session: AsyncSession = Depends(get_async_session)) -> None:
+    workspace = await session.scalar(select(Workspace).where(Workspace.id == workspace_id))
     if workspace is None:
         raise HTTPException(status_code=404, detail="Workspace not found")
     
-    session.delete(workspace)
+    await session.delete(workspace)
 
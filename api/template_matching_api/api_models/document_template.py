@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class DocumentTemplateBase(BaseModel):
@@ -15,6 +15,8 @@ class DocumentTemplateOut(DocumentTemplateBase):
 
     id: int
     created_at: datetime
+    template_sha256: str | None = None
+    template_size: int | None = None
 
 
 class DocumentTemplateIn(DocumentTemplateBase):
@@ -23,3 +25,14 @@ class DocumentTemplateIn(DocumentTemplateBase):
 
 class DocumentTemplateUpdate(BaseModel):
     name: str
+
+
+class DocumentTemplateBatchIn(BaseModel):
+    ids: list[int] = Field(max_length=1000)
+    thumbnail_size: int = Field(128, gt=0)
+
+
+class DocumentTemplateBatchItem(BaseModel):
+    template: DocumentTemplateOut
+    # None if no thumbnail could be made, e.g. the template file is not an image
+    thumbnail_media_type: str | None
@@ -1,11 +1,11 @@
-from datetime import datetime
+from datetime import date, datetime
 from enum import StrEnum
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 
 from template_matching_api.api_models.document_template import DocumentTemplateOut
 from template_matching_api.api_models.workspace import WorkspaceOut
-from template_matching_api.api_models.sample import SampleResult, ExtendedSampleResult
+from template_matching_api.api_models.sample import FileType, SampleResult, ExtendedSampleResult
 
 
 class JobState(StrEnum):
@@ -13,11 +13,16 @@ class JobState(StrEnum):
     RUNNING = "RUNNING"
     FAILED = "FAILED"
     SUCCEEDED = "SUCCEEDED"
+    CANCELLED = "CANCELLED"
 
 
 class TemplateMatchingJobIn(BaseModel):
     workspace_id: int | None
     document_template_ids: list[int]
+    # Submitted jobs of a workspace with a higher priority run first
+    priority: int = 0
+    # Wall-clock seconds a run may take before it fails, `TEMPLATE_MATCHING_JOB_TIMEOUT_SECONDS` if None
+    timeout_seconds: float | None = Field(default=None, gt=0)
 
 
 class TemplateMatchingJobOut(BaseModel):
@@ -27,11 +32,60 @@ class TemplateMatchingJobOut(BaseModel):
     created_at: datetime
     job_state: JobState | None
     job_id: str | None
+    priority: int = 0
+    timeout_seconds: float | None = None
+    # Why the last run failed or was cancelled
+    error: str | None = None
+    # Set if the results of an earlier job with the same inputs were reused
+    memoized_from_id: int | None = None
+    # Work done by the last run, set once it succeeded
+    templates_computed: int | None = None
+    templates_reused: int | None = None
+    reused_run_time: int | None = None
 
     workspace: WorkspaceOut | None
     document_templates: list[DocumentTemplateOut]
 
 
+class TemplateMatchingJobEvent(BaseModel):
+    """State of a job, published to subscribers whenever it changes"""
+    id: int
+    workspace_id: int | None
+    job_state: JobState | None
+    job_id: str | None = None
+    error: str | None = None
+    # Progress of the current run
+    shards_total: int = 0
+    shards_succeeded: int = 0
+    deleted: bool = False
+
+
+class WorkspaceQueueMetrics(BaseModel):
+    workspace_id: int | None
+    queued: int
+    running: int
+    # How long the longest queued job has been waiting
+    oldest_queued_seconds: float | None
+    # Jobs started within the metrics window and how long they waited for a worker
+    started: int
+    mean_wait_seconds: float | None
+    max_wait_seconds: float | None
+
+
+class TemplateMatchingJobShardOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    shard_index: int
+    document_template_ids: list[int]
+    state: JobState
+    attempts: int
+    worker_id: str | None
+    started_at: datetime | None
+    finished_at: datetime | None
+    # Of the last attempt, also set while a failed shard waits to be retried
+    error: str | None
+
+
 class TemplateMatchingJobTempLateResults(BaseModel):
     template_id: int
     sample_results: list[SampleResult] | list[ExtendedSampleResult]
@@ -40,3 +94,34 @@ class TemplateMatchingJobTempLateResults(BaseModel):
 class TemplateMatchingJobResults(BaseModel):
     results_per_template: list[TemplateMatchingJobTempLateResults]
     total_run_time: int
+
+
+class ScoreHistogram(BaseModel):
+    # `counts[i]` sample results scored in [bin_edges[i], bin_edges[i + 1]), the last bin includes its upper edge
+    bin_edges: list[float]
+    counts: list[int]
+
+
+class ScorePercentile(BaseModel):
+    percentile: float
+    # None without any sample results
+    score: float | None
+
+
+class ScoreStats(BaseModel):
+    count: int
+    min_score: float | None
+    max_score: float | None
+    mean_score: float | None
+    percentiles: list[ScorePercentile]
+    histogram: ScoreHistogram
+
+
+class TemplateResultStats(ScoreStats):
+    template_id: int
+
+
+class TemplateMatchingJobResultStats(ScoreStats):
+    count_per_file_type: dict[FileType, int]
+    count_per_day: dict[date, int]
+    per_template: list[TemplateResultStats]
@@ -0,0 +1,21 @@
+from datetime import datetime
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class TemplateUploadIn(BaseModel):
+    name: str
+    template_filename: str
+    template_file_type: str
+    total_size: int = Field(gt=0)
+    # Replace the file of this template instead of creating a new one
+    template_id: int | None = None
+
+
+class TemplateUploadOut(TemplateUploadIn):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: str
+    offset: int
+    created_at: datetime
+    expires_at: datetime
@@ -1,11 +1,15 @@
 from datetime import datetime
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field
 from template_matching_api.api_models.data_specification import DataSpecification
 
 
 class WorkspaceBase(BaseModel):
     name: str
     data_specification: DataSpecification
+    # Jobs of the workspace running at the same time, unlimited if None
+    max_concurrent_jobs: int | None = Field(default=None, ge=1)
+    # Share of the job workers while several workspaces have jobs waiting, relative to other workspaces
+    job_weight: float = Field(default=1.0, gt=0)
 
 class WorkspaceIn(WorkspaceBase):
     pass
@@ -20,3 +24,6 @@ class WorkspaceOut(WorkspaceBase):
 class WorkspaceUpdate(BaseModel):
     name: str | None = None
     data_specification: DataSpecification | None = None
+    # Explicitly set to None to remove the limit
+    max_concurrent_jobs: int | None = Field(default=None, ge=1)
+    job_weight: float | None = Field(default=None, gt=0)
@@ -1,22 +1,112 @@
-import os
+import threading
 from contextlib import contextmanager
-from pathlib import Path
-from typing import Generator
+from typing import Any, Generator
 
-from sqlalchemy import create_engine, Engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, event, make_url, Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from sqlalchemy.orm import ORMExecuteState, UOWTransaction, sessionmaker, Session
 
-DB_STORAGE_LOCATION = (
-    Path(os.path.realpath(__file__)).parents[1] / "storage/matching_api.db"
+from template_matching_api.settings import Settings, get_settings
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
 )
 
 
-def get_db() -> Engine:
-    return create_engine(
-        f"sqlite+pysqlite:///{DB_STORAGE_LOCATION}",
-        echo=True,
+
+class ReadOnlySessionError(Exception):
+    pass
+
+
+_engine: Engine | None = None
+_async_engine: AsyncEngine | None = None
+_engine_lock = threading.Lock()
+
+
+def _is_in_memory_sqlite(db_url: str) -> bool:
+    url = make_url(db_url)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def _install_sqlite_pragmas(engine: Engine, settings: Settings) -> None:
+    pragmas = (
+        *SQLITE_PRAGMAS,
+        f"PRAGMA mmap_size={settings.sqlite_mmap_size}",
+        f"PRAGMA busy_timeout={settings.sqlite_busy_timeout_ms}",
     )
 
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection: Any, _connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in pragmas:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def _engine_kwargs(db_url: str, settings: Settings) -> dict[str, Any]:
+    engine_kwargs: dict[str, Any] = {
+        "echo": settings.db_echo,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+    if not _is_in_memory_sqlite(db_url):
+        engine_kwargs |= {
+            "pool_size": settings.db_pool_size,
+            "max_overflow": settings.db_max_overflow,
+            "pool_recycle": settings.db_pool_recycle_seconds,
+        }
+    return engine_kwargs
+
+
+def create_db_engine(settings: Settings) -> Engine:
+    engine = create_engine(settings.db_url, **_engine_kwargs(settings.db_url, settings))
+    if engine.dialect.name == "sqlite":
+        _install_sqlite_pragmas(engine, settings)
+    return engine
+
+
+def create_async_db_engine(settings: Settings) -> AsyncEngine:
+    db_url = settings.get_async_db_url()
+    engine = create_async_engine(db_url, **_engine_kwargs(db_url, settings))
+    if engine.dialect.name == "sqlite":
+        _install_sqlite_pragmas(engine.sync_engine, settings)
+    return engine
+
+
+def get_db() -> Engine:
+    # One engine (and therefore one connection pool) per process, shared by every request
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_db_engine(get_settings())
+        return _engine
+
+
+def get_async_db() -> AsyncEngine:
+    global _async_engine
+    with _engine_lock:
+        if _async_engine is None:
+            _async_engine = create_async_db_engine(get_settings())
+        return _async_engine
+
+
+def dispose_db() -> None:
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+
+async def dispose_async_db() -> None:
+    global _async_engine
+    with _engine_lock:
+        async_engine, _async_engine = _async_engine, None
+    if async_engine is not None:
+        await async_engine.dispose()
+
 
 @contextmanager
 def session_scope(session_maker: sessionmaker[Session]) -> Generator[Session, None, None]:
@@ -29,3 +119,18 @@ def session_scope(session_maker: sessionmaker[Session]) -> Generator[Session, No
         raise
     finally:
         session.close()
+
+
+def _refuse_writing_statements(orm_execute_state: ORMExecuteState) -> None:
+    if not orm_execute_state.is_select:
+        raise ReadOnlySessionError(f"Read-only session cannot execute {orm_execute_state.statement}")
+
+
+def _refuse_flush(_session: Session, _flush_context: UOWTransaction, _instances: object) -> None:
+    raise ReadOnlySessionError("Read-only session cannot flush changes")
+
+
+def make_read_only(session: Session) -> None:
+    """Raise `ReadOnlySessionError` on any statement other than a SELECT and on flushing changes, committing included"""
+    event.listen(session, "do_orm_execute", _refuse_writing_statements)
+    event.listen(session, "before_flush", _refuse_flush)
@@ -1,7 +1,7 @@
 from typing import Any
 from datetime import datetime
 
-from sqlalchemy import Integer, String, DateTime, ForeignKey, func, JSON
+from sqlalchemy import BigInteger, Float, Integer, String, DateTime, ForeignKey, func, JSON
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.orm import relationship, DeclarativeBase, Mapped, mapped_column
 
@@ -17,6 +17,8 @@ class DocumentTemplate(Base):
     name: Mapped[str] = mapped_column(String, nullable=False)
     template_filename: Mapped[str] = mapped_column(String, nullable=False)
     template_file_type: Mapped[str] = mapped_column(String, nullable=False)
+    template_sha256: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    template_size: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
     uploaded_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), nullable=False
     )
@@ -42,12 +44,36 @@ class DocumentTemplate(Base):
     )
 
 
+class TemplateUpload(Base):
+    """Resumable upload of a template file, staged in the template storage until it is finalized"""
+
+    __tablename__ = "template_uploads"
+
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    name: Mapped[str] = mapped_column(String, nullable=False)
+    template_filename: Mapped[str] = mapped_column(String, nullable=False)
+    template_file_type: Mapped[str] = mapped_column(String, nullable=False)
+    # Existing template whose file is replaced on finalization, a new template is created otherwise
+    template_id: Mapped[int | None] = mapped_column(
+        ForeignKey("document_templates.id", ondelete="CASCADE"), nullable=True
+    )
+    total_size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    offset: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False, index=True)
+
+
 class Workspace(Base):
     __tablename__ = "workspaces"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     name: Mapped[str] = mapped_column(String, nullable=False)
     data_specification: Mapped[dict[str, Any]] = mapped_column(JSON, nullable=False)
+    # Scheduling of the workspace's jobs, see `jobs.scheduler`
+    max_concurrent_jobs: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    job_weight: Mapped[float] = mapped_column(Float, nullable=False, default=1.0, server_default="1.0")
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), nullable=False, server_default=func.now()
     )
@@ -65,8 +91,32 @@ class TemplateMatchingJob(Base):
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), nullable=False, server_default=func.now()
     )
-    job_state: Mapped[str | None] = mapped_column(String, nullable=True)
+    job_state: Mapped[str | None] = mapped_column(String, nullable=True, index=True)
+    # Id of the current run, every (re)submission starts a new one
     job_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    submitted_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    started_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    # Worker running the job, and when it last reported being alive
+    worker_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
+    # Submitted jobs of a workspace with a higher priority run first
+    priority: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # Runs taking longer fail, the `job_timeout_seconds` setting applies if None
+    timeout_seconds: Mapped[float | None] = mapped_column(Float, nullable=True)
+    # Hash of the templates and data specification the job ran with, see `jobs.memoization`
+    input_hash: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)
+    # Earlier job whose results were reused for the current run
+    memoized_from_id: Mapped[int | None] = mapped_column(
+        ForeignKey("template_matching_jobs.id", ondelete="SET NULL"), nullable=True
+    )
+    # Work done by the last run, templates whose results of an earlier run were reused are not computed again
+    templates_computed: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    templates_reused: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # Run time of the reused results, i.e. the run time saved
+    reused_run_time: Mapped[int | None] = mapped_column(Integer, nullable=True)
 
     template_matching_job_templates: Mapped[list["TemplateMatchingJobTemplate"]] = (
         relationship(
@@ -130,3 +180,24 @@ class TemplateMatchingJobTemplate(Base):
         back_populates="template_matching_job_templates",
         viewonly=True,
     )
+
+
+class TemplateMatchingJobShard(Base):
+    """Part of the templates of a job run, shards of a run are computed in parallel by the job workers"""
+    __tablename__ = "template_matching_job_shards"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    template_matching_job_id: Mapped[int] = mapped_column(
+        ForeignKey("template_matching_jobs.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    # `job_id` of the run the shard belongs to
+    run_id: Mapped[str] = mapped_column(String, nullable=False)
+    shard_index: Mapped[int] = mapped_column(Integer, nullable=False)
+    document_template_ids: Mapped[list[int]] = mapped_column(JSON, nullable=False)
+    state: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    worker_id: Mapped[str | None] = mapped_column(String, nullable=True)
+    heartbeat_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    started_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    error: Mapped[str | None] = mapped_column(String, nullable=True)
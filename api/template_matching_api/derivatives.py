@@ -0,0 +1,151 @@
+"""Files derived from template images: thumbnails for the GUI and grayscale arrays for matching.
+
+They are generated in a process pool (decoding and resizing is CPU bound and would hold the GIL) and stored next to
+the original via `TemplateStorage.save_derivative`, keyed by the sha256 of the original they were made of. Workers
+open the stored file themselves, the API process never reads it into memory, and uploads of other file types are
+skipped.
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+from typing import IO, Any
+
+import numpy as np
+import numpy.typing as npt
+from PIL import Image, ImageOps
+
+from template_matching_api.file_storage import AsyncDocumentTemplateStorage
+from template_matching_api.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+THUMBNAIL_MEDIA_TYPE = "image/webp"
+# Full resolution float32 luminance in [0, 1]
+GRAYSCALE_NAME = "grayscale.npy"
+# `level_<n>` arrays, each half the size of the previous one, `level_0` being the grayscale image itself
+PYRAMID_NAME = "pyramid.npz"
+PYRAMID_MIN_SIDE = 16
+# Version of derivatives of templates uploaded before their sha256 was recorded
+UNVERSIONED = "unversioned"
+
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = threading.Lock()
+
+
+class UnsupportedImageError(Exception):
+    pass
+
+
+def is_image_file_type(file_type: str | None) -> bool:
+    """Whether derivatives are generated for uploads of the content type, files of unknown type are tried"""
+    return file_type is None or file_type.partition("/")[0] == "image" or file_type == "application/octet-stream"
+
+
+def thumbnail_name(size: int) -> str:
+    return f"thumbnail-{size}.webp"
+
+
+def closest_thumbnail_size(size: int) -> int:
+    """Smallest generated thumbnail at least `size` pixels wide and tall, the largest one for bigger sizes"""
+    return next((thumbnail_size for thumbnail_size in THUMBNAIL_SIZES if thumbnail_size >= size), THUMBNAIL_SIZES[-1])
+
+
+def _downscale(level: npt.NDArray[np.float32]) -> npt.NDArray[np.float32]:
+    # 2x2 box filter, an odd last row/column is dropped
+    height, width = level.shape[0] // 2 * 2, level.shape[1] // 2 * 2
+    blocks = level[:height, :width].reshape(height // 2, 2, width // 2, 2)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def build_pyramid(grayscale: npt.NDArray[np.float32]) -> list[npt.NDArray[np.float32]]:
+    levels = [grayscale]
+    while min(levels[-1].shape) // 2 >= PYRAMID_MIN_SIDE:
+        levels.append(_downscale(levels[-1]))
+    return levels
+
+
+def generate_derivatives(image_file: bytes | Path | IO[bytes]) -> dict[str, bytes]:
+    """Decode the template image and render all derivatives, runs in a worker process.
+
+    Raises `UnsupportedImageError` if the file is not an image Pillow can decode, which is told by its header before
+    anything else is read.
+    """
+    try:
+        decoded = Image.open(io.BytesIO(image_file) if isinstance(image_file, bytes) else image_file)
+        decoded.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise UnsupportedImageError(str(e)) from e
+    image = ImageOps.exif_transpose(decoded)
+
+    derivatives = {}
+    preview = image if image.mode in ("RGB", "RGBA", "L", "LA") else image.convert("RGBA")
+    for size in THUMBNAIL_SIZES:
+        thumbnail = preview.copy()
+        thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format="WEBP", quality=80)
+        derivatives[thumbnail_name(size)] = buffer.getvalue()
+
+    grayscale = np.asarray(image.convert("L"), dtype=np.float32) / np.float32(255)
+    buffer = io.BytesIO()
+    np.save(buffer, grayscale)
+    derivatives[GRAYSCALE_NAME] = buffer.getvalue()
+    buffer = io.BytesIO()
+    levels: dict[str, Any] = {f"level_{idx}": level for idx, level in enumerate(build_pyramid(grayscale))}
+    np.savez(buffer, **levels)
+    derivatives[PYRAMID_NAME] = buffer.getvalue()
+    return derivatives
+
+
+async def store_derivatives(
+    template_storage: AsyncDocumentTemplateStorage, executor: Executor, template_id: int, version: str
+) -> dict[str, bytes]:
+    # Only storage without local files has the file loaded and sent to the worker
+    image_file = template_storage.local_path(template_id) or await template_storage.load(template_id)
+    derivatives = await asyncio.get_running_loop().run_in_executor(executor, generate_derivatives, image_file)
+    for name, derivative_bytes in derivatives.items():
+        await template_storage.save_derivative(template_id, version, name, derivative_bytes)
+    return derivatives
+
+
+async def store_derivatives_in_background(
+    template_storage: AsyncDocumentTemplateStorage,
+    executor: Executor,
+    template_id: int,
+    version: str,
+    file_type: str | None,
+) -> None:
+    # Runs after the upload response was sent, missing derivatives are regenerated when they are requested
+    if not is_image_file_type(file_type):
+        logger.info("Template %s is a %s file, no derivatives generated", template_id, file_type)
+        return
+    try:
+        await store_derivatives(template_storage, executor, template_id, version)
+    except UnsupportedImageError:
+        logger.info("Template %s is not a supported image, no derivatives generated", template_id)
+    except Exception:
+        logger.exception("Generating derivatives of template %s failed", template_id)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Workers are spawned rather than forked from the (multithreaded) server process
+            _process_pool = ProcessPoolExecutor(
+                max_workers=get_settings().derivative_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is not None:
+            _process_pool.shutdown(cancel_futures=True)
+            _process_pool = None
@@ -1,25 +1,770 @@
+import errno
+import fcntl
+import hashlib
 import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
 from pathlib import Path
+from typing import AsyncIterable, AsyncIterator, Generator, Iterable, Iterator, Protocol
 
-STORAGE_LOCATION = Path(os.path.realpath(__file__)).parents[1] / "storage"
+import anyio.from_thread
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import sessionmaker, Session
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from template_matching_api.db import get_db, session_scope
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.settings import STORAGE_LOCATION, Settings
+
+READ_CHUNK_SIZE = 64 * 1024
+# Blobs installed this recently are kept, the rows referencing them may not be committed yet
+BLOB_GRACE_PERIOD = timedelta(hours=1)
+
+
+class TemplateTooLargeError(Exception):
+    def __init__(self, max_size: int) -> None:
+        super().__init__(f"Template file exceeds the maximum size of {max_size} bytes")
+        self.max_size = max_size
+
+
+class UploadInProgressError(Exception):
+    def __init__(self, upload_id: str) -> None:
+        super().__init__(f"Another chunk of upload {upload_id} is being written")
+        self.upload_id = upload_id
+
+
+@dataclass(frozen=True)
+class StoredTemplate:
+    sha256: str
+    size: int
+
+
+class TemplateDigest:
+    """Running sha256 and byte count of a template file written chunk by chunk"""
+
+    def __init__(self, max_size: int | None = None) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def update(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise TemplateTooLargeError(self.max_size)
+        self._hash.update(chunk)
+
+    def result(self) -> StoredTemplate:
+        return StoredTemplate(sha256=self._hash.hexdigest(), size=self.size)
+
+
+class TemplateStorage(Protocol):
+    """Blocking storage backend keyed by template id"""
+
+    def save(self, template_id: int, file_bytes: bytes) -> None: ...
+
+    def save_stream(
+        self, template_id: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> StoredTemplate: ...
+
+    def load(self, template_id: int) -> bytes: ...
+
+    def size(self, template_id: int) -> int: ...
+
+    def iter_range(
+        self, template_id: int, start: int = 0, end: int | None = None, chunk_size: int = READ_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        """Yield the bytes in [start, end) of the template file, `end=None` meaning the end of the file"""
+        ...
+
+    def local_path(self, template_id: int) -> Path | None:
+        """Path of the template file when the backend is a local filesystem, so that it can be served zero-copy"""
+        ...
+
+    def delete(self, template_id: int) -> None: ...
+
+    def save_derivative(self, template_id: int, version: str, name: str, file_bytes: bytes) -> None:
+        """Store a file derived from the template (e.g. a thumbnail), `version` identifies the original it was made of.
+
+        Derivatives are dropped together with the original when it is replaced or deleted.
+        """
+        ...
+
+    def load_derivative(self, template_id: int, version: str, name: str) -> bytes:
+        """Raises `FileNotFoundError` if the derivative was not generated (yet)"""
+        ...
+
+    def write_upload_chunk(
+        self, upload_id: str, offset: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> int:
+        """Write the chunks at `offset` of the staged file of a resumable upload, returns the number of bytes written.
+
+        Only returns once the bytes are durable. Raises `UploadInProgressError` if another chunk is being written.
+        """
+        ...
+
+    def finalize_upload(self, upload_id: str, template_id: int, size: int) -> StoredTemplate:
+        """Turn the first `size` bytes of the staged file into the template file, without copying it"""
+        ...
+
+    def delete_upload(self, upload_id: str) -> None: ...
 
 
 class DocumentTemplateStorage:
-    def __init__(self) -> None:
+    def __init__(self, root: Path | None = None) -> None:
         # This is just to mimic storage like it would be on s3, where you just store bytes, so keeping the filename and file type in storage is not possible
-        self.file_location = STORAGE_LOCATION / "templates"
+        self.file_location = (root or STORAGE_LOCATION) / "templates"
+        # Numeric `templates/<id>` directories are the legacy flat layout, they are read until they are migrated
+        self.sharded_location = self.file_location / "shards"
         self.file_name = "template_file"
+        # Staged files of resumable uploads, on the same filesystem so that they can be renamed into place
+        self.upload_location = (root or STORAGE_LOCATION) / "uploads"
 
     def _get_location_for_template(self, template_id: int) -> Path:
+        """Two levels of 256 buckets derived from a hash of the id, e.g. `templates/shards/3f/a2/<id>/template_file`"""
+        bucket = hashlib.blake2b(str(template_id).encode(), digest_size=2).hexdigest()
+        return self.sharded_location / bucket[:2] / bucket[2:] / str(template_id) / self.file_name
+
+    def _get_legacy_location_for_template(self, template_id: int) -> Path:
         return self.file_location / str(template_id) / self.file_name
 
+    def _find_location_for_template(self, template_id: int) -> Path:
+        """Location to read the template from, falling back to the legacy layout while it is not migrated"""
+        location = self._get_location_for_template(template_id)
+        if os.path.lexists(location):
+            return location
+        legacy_location = self._get_legacy_location_for_template(template_id)
+        if os.path.lexists(legacy_location):
+            return legacy_location
+        # Either missing, or moved by the migration in between both checks
+        return location
+
+    def _get_derivatives_location(self, template_location: Path) -> Path:
+        return template_location.parent / "derivatives"
+
+    def _remove_legacy_template(self, template_id: int) -> None:
+        legacy_location = self._get_legacy_location_for_template(template_id)
+        legacy_location.unlink(missing_ok=True)
+        shutil.rmtree(self._get_derivatives_location(legacy_location), ignore_errors=True)
+        try:
+            legacy_location.parent.rmdir()
+        except OSError:
+            pass
+
     def save(self, template_id: int, file_bytes: bytes) -> None:
-        template_location=self._get_location_for_template(template_id)
+        self.save_stream(template_id, [file_bytes])
+
+    def save_stream(
+        self, template_id: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> StoredTemplate:
+        """Write the chunks to a temporary file next to the template and atomically rename it into place.
+
+        Readers either see the previous file or the complete new one, never a partially written template.
+        """
+        template_location = self._get_location_for_template(template_id)
         os.makedirs(os.path.dirname(template_location), exist_ok=True)
-        template_location.write_bytes(file_bytes)
+        digest = TemplateDigest(max_size)
+        fd, tmp_name = tempfile.mkstemp(dir=template_location.parent, prefix=f".{self.file_name}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_name, template_location)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        self._remove_stale_files(template_id, template_location)
+        return digest.result()
+
+    def _remove_stale_files(self, template_id: int, template_location: Path) -> None:
+        # Derivatives of the previous file and the copy in the legacy layout
+        shutil.rmtree(self._get_derivatives_location(template_location), ignore_errors=True)
+        self._remove_legacy_template(template_id)
+
+    def load(self, template_id: int) -> bytes:
+        return self._find_location_for_template(template_id).read_bytes()
+
+    def size(self, template_id: int) -> int:
+        return self._find_location_for_template(template_id).stat().st_size
+
+    def iter_range(
+        self, template_id: int, start: int = 0, end: int | None = None, chunk_size: int = READ_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        with self._find_location_for_template(template_id).open("rb") as template_file:
+            template_file.seek(start)
+            remaining = end - start if end is not None else None
+            while remaining is None or remaining > 0:
+                chunk = template_file.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def local_path(self, template_id: int) -> Path | None:
+        return self._find_location_for_template(template_id)
+
+    def delete(self, template_id: int) -> None:
+        template_location = self._find_location_for_template(template_id)
+        template_location.unlink()
+        shutil.rmtree(self._get_derivatives_location(template_location), ignore_errors=True)
+
+    def save_derivative(self, template_id: int, version: str, name: str, file_bytes: bytes) -> None:
+        # Next to the original, wherever it currently is, so that the layout migration moves them along
+        derivative_location = (
+            self._get_derivatives_location(self._find_location_for_template(template_id)) / version / name
+        )
+        os.makedirs(derivative_location.parent, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=derivative_location.parent, prefix=f".{name}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(file_bytes)
+            os.replace(tmp_name, derivative_location)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def load_derivative(self, template_id: int, version: str, name: str) -> bytes:
+        template_location = self._find_location_for_template(template_id)
+        return (self._get_derivatives_location(template_location) / version / name).read_bytes()
+
+    def _get_location_for_upload(self, upload_id: str) -> Path:
+        return self.upload_location / upload_id
+
+    def write_upload_chunk(
+        self, upload_id: str, offset: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> int:
+        os.makedirs(self.upload_location, exist_ok=True)
+        fd = os.open(self._get_location_for_upload(upload_id), os.O_WRONLY | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "wb") as upload_file:
+            try:
+                fcntl.flock(upload_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadInProgressError(upload_id)
+            # Written at the offset rather than appended, so that a chunk retried after a lost response is idempotent
+            upload_file.seek(offset)
+            written = 0
+            for chunk in chunks:
+                written += len(chunk)
+                if max_size is not None and written > max_size:
+                    raise TemplateTooLargeError(max_size)
+                upload_file.write(chunk)
+            upload_file.flush()
+            os.fsync(upload_file.fileno())
+        return written
+
+    def _digest_upload(self, upload_id: str, size: int) -> StoredTemplate:
+        digest = TemplateDigest()
+        with open(self._get_location_for_upload(upload_id), "r+b") as upload_file:
+            # Drops bytes of chunks which failed half way past the acknowledged end
+            upload_file.truncate(size)
+            while chunk := upload_file.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.result()
+
+    def finalize_upload(self, upload_id: str, template_id: int, size: int) -> StoredTemplate:
+        stored = self._digest_upload(upload_id, size)
+        template_location = self._get_location_for_template(template_id)
+        os.makedirs(template_location.parent, exist_ok=True)
+        os.replace(self._get_location_for_upload(upload_id), template_location)
+        self._remove_stale_files(template_id, template_location)
+        return stored
+
+    def delete_upload(self, upload_id: str) -> None:
+        self._get_location_for_upload(upload_id).unlink(missing_ok=True)
+
+    def iter_legacy_template_ids(self) -> Iterator[int]:
+        try:
+            entries = os.scandir(self.file_location)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.name.isdigit() and entry.is_dir(follow_symlinks=False):
+                    yield int(entry.name)
+
+    def migrate_template(self, template_id: int) -> bool:
+        """Move a template from the legacy layout into its bucket with a single atomic directory rename.
+
+        Safe to run while the API is serving, returns False if the template is not in the legacy layout (anymore).
+        """
+        legacy_location = self._get_legacy_location_for_template(template_id)
+        location = self._get_location_for_template(template_id)
+        os.makedirs(location.parent.parent, exist_ok=True)
+        try:
+            os.rename(legacy_location.parent, location.parent)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+            # Re-uploaded into the new layout in the meantime, the legacy copy is stale
+            self._remove_legacy_template(template_id)
+        return True
+
+    def migrate_legacy_layout(self) -> int:
+        """Migrate every template still stored in the legacy layout, returns the number of migrated templates.
+
+        The directory is scanned while entries are being renamed out of it, which may skip some of them, so passes are
+        repeated until one finds nothing left to migrate.
+        """
+        migrated = 0
+        while migrated_in_pass := sum(
+            self.migrate_template(template_id) for template_id in self.iter_legacy_template_ids()
+        ):
+            migrated += migrated_in_pass
+        return migrated
+
+
+class ContentAddressedTemplateStorage(DocumentTemplateStorage):
+    """Deduplicating storage, every distinct template file is stored once as a blob keyed by its sha256.
+
+    Layout under `root`:
+        blobs/ab/cd/<sha256>                  the file content
+        templates/<id>/template_file          symlink to the blob, so reads work exactly as in the local storage
+
+    Blobs are referenced by the `template_sha256` of DocumentTemplate rows, which are counted in the DB when a template
+    is deleted or re-uploaded, so the references cannot disagree with the templates after a crash. A blob is removed
+    once no other template references it, unless it was installed within `blob_grace_period`: the row of a template
+    is committed after its file is stored. Blobs kept meanwhile are removed by `collect_garbage`, without a
+    `session_maker` blobs are never removed. Blob creation and removal are serialized by an flock per shard directory,
+    so they are safe across threads and worker processes. Regular template files written by the local storage are
+    read as they are, and imported into a blob when they are migrated.
+    """
+
+    def __init__(
+        self,
+        root: Path | None = None,
+        session_maker: sessionmaker[Session] | None = None,
+        blob_grace_period: timedelta = BLOB_GRACE_PERIOD,
+    ) -> None:
+        super().__init__(root)
+        self.blob_location = (root or STORAGE_LOCATION) / "blobs"
+        self.incoming_location = self.blob_location / ".incoming"
+        self.session_maker = session_maker
+        self.blob_grace_period = blob_grace_period
+
+    def _get_location_for_blob(self, sha256: str) -> Path:
+        return self.blob_location / sha256[:2] / sha256[2:4] / sha256
+
+    @contextmanager
+    def _lock_shard(self, blob_location: Path) -> Generator[None, None, None]:
+        os.makedirs(blob_location.parent, exist_ok=True)
+        with open(blob_location.parent / ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _linked_blob_sha256(template_location: Path) -> str | None:
+        """Blob the template links to, None if it is missing or a regular file written by the local storage"""
+        try:
+            return Path(os.readlink(template_location)).name
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            return None
+
+    def _import_template_file(self, template_id: int, template_location: Path) -> str:
+        """Move a regular template file into its blob and replace it by a link to it, returns the blob's sha256"""
+        digest = TemplateDigest()
+        with open(template_location, "rb") as template_file:
+            while chunk := template_file.read(1024 * 1024):
+                digest.update(chunk)
+        stored = digest.result()
+        os.makedirs(self.incoming_location, exist_ok=True)
+        tmp_name = str(self.incoming_location / uuid.uuid4().hex)
+        # A second link rather than a move, the template stays readable until the link to the blob replaces it
+        try:
+            os.link(template_location, tmp_name)
+        except OSError:
+            shutil.copyfile(template_location, tmp_name)
+        try:
+            self._store_blob(stored.sha256, tmp_name)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+        self._link_template(template_location, self._get_location_for_blob(stored.sha256))
+        if self.session_maker is not None:
+            # Templates uploaded before their content hash was recorded reference the blob from now on
+            with session_scope(self.session_maker) as session:
+                session.execute(
+                    update(DocumentTemplate)
+                    .where(DocumentTemplate.id == template_id, DocumentTemplate.template_sha256.is_(None))
+                    .values(template_sha256=stored.sha256, template_size=stored.size)
+                )
+        return stored.sha256
+
+    def save_stream(
+        self, template_id: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> StoredTemplate:
+        os.makedirs(self.incoming_location, exist_ok=True)
+        digest = TemplateDigest(max_size)
+        fd, tmp_name = tempfile.mkstemp(dir=self.incoming_location)
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        return self._install_blob(template_id, tmp_name, digest.result())
+
+    def finalize_upload(self, upload_id: str, template_id: int, size: int) -> StoredTemplate:
+        stored = self._digest_upload(upload_id, size)
+        return self._install_blob(template_id, str(self._get_location_for_upload(upload_id)), stored)
+
+    def _install_blob(self, template_id: int, tmp_name: str, stored: StoredTemplate) -> StoredTemplate:
+        """Move the file into its blob (or drop it if the blob exists) and point the template at it"""
+        try:
+            previous_sha256 = self._linked_blob_sha256(self._find_location_for_template(template_id))
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        try:
+            self._store_blob(stored.sha256, tmp_name)
+        finally:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+
+        template_location = self._get_location_for_template(template_id)
+        self._link_template(template_location, self._get_location_for_blob(stored.sha256))
+        self._remove_stale_files(template_id, template_location)
+        if previous_sha256 is not None and previous_sha256 != stored.sha256:
+            self._release_blob(previous_sha256, template_id)
+        return stored
+
+    def _store_blob(self, sha256: str, tmp_name: str) -> None:
+        blob_location = self._get_location_for_blob(sha256)
+        with self._lock_shard(blob_location):
+            if blob_location.exists():
+                # Identical bytes are already stored, the incoming copy is dropped without rewriting the blob. Its grace
+                # period starts again, the template's row referencing it may not be committed yet
+                os.utime(blob_location)
+                return
+            with open(tmp_name, "rb") as tmp_file:
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_name, 0o444)
+            os.replace(tmp_name, blob_location)
+
+    def _count_references(self, session_maker: sessionmaker[Session], sha256: str, template_id: int | None) -> int:
+        """Templates other than `template_id` referencing the blob"""
+        with session_maker() as session:
+            return session.scalar(
+                select(func.count())
+                .select_from(DocumentTemplate)
+                .where(
+                    DocumentTemplate.template_sha256 == sha256,
+                    *((DocumentTemplate.id != template_id,) if template_id is not None else ()),
+                )
+            ) or 0
+
+    def _release_blob(self, sha256: str, template_id: int | None = None) -> bool:
+        """Remove the blob unless a template other than `template_id` references it, returns whether it was removed"""
+        if self.session_maker is None:
+            return False
+        blob_location = self._get_location_for_blob(sha256)
+        with self._lock_shard(blob_location):
+            try:
+                installed_at = blob_location.stat().st_mtime
+            except FileNotFoundError:
+                return False
+            if installed_at > time.time() - self.blob_grace_period.total_seconds():
+                return False
+            if self._count_references(self.session_maker, sha256, template_id):
+                return False
+            blob_location.unlink()
+            return True
+
+    def _link_template(self, template_location: Path, blob_location: Path) -> None:
+        os.makedirs(template_location.parent, exist_ok=True)
+        tmp_link = template_location.with_name(f".{self.file_name}.{uuid.uuid4().hex}")
+        tmp_link.symlink_to(os.path.relpath(blob_location, template_location.parent))
+        os.replace(tmp_link, template_location)
+
+    def delete(self, template_id: int) -> None:
+        template_location = self._find_location_for_template(template_id)
+        sha256 = self._linked_blob_sha256(template_location)
+        template_location.unlink()
+        shutil.rmtree(self._get_derivatives_location(template_location), ignore_errors=True)
+        if sha256 is not None:
+            self._release_blob(sha256, template_id)
+
+    def migrate_template(self, template_id: int) -> bool:
+        # Links are relative to their directory, so they are recreated in the bucket instead of moved there
+        legacy_location = self._get_legacy_location_for_template(template_id)
+        if not os.path.lexists(legacy_location):
+            return False
+        try:
+            sha256 = self._linked_blob_sha256(legacy_location) or self._import_template_file(
+                template_id, legacy_location
+            )
+        except FileNotFoundError:
+            return False
+        location = self._get_location_for_template(template_id)
+        os.makedirs(location.parent, exist_ok=True)
+        try:
+            location.symlink_to(os.path.relpath(self._get_location_for_blob(sha256), location.parent))
+        except FileExistsError:
+            # Re-uploaded into the new layout in the meantime
+            pass
+        try:
+            os.rename(self._get_derivatives_location(legacy_location), self._get_derivatives_location(location))
+        except OSError:
+            # None generated yet, or stale next to a re-uploaded template, they are regenerated when needed
+            pass
+        self._remove_legacy_template(template_id)
+        return True
+
+    def collect_garbage(self) -> int:
+        """Remove blobs no template references, e.g. kept by their grace period or a crash, returns how many"""
+        removed = 0
+        for blob_location in self.blob_location.glob("??/??/*"):
+            if blob_location.name.endswith(".refs"):
+                # Reference markers of earlier versions, references are counted in the DB now
+                shutil.rmtree(blob_location, ignore_errors=True)
+            elif not blob_location.name.startswith(".") and self._release_blob(blob_location.name):
+                removed += 1
+        return removed
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size_bytes: int
+    max_bytes: int
+
+
+class CachedTemplateStorage:
+    """In-process LRU cache of template files in front of any `TemplateStorage`, bounded by total bytes.
+
+    Files larger than `max_bytes` are never cached. Local filesystem backends keep serving downloads zero-copy through
+    `local_path`, the cache then only serves `load`, e.g. for the matching engine.
+    """
+
+    def __init__(self, storage: TemplateStorage, max_bytes: int) -> None:
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[int, bytes] = OrderedDict()
+        self._size_bytes = 0
+        # Bumped on every invalidation, a load racing with a save/delete must not cache the bytes it read
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, template_id: int) -> bytes | None:
+        with self._lock:
+            file_bytes = self._entries.get(template_id)
+            if file_bytes is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(template_id)
+            self.hits += 1
+            return file_bytes
+
+    def _put(self, template_id: int, file_bytes: bytes, epoch: int) -> None:
+        if len(file_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            if epoch != self._epoch or template_id in self._entries:
+                return
+            self._entries[template_id] = file_bytes
+            self._size_bytes += len(file_bytes)
+            while self._size_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, template_id: int) -> None:
+        with self._lock:
+            self._epoch += 1
+            file_bytes = self._entries.pop(template_id, None)
+            if file_bytes is not None:
+                self._size_bytes -= len(file_bytes)
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                size_bytes=self._size_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def save(self, template_id: int, file_bytes: bytes) -> None:
+        self.invalidate(template_id)
+        self.storage.save(template_id, file_bytes)
+        self.invalidate(template_id)
+
+    def save_stream(
+        self, template_id: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> StoredTemplate:
+        self.invalidate(template_id)
+        try:
+            return self.storage.save_stream(template_id, chunks, max_size)
+        finally:
+            self.invalidate(template_id)
 
     def load(self, template_id: int) -> bytes:
-        return self._get_location_for_template(template_id).read_bytes()
+        file_bytes = self._get(template_id)
+        if file_bytes is not None:
+            return file_bytes
+        epoch = self._epoch
+        file_bytes = self.storage.load(template_id)
+        self._put(template_id, file_bytes, epoch)
+        return file_bytes
+
+    def size(self, template_id: int) -> int:
+        with self._lock:
+            file_bytes = self._entries.get(template_id)
+        if file_bytes is not None:
+            return len(file_bytes)
+        return self.storage.size(template_id)
+
+    def iter_range(
+        self, template_id: int, start: int = 0, end: int | None = None, chunk_size: int = READ_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        file_bytes = self._get(template_id)
+        if file_bytes is None and self.storage.size(template_id) <= self.max_bytes:
+            epoch = self._epoch
+            file_bytes = self.storage.load(template_id)
+            self._put(template_id, file_bytes, epoch)
+        if file_bytes is None:
+            yield from self.storage.iter_range(template_id, start, end, chunk_size)
+            return
+        file_view = memoryview(file_bytes)[start:end]
+        for offset in range(0, len(file_view), chunk_size):
+            yield bytes(file_view[offset : offset + chunk_size])
+
+    def local_path(self, template_id: int) -> Path | None:
+        return self.storage.local_path(template_id)
 
     def delete(self, template_id: int) -> None:
-        self._get_location_for_template(template_id).unlink()
+        self.invalidate(template_id)
+        try:
+            self.storage.delete(template_id)
+        finally:
+            self.invalidate(template_id)
+
+    def save_derivative(self, template_id: int, version: str, name: str, file_bytes: bytes) -> None:
+        self.storage.save_derivative(template_id, version, name, file_bytes)
+
+    def load_derivative(self, template_id: int, version: str, name: str) -> bytes:
+        return self.storage.load_derivative(template_id, version, name)
+
+    def write_upload_chunk(
+        self, upload_id: str, offset: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> int:
+        return self.storage.write_upload_chunk(upload_id, offset, chunks, max_size)
+
+    def finalize_upload(self, upload_id: str, template_id: int, size: int) -> StoredTemplate:
+        self.invalidate(template_id)
+        try:
+            return self.storage.finalize_upload(upload_id, template_id, size)
+        finally:
+            self.invalidate(template_id)
+
+    def delete_upload(self, upload_id: str) -> None:
+        self.storage.delete_upload(upload_id)
+
+
+def create_template_backend(settings: Settings) -> DocumentTemplateStorage:
+    if settings.template_storage_backend == "content_addressed":
+        return ContentAddressedTemplateStorage(
+            root=settings.storage_location,
+            session_maker=sessionmaker(bind=get_db()),
+            blob_grace_period=timedelta(seconds=settings.template_blob_grace_period_seconds),
+        )
+    return DocumentTemplateStorage(root=settings.storage_location)
+
+
+def create_template_storage(settings: Settings) -> TemplateStorage:
+    storage: TemplateStorage = create_template_backend(settings)
+    if settings.template_cache_max_bytes > 0:
+        storage = CachedTemplateStorage(storage, settings.template_cache_max_bytes)
+    return storage
+
+
+class AsyncDocumentTemplateStorage:
+    """Async interface over any `TemplateStorage`.
+
+    Blocking backend calls are offloaded to the threadpool so that they never stall the event loop.
+    """
+
+    def __init__(self, storage: TemplateStorage) -> None:
+        self.storage = storage
+
+    async def save(self, template_id: int, file_bytes: bytes) -> None:
+        await run_in_threadpool(self.storage.save, template_id, file_bytes)
+
+    @staticmethod
+    def _blocking_chunks(chunks: AsyncIterable[bytes]) -> Iterator[bytes]:
+        # Pulls one chunk at a time from the event loop, so at most one chunk is held in memory
+        async_chunks = aiter(chunks)
+        while True:
+            try:
+                yield anyio.from_thread.run(anext, async_chunks)
+            except StopAsyncIteration:
+                return
+
+    async def save_stream(
+        self, template_id: int, chunks: AsyncIterable[bytes], max_size: int | None = None
+    ) -> StoredTemplate:
+        return await run_in_threadpool(self.storage.save_stream, template_id, self._blocking_chunks(chunks), max_size)
+
+    async def load(self, template_id: int) -> bytes:
+        return await run_in_threadpool(self.storage.load, template_id)
+
+    async def size(self, template_id: int) -> int:
+        return await run_in_threadpool(self.storage.size, template_id)
+
+    def iter_range(
+        self, template_id: int, start: int = 0, end: int | None = None, chunk_size: int = READ_CHUNK_SIZE
+    ) -> AsyncIterator[bytes]:
+        return iterate_in_threadpool(self.storage.iter_range(template_id, start, end, chunk_size))
+
+    def local_path(self, template_id: int) -> Path | None:
+        return self.storage.local_path(template_id)
+
+    async def delete(self, template_id: int) -> None:
+        await run_in_threadpool(self.storage.delete, template_id)
+
+    async def save_derivative(self, template_id: int, version: str, name: str, file_bytes: bytes) -> None:
+        await run_in_threadpool(self.storage.save_derivative, template_id, version, name, file_bytes)
+
+    async def load_derivative(self, template_id: int, version: str, name: str) -> bytes:
+        return await run_in_threadpool(self.storage.load_derivative, template_id, version, name)
+
+    async def write_upload_chunk(
+        self, upload_id: str, offset: int, chunks: AsyncIterable[bytes], max_size: int | None = None
+    ) -> int:
+        return await run_in_threadpool(
+            self.storage.write_upload_chunk, upload_id, offset, self._blocking_chunks(chunks), max_size
+        )
+
+    async def finalize_upload(self, upload_id: str, template_id: int, size: int) -> StoredTemplate:
+        return await run_in_threadpool(self.storage.finalize_upload, upload_id, template_id, size)
+
+    async def delete_upload(self, upload_id: str) -> None:
+        await run_in_threadpool(self.storage.delete_upload, upload_id)
@@ -0,0 +1,206 @@
+"""In-process publishing of template matching job state changes to subscribed clients.
+
+Jobs run in the worker service, so every API process has a single watcher task publishing the changes of the watched
+jobs: while there are subscribers, it polls the state and shard progress of the subscribed jobs and workspaces with two
+queries per interval, however many clients are subscribed. Idle subscribers only hold a `Subscription`, no task or DB
+connection of their own.
+"""
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator
+
+from sqlalchemy import func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from template_matching_api.api_models.template_matching_job import JobState, TemplateMatchingJobEvent
+from template_matching_api.db_model import TemplateMatchingJob, TemplateMatchingJobShard
+
+logger = logging.getLogger(__name__)
+
+# States a job only leaves when it is resubmitted
+FINISHED_JOB_STATES = frozenset({JobState.FAILED, JobState.SUCCEEDED, JobState.CANCELLED})
+
+
+@dataclass(frozen=True)
+class Topic:
+    job_id: int | None = None
+    workspace_id: int | None = None
+
+    def matches(self, event: TemplateMatchingJobEvent) -> bool:
+        return event.id == self.job_id or (self.workspace_id is not None and event.workspace_id == self.workspace_id)
+
+
+class Subscription:
+    """Events of one client, only the latest event of every job is kept until the client reads them"""
+
+    def __init__(self, topic: Topic) -> None:
+        self.topic = topic
+        self._pending: dict[int, TemplateMatchingJobEvent] = {}
+        self._ready = asyncio.Event()
+
+    def push(self, event: TemplateMatchingJobEvent) -> None:
+        self._pending[event.id] = event
+        self._ready.set()
+
+    async def next_events(self, timeout: float | None = None) -> list[TemplateMatchingJobEvent]:
+        """Events published since the last call, empty if there were none within `timeout` seconds"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except TimeoutError:
+            return []
+        self._ready.clear()
+        events = list(self._pending.values())
+        self._pending.clear()
+        return events
+
+
+async def load_job_events(
+    session: AsyncSession, job_ids: set[int], workspace_ids: set[int]
+) -> dict[int, TemplateMatchingJobEvent]:
+    """Current state of the jobs and of the jobs of the workspaces"""
+    watched = or_(TemplateMatchingJob.id.in_(job_ids), TemplateMatchingJob.workspace_id.in_(workspace_ids))
+    jobs = await session.execute(
+        select(
+            TemplateMatchingJob.id,
+            TemplateMatchingJob.workspace_id,
+            TemplateMatchingJob.job_state,
+            TemplateMatchingJob.job_id,
+            TemplateMatchingJob.error,
+        ).where(watched)
+    )
+    shards = await session.execute(
+        select(
+            TemplateMatchingJobShard.template_matching_job_id,
+            func.count(),
+            func.count().filter(TemplateMatchingJobShard.state == JobState.SUCCEEDED),
+        )
+        .join(
+            TemplateMatchingJob,
+            (TemplateMatchingJob.id == TemplateMatchingJobShard.template_matching_job_id)
+            & (TemplateMatchingJob.job_id == TemplateMatchingJobShard.run_id),
+        )
+        .where(watched)
+        .group_by(TemplateMatchingJobShard.template_matching_job_id)
+    )
+    progress = {job_id: (total, succeeded) for job_id, total, succeeded in shards}
+    return {
+        job.id: TemplateMatchingJobEvent(
+            id=job.id,
+            workspace_id=job.workspace_id,
+            job_state=job.job_state,
+            job_id=job.job_id,
+            error=job.error,
+            shards_total=progress.get(job.id, (0, 0))[0],
+            shards_succeeded=progress.get(job.id, (0, 0))[1],
+        )
+        for job in jobs
+    }
+
+
+class JobEventBroker:
+    def __init__(self, poll_interval_seconds: float) -> None:
+        self.poll_interval_seconds = poll_interval_seconds
+        self._subscriptions: dict[Topic, set[Subscription]] = {}
+        # Latest event of every watched job, a new subscriber receives it right away
+        self._latest: dict[int, TemplateMatchingJobEvent] = {}
+        self._watcher: asyncio.Task[None] | None = None
+
+    @property
+    def num_subscriptions(self) -> int:
+        return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    @asynccontextmanager
+    async def subscribe(
+        self, session_maker: async_sessionmaker[AsyncSession], topic: Topic
+    ) -> AsyncIterator[Subscription]:
+        subscription = Subscription(topic)
+        self._subscriptions.setdefault(topic, set()).add(subscription)
+        for event in self._latest.values():
+            if topic.matches(event):
+                subscription.push(event)
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch(session_maker))
+        try:
+            yield subscription
+        finally:
+            subscriptions = self._subscriptions[topic]
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[topic]
+
+    def publish(self, event: TemplateMatchingJobEvent) -> None:
+        self._latest[event.id] = event
+        for topic in (Topic(job_id=event.id), Topic(workspace_id=event.workspace_id)):
+            for subscription in self._subscriptions.get(topic, ()):
+                subscription.push(event)
+
+    async def close(self) -> None:
+        if self._watcher is None:
+            return
+        # Without subscribers the watcher ends after its current poll, a query is not cancelled midway
+        if self._subscriptions:
+            self._watcher.cancel()
+        await asyncio.gather(self._watcher, return_exceptions=True)
+
+    async def _watch(self, session_maker: async_sessionmaker[AsyncSession]) -> None:
+        """Publish the changes of the watched jobs until the last subscriber is gone"""
+        while self._subscriptions:
+            job_ids = {topic.job_id for topic in self._subscriptions if topic.job_id is not None}
+            workspace_ids = {topic.workspace_id for topic in self._subscriptions if topic.workspace_id is not None}
+            try:
+                async with session_maker() as session:
+                    events = await load_job_events(session, job_ids, workspace_ids)
+            except Exception:
+                logger.exception("Loading the state of watched template matching jobs failed")
+            else:
+                self._publish_changes(events, job_ids)
+            await asyncio.sleep(self.poll_interval_seconds)
+        self._latest.clear()
+
+    def _publish_changes(self, events: dict[int, TemplateMatchingJobEvent], job_ids: set[int]) -> None:
+        for job_id in job_ids - events.keys():
+            if job_id not in self._latest or not self._latest[job_id].deleted:
+                self.publish(TemplateMatchingJobEvent(id=job_id, workspace_id=None, job_state=None, deleted=True))
+        for event in events.values():
+            if self._latest.get(event.id) != event:
+                self.publish(event)
+        # Jobs that are not watched anymore are forgotten, a later subscriber gets their state from the next poll
+        self._latest = {
+            job_id: event for job_id, event in self._latest.items() if job_id in events or job_id in job_ids
+        }
+
+
+async def iter_sse_events(
+    broker: JobEventBroker,
+    session_maker: async_sessionmaker[AsyncSession],
+    topic: Topic,
+    keepalive_seconds: float,
+) -> AsyncGenerator[bytes, None]:
+    """Server-Sent Events stream of the events of `topic`, one `job` event per state change"""
+    async with broker.subscribe(session_maker, topic) as subscription:
+        while True:
+            events = await subscription.next_events(keepalive_seconds)
+            if not events:
+                yield b": keepalive\n\n"
+            for event in events:
+                yield f"event: job\ndata: {event.model_dump_json()}\n\n".encode()
+
+
+async def wait_for_job_state(
+    broker: JobEventBroker,
+    session_maker: async_sessionmaker[AsyncSession],
+    job_id: int,
+    job_state: JobState,
+    timeout: float,
+) -> None:
+    """Wait until the job is in `job_state`, has finished or was deleted, for at most `timeout` seconds"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    # The first event is the current state of the job
+    async with broker.subscribe(session_maker, Topic(job_id=job_id)) as subscription:
+        while (remaining := deadline - loop.time()) > 0:
+            for event in await subscription.next_events(remaining):
+                if event.deleted or event.job_state == job_state or event.job_state in FINISHED_JOB_STATES:
+                    return
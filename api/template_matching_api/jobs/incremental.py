@@ -0,0 +1,116 @@
+"""Incremental runs of template matching jobs.
+
+The results of every template of a job are kept as partial results, keyed by the hash of the template content, the
+data specification and the samples it selects. A run only computes the templates without partial results for their
+current inputs, i.e. templates that were added to the job or re-uploaded, and concatenates them with the reused partial
+results in the order of the job's templates.
+"""
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.jobs.memoization import compute_template_input_hashes
+from template_matching_api.jobs.queue import RunSummary
+from template_matching_api.result_storage import JobResultColumns, JobResultStorage, concat_columns
+
+# Computes the results of a single template
+ComputeTemplateResults = Callable[[DocumentTemplate, DataSpecification], JobResultColumns]
+
+
+class ComputeAbortedError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class IncrementalPlan:
+    templates: list[DocumentTemplate]
+    partial_keys: list[str]
+    # Templates without partial results for their current inputs
+    missing: list[DocumentTemplate]
+    reused_run_time: int
+
+
+@dataclass(frozen=True)
+class IncrementalRun:
+    columns: JobResultColumns
+    summary: RunSummary
+    # Partial results the run consists of, the other partial results of the job can be pruned once it succeeded
+    partial_keys: list[str]
+
+
+def plan_incremental_run(
+    job_id: int,
+    templates: list[DocumentTemplate],
+    data_specification: DataSpecification,
+    result_storage: JobResultStorage,
+) -> IncrementalPlan:
+    partial_keys = compute_template_input_hashes(templates, data_specification)
+    missing = []
+    reused_run_time = 0
+    for template, key in zip(templates, partial_keys):
+        partial = result_storage.load_partial(job_id, key)
+        if partial is None:
+            missing.append(template)
+        else:
+            reused_run_time += partial.total_run_time
+    return IncrementalPlan(templates, partial_keys, missing, reused_run_time)
+
+
+def compute_partials(
+    job_id: int,
+    templates: list[DocumentTemplate],
+    data_specification: DataSpecification,
+    result_storage: JobResultStorage,
+    compute: ComputeTemplateResults,
+    aborted: threading.Event | None = None,
+) -> list[JobResultColumns]:
+    """Results of the templates, only the ones without partial results for their current inputs are computed.
+
+    Raises `ComputeAbortedError` before computing the next template once `aborted` is set.
+    """
+    parts = []
+    for template, key in zip(templates, compute_template_input_hashes(templates, data_specification)):
+        partial = result_storage.load_partial(job_id, key)
+        if partial is None:
+            if aborted is not None and aborted.is_set():
+                raise ComputeAbortedError(f"Aborted before computing template {template.id}")
+            partial = compute(template, data_specification)
+            # Saved right away, a run failing or interrupted later does not compute the template again
+            result_storage.save_partial(job_id, key, partial)
+        parts.append(partial)
+    return parts
+
+
+def merge_partials(
+    job_id: int,
+    plan: IncrementalPlan,
+    data_specification: DataSpecification,
+    result_storage: JobResultStorage,
+    compute: ComputeTemplateResults,
+) -> IncrementalRun:
+    """Results of the planned run, from the partial results of all of its templates"""
+    # Partial results are normally all there, a template re-uploaded since the run was planned is computed here
+    parts = compute_partials(job_id, plan.templates, data_specification, result_storage, compute)
+    return IncrementalRun(
+        columns=concat_columns(parts),
+        summary=RunSummary(
+            templates_computed=len(plan.missing),
+            templates_reused=len(plan.templates) - len(plan.missing),
+            reused_run_time=plan.reused_run_time,
+        ),
+        partial_keys=plan.partial_keys,
+    )
+
+
+def run_incrementally(
+    job_id: int,
+    templates: list[DocumentTemplate],
+    data_specification: DataSpecification,
+    result_storage: JobResultStorage,
+    compute: ComputeTemplateResults,
+) -> IncrementalRun:
+    plan = plan_incremental_run(job_id, templates, data_specification, result_storage)
+    compute_partials(job_id, plan.missing, data_specification, result_storage, compute)
+    return merge_partials(job_id, plan, data_specification, result_storage, compute)
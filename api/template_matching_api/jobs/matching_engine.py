@@ -0,0 +1,189 @@
+"""Template matching by FFT-based normalized cross-correlation (NCC).
+
+The score of a sample is the best NCC of the template at any position and at any of the first `scale_levels` levels
+of its precomputed pyramid (the template at full, half, quarter... size), clipped to [0, 1]. Samples are matched in
+batches of equal size:
+
+- the FFT of every sample of a batch is computed once and shared by all levels of the template,
+- the correlation of a level with all samples of the batch is a single batched inverse FFT,
+- the local sums and energies normalizing the correlation come from integral images of the batch.
+
+Nothing loops over pixels or samples in Python, only over batches and levels. With a `score_threshold`, samples
+scoring at least that much stop being matched at the remaining levels, their score is then a lower bound of their best
+score that still tells they match.
+"""
+import io
+import time
+
+import numpy as np
+import numpy.typing as npt
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.derivatives import PYRAMID_NAME, UNVERSIONED, generate_derivatives
+from template_matching_api.file_storage import TemplateStorage, create_template_storage
+from template_matching_api.result_storage import JobResultColumns
+from template_matching_api.sample_corpus import LocalSampleCorpus, create_sample_corpus
+from template_matching_api.settings import Settings
+
+# Bump whenever the scores computed for the same inputs change, it keys memoized and partial results
+NCC_ENGINE_VERSION = 1
+# Windows with a lower standard deviation are flat, they do not match anything
+_FLAT_STD = 1e-3
+
+
+def _integral_images(values: npt.NDArray[np.float64]) -> npt.NDArray[np.float64]:
+    """Zero padded integral images, float64 keeps the differences of large sums exact enough"""
+    integral = np.zeros((values.shape[0], values.shape[1] + 1, values.shape[2] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(values, axis=1), axis=2, out=integral[:, 1:, 1:])
+    return integral
+
+
+def _window_sums(integral: npt.NDArray[np.float64], height: int, width: int) -> npt.NDArray[np.float64]:
+    """Sums of all `height` x `width` windows fully within the images"""
+    return (
+        integral[:, height:, width:]
+        - integral[:, :-height, width:]
+        - integral[:, height:, :-width]
+        + integral[:, :-height, :-width]
+    )
+
+
+def ncc_scores(
+    pyramid: list[npt.NDArray[np.float32]],
+    images: npt.NDArray[np.float32],
+    scale_levels: int,
+    score_threshold: float | None = None,
+) -> npt.NDArray[np.float32]:
+    """Best NCC of the template pyramid levels within each of the equally sized `images`, clipped to [0, 1]"""
+    num_images, image_height, image_width = images.shape
+    scores = np.zeros(num_images, dtype=np.float32)
+    levels = [
+        level
+        for level in pyramid[:scale_levels]
+        if level.shape[0] <= image_height and level.shape[1] <= image_width and level.std() >= _FLAT_STD
+    ]
+    if not levels or not num_images:
+        return scores
+
+    fft_shape = (image_height, image_width)
+    image_ffts = np.fft.rfft2(images, s=fft_shape)
+    sums = _integral_images(images.astype(np.float64))
+    squared_sums = _integral_images(np.square(images, dtype=np.float64))
+    active = np.arange(num_images)
+    for level in levels:
+        height, width = level.shape
+        # The template sums up to 0, so the correlation with it equals the one with the mean-free windows
+        centered = (level - level.mean(dtype=np.float64)).astype(np.float32)
+        template_norm = float(np.sqrt(np.square(centered, dtype=np.float64).sum()))
+        # Circular correlation, valid positions never wrap around as the template fits into the images
+        correlation = np.fft.irfft2(
+            image_ffts[active] * np.conj(np.fft.rfft2(centered, s=fft_shape)), s=fft_shape
+        )[:, : image_height - height + 1, : image_width - width + 1]
+        window_sums = _window_sums(sums[active], height, width)
+        variances = _window_sums(squared_sums[active], height, width) - np.square(window_sums) / (height * width)
+        window_norms = np.sqrt(np.maximum(variances, 0))
+        flat = window_norms < _FLAT_STD * np.sqrt(height * width)
+        ncc = np.where(flat, 0, correlation / (np.where(flat, 1, window_norms) * template_norm))
+        scores[active] = np.maximum(scores[active], ncc.max(axis=(1, 2)))
+        if score_threshold is not None:
+            active = active[scores[active] < score_threshold]
+            if not len(active):
+                break
+    return np.clip(scores, 0, 1)
+
+
+def load_template_pyramid(
+    template_storage: TemplateStorage, template: DocumentTemplate
+) -> list[npt.NDArray[np.float32]]:
+    """Precomputed pyramid of the template, generated (and stored) if it is missing"""
+    version = template.template_sha256 or UNVERSIONED
+    try:
+        pyramid_bytes = template_storage.load_derivative(template.id, version, PYRAMID_NAME)
+    except FileNotFoundError:
+        derivatives = generate_derivatives(
+            template_storage.local_path(template.id) or template_storage.load(template.id)
+        )
+        for name, derivative_bytes in derivatives.items():
+            template_storage.save_derivative(template.id, version, name, derivative_bytes)
+        pyramid_bytes = derivatives[PYRAMID_NAME]
+    with np.load(io.BytesIO(pyramid_bytes)) as levels:
+        return [levels[f"level_{idx}"] for idx in range(len(levels.files))]
+
+
+class NccMatchingEngine:
+    def __init__(
+        self,
+        template_storage: TemplateStorage,
+        sample_corpus: LocalSampleCorpus,
+        batch_size: int,
+        scale_levels: int,
+        score_threshold: float | None = None,
+    ) -> None:
+        self.template_storage = template_storage
+        self.sample_corpus = sample_corpus
+        self.batch_size = batch_size
+        self.scale_levels = scale_levels
+        self.score_threshold = score_threshold
+
+    @property
+    def version(self) -> str:
+        return _ncc_engine_version(self.scale_levels, self.score_threshold)
+
+    def template_results(
+        self, template: DocumentTemplate, data_specification: DataSpecification
+    ) -> JobResultColumns:
+        started = time.perf_counter()
+        pyramid = load_template_pyramid(self.template_storage, template)
+        sample_ids = [np.zeros(0, dtype=np.int64)]
+        scores = [np.zeros(0, dtype=np.float32)]
+        file_types = [np.zeros(0, dtype=np.uint8)]
+        created_at = [np.zeros(0, dtype="datetime64[s]")]
+        for batch in self.sample_corpus.iter_batches(data_specification, self.batch_size):
+            scores.append(ncc_scores(pyramid, batch.images, self.scale_levels, self.score_threshold))
+            sample_ids.append(batch.sample_id)
+            file_types.append(batch.file_type)
+            created_at.append(batch.created_at)
+
+        num_results = sum(len(batch_ids) for batch_ids in sample_ids)
+        return JobResultColumns(
+            template_id=np.full(num_results, template.id, dtype=np.int64),
+            sample_id=np.concatenate(sample_ids),
+            score=np.concatenate(scores),
+            file_type=np.concatenate(file_types),
+            created_at=np.concatenate(created_at),
+            templates=np.array([template.id], dtype=np.int64),
+            offsets=np.array([0, num_results], dtype=np.int64),
+            total_run_time=round((time.perf_counter() - started) * 1000),
+        )
+
+
+def _ncc_engine_version(scale_levels: int, score_threshold: float | None) -> str:
+    return f"ncc-{NCC_ENGINE_VERSION}:levels={scale_levels}:threshold={score_threshold}"
+
+
+def create_matching_engine(settings: Settings) -> NccMatchingEngine | None:
+    """The engine configured by the `matching_engine` setting, None for the mock engine generating random scores"""
+    if settings.matching_engine == "mock":
+        return None
+    return NccMatchingEngine(
+        create_template_storage(settings),
+        create_sample_corpus(settings),
+        settings.matching_batch_size,
+        settings.matching_scale_levels,
+        settings.matching_score_threshold,
+    )
+
+
+def sample_corpus_version(settings: Settings, data_specification: DataSpecification) -> str | None:
+    """Identifies the samples the configured engine matches, None for the mock engine which does not read any"""
+    if settings.matching_engine == "mock":
+        return None
+    return create_sample_corpus(settings).version(data_specification)
+
+
+def matching_engine_version(settings: Settings) -> str:
+    """Identifies the scores the configured engine computes, results of another engine are never reused"""
+    if settings.matching_engine == "mock":
+        return "mock"
+    return _ncc_engine_version(settings.matching_scale_levels, settings.matching_score_threshold)
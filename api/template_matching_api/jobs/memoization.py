@@ -0,0 +1,140 @@
+"""Reuse of results across jobs with identical inputs.
+
+The input hash of a job covers its sorted template ids, the content hashes of the template files, the data
+specification with its date range resolved, the samples it selects and the matching engine scoring them. A submitted
+job whose hash matches one of a job that already succeeded completes right away, its run gets hard links to the earlier
+results. Re-uploading a template clears the hashes of the jobs using it, and samples ingested into the selected
+partitions of the sample corpus change the hash, so earlier results are not reused anymore.
+"""
+import hashlib
+import json
+from datetime import date, datetime
+from typing import Any, Iterable
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.template_matching_job import JobState
+from template_matching_api.db_model import DocumentTemplate, TemplateMatchingJob, TemplateMatchingJobTemplate
+from template_matching_api.jobs.matching_engine import matching_engine_version, sample_corpus_version
+from template_matching_api.jobs.queue import submit_job
+from template_matching_api.jobs.template_matching_job import job_data_specification, sample_date_range
+from template_matching_api.result_storage import JobResultStorage, ResultsNotFoundError
+from template_matching_api.settings import get_settings
+
+# Earlier runs tried before giving up, their results may have been pruned in the meantime
+_MAX_CANDIDATES = 5
+
+
+def _template_version(template: DocumentTemplate) -> str:
+    # Templates uploaded before their content hash was recorded fall back to the time of the upload
+    return template.template_sha256 or f"uploaded-at:{template.uploaded_at.isoformat()}"
+
+
+def _data_specification_inputs(data_specification: DataSpecification) -> dict[str, Any]:
+    samples = sample_corpus_version(get_settings(), data_specification)
+    date_from: date | None
+    date_to: date | None
+    if samples is None:
+        # Mock results are drawn from the days the open ended specification resolves to at the time of the run
+        date_from, date_to = sample_date_range(data_specification)
+    else:
+        # The sample corpus version already tells the selected samples apart, open ended specifications keep their key
+        date_from, date_to = data_specification.date_from, data_specification.date_to
+    return {
+        "file_type": data_specification.file_type,
+        "date_from": date_from and date_from.isoformat(),
+        "date_to": date_to and date_to.isoformat(),
+        "samples": samples,
+    }
+
+
+def _hash_inputs(inputs: dict[str, Any]) -> str:
+    # Results of another matching engine (or configuration of it) are never reused
+    inputs = {**inputs, "engine": matching_engine_version(get_settings())}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def compute_input_hash(templates: Iterable[DocumentTemplate], data_specification: DataSpecification) -> str:
+    return _hash_inputs({
+        "templates": sorted([template.id, _template_version(template)] for template in templates),
+        **_data_specification_inputs(data_specification),
+    })
+
+
+def compute_template_input_hashes(
+    templates: Iterable[DocumentTemplate], data_specification: DataSpecification
+) -> list[str]:
+    """Hashes of the inputs of the results of single templates, they key the partial results of incremental runs"""
+    # Resolved once, it reads the sample corpus
+    data_specification_inputs = _data_specification_inputs(data_specification)
+    return [
+        _hash_inputs({"template": [template.id, _template_version(template)], **data_specification_inputs})
+        for template in templates
+    ]
+
+
+def compute_template_input_hash(template: DocumentTemplate, data_specification: DataSpecification) -> str:
+    return compute_template_input_hashes([template], data_specification)[0]
+
+
+async def reuse_memoized_results(
+    session: AsyncSession, job: TemplateMatchingJob, result_storage: JobResultStorage
+) -> bool:
+    """Complete the just submitted `job` with the results of an earlier job with the same input hash"""
+    if job.input_hash is None or job.job_id is None:
+        return False
+    candidates = await session.execute(
+        select(TemplateMatchingJob.id, TemplateMatchingJob.job_id)
+        .where(
+            TemplateMatchingJob.input_hash == job.input_hash,
+            TemplateMatchingJob.job_state == JobState.SUCCEEDED,
+            TemplateMatchingJob.job_id.is_not(None),
+            TemplateMatchingJob.id != job.id,
+        )
+        .order_by(TemplateMatchingJob.finished_at.desc())
+        .limit(_MAX_CANDIDATES)
+    )
+    for source_id, source_run_id in candidates:
+        try:
+            await run_in_threadpool(result_storage.link_run, source_id, source_run_id, job.id, job.job_id)
+        except ResultsNotFoundError:
+            continue
+        await run_in_threadpool(result_storage.prune, job.id, job.job_id)
+        now = datetime.now()
+        job.job_state = JobState.SUCCEEDED
+        job.started_at = now
+        job.finished_at = now
+        job.memoized_from_id = source_id
+        job.templates_computed = 0
+        job.templates_reused = len(job.document_templates)
+        job.reused_run_time = (await run_in_threadpool(result_storage.load, job.id, job.job_id)).total_run_time
+        return True
+    return False
+
+
+async def submit_job_with_memoization(
+    session: AsyncSession, job: TemplateMatchingJob, result_storage: JobResultStorage
+) -> None:
+    """Submit the job, the workspace and the document templates of the job have to be loaded"""
+    submit_job(job)
+    # Reads the sample corpus
+    job.input_hash = await run_in_threadpool(compute_input_hash, job.document_templates, job_data_specification(job))
+    await reuse_memoized_results(session, job, result_storage)
+
+
+async def invalidate_memoized_results(session: AsyncSession, template_id: int) -> None:
+    """Results of jobs using the template are not reused anymore, called when the template file changes"""
+    await session.execute(
+        update(TemplateMatchingJob)
+        .where(
+            TemplateMatchingJob.id.in_(
+                select(TemplateMatchingJobTemplate.template_matching_job_id).where(
+                    TemplateMatchingJobTemplate.document_template_id == template_id
+                )
+            )
+        )
+        .values(input_hash=None)
+    )
@@ -0,0 +1,363 @@
+"""Durable job queue on top of the `template_matching_jobs` table.
+
+Every state transition is a single conditional UPDATE (compare-and-set on the state and on the run id in `job_id`),
+so API processes and any number of worker processes can share the table without further locking:
+
+    SUBMITTED -> RUNNING -> SUCCEEDED / FAILED
+                 RUNNING -> SUBMITTED when the worker running it stopped sending heartbeats
+    SUBMITTED / RUNNING -> CANCELLED
+
+Resubmitting a job starts a new run, results of a previous run still in flight are then discarded.
+
+The templates of a run are split into shards in `template_matching_job_shards`, which go through the same states. Shards
+are claimed by any worker while their run is RUNNING, a failed or orphaned shard is retried on its own. The worker that
+claimed the job merges the results once all shards succeeded. Shards still to be computed when a run fails or is
+cancelled are cancelled with it, workers notice that through their heartbeats and stop after their current shard.
+"""
+import uuid
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import ColumnElement, delete, exists, func, select, update
+from sqlalchemy.orm import Session
+
+from template_matching_api.api_models.template_matching_job import JobState
+from template_matching_api.db_model import TemplateMatchingJob, TemplateMatchingJobShard
+from template_matching_api.jobs.scheduler import next_job_id
+
+
+@dataclass(frozen=True)
+class ClaimedJob:
+    id: int
+    run_id: str
+    worker_id: str
+    # Of the job, the `job_timeout_seconds` setting applies if None
+    timeout_seconds: float | None = None
+
+
+@dataclass(frozen=True)
+class ClaimedShard:
+    id: int
+    job_id: int
+    run_id: str
+    worker_id: str
+    document_template_ids: list[int]
+    attempts: int
+
+
+@dataclass(frozen=True)
+class ShardProgress:
+    total: int
+    succeeded: int
+    # Error of a shard that failed for good, the run cannot succeed anymore
+    error: str | None
+
+    @property
+    def done(self) -> bool:
+        return self.succeeded == self.total
+
+
+@dataclass(frozen=True)
+class RunSummary:
+    """Work done by a run, results of templates with unchanged inputs are reused from earlier runs"""
+    templates_computed: int
+    templates_reused: int
+    reused_run_time: int
+
+
+def submit_job(job: TemplateMatchingJob) -> None:
+    job.job_id = str(uuid.uuid4())
+    job.job_state = JobState.SUBMITTED
+    job.submitted_at = datetime.now()
+    job.started_at = None
+    job.finished_at = None
+    job.worker_id = None
+    job.heartbeat_at = None
+    job.attempts = 0
+    job.error = None
+    job.memoized_from_id = None
+    job.templates_computed = None
+    job.templates_reused = None
+    job.reused_run_time = None
+
+
+def claim_next_job(
+    session: Session, worker_id: str, fairness_window: timedelta = timedelta(hours=1)
+) -> ClaimedJob | None:
+    """Move the submitted job scheduled next (see `jobs.scheduler`) to RUNNING on behalf of `worker_id`"""
+    now = datetime.now()
+    claimed = session.execute(
+        update(TemplateMatchingJob)
+        # The state is checked again, the subquery may have seen a job another worker claimed in the meantime
+        .where(
+            TemplateMatchingJob.id == next_job_id(fairness_window),
+            TemplateMatchingJob.job_state == JobState.SUBMITTED,
+            # Without a run id the run could not be owned, such a job is never moved to RUNNING
+            TemplateMatchingJob.job_id.is_not(None),
+        )
+        .values(
+            job_state=JobState.RUNNING,
+            worker_id=worker_id,
+            started_at=now,
+            heartbeat_at=now,
+            attempts=TemplateMatchingJob.attempts + 1,
+        )
+        .returning(TemplateMatchingJob.id, TemplateMatchingJob.job_id, TemplateMatchingJob.timeout_seconds)
+    ).one_or_none()
+    if claimed is None:
+        return None
+    return ClaimedJob(
+        id=claimed.id, run_id=claimed.job_id, worker_id=worker_id, timeout_seconds=claimed.timeout_seconds
+    )
+
+
+def _owned_by(claimed: ClaimedJob) -> tuple[ColumnElement[bool], ...]:
+    return (
+        TemplateMatchingJob.id == claimed.id,
+        TemplateMatchingJob.job_id == claimed.run_id,
+        TemplateMatchingJob.worker_id == claimed.worker_id,
+        TemplateMatchingJob.job_state == JobState.RUNNING,
+    )
+
+
+def heartbeat(session: Session, claimed: ClaimedJob) -> bool:
+    """Returns False once the job is not running on behalf of this worker anymore"""
+    result = session.execute(
+        update(TemplateMatchingJob).where(*_owned_by(claimed)).values(heartbeat_at=datetime.now())
+    )
+    return bool(result.rowcount)
+
+
+def finish_job(
+    session: Session,
+    claimed: ClaimedJob,
+    state: JobState,
+    error: str | None = None,
+    summary: RunSummary | None = None,
+) -> bool:
+    """Move the job to SUCCEEDED or FAILED, returns False if it was resubmitted, recovered or cancelled meanwhile"""
+    result = session.execute(
+        update(TemplateMatchingJob)
+        .where(*_owned_by(claimed))
+        .values(job_state=state, finished_at=datetime.now(), error=error, **(asdict(summary) if summary else {}))
+    )
+    if result.rowcount and state != JobState.SUCCEEDED:
+        _cancel_shards(session, claimed.id)
+    return bool(result.rowcount)
+
+
+def cancel_job(session: Session, job_id: int) -> bool:
+    """Move a submitted or running job to CANCELLED, returns False if it is not queued or running.
+
+    Workers computing its shards stop within a heartbeat interval plus the time to finish their current template.
+    """
+    result = session.execute(
+        update(TemplateMatchingJob)
+        .where(
+            TemplateMatchingJob.id == job_id,
+            TemplateMatchingJob.job_state.in_([JobState.SUBMITTED, JobState.RUNNING]),
+        )
+        .values(job_state=JobState.CANCELLED, finished_at=datetime.now(), error="Cancelled")
+    )
+    if result.rowcount:
+        _cancel_shards(session, job_id)
+    return bool(result.rowcount)
+
+
+def recover_orphaned_jobs(session: Session, heartbeat_timeout: timedelta, max_attempts: int) -> int:
+    """Resubmit running jobs whose worker stopped sending heartbeats, or fail them after `max_attempts` starts.
+
+    Returns the number of recovered jobs.
+    """
+    orphaned = (
+        TemplateMatchingJob.job_state == JobState.RUNNING,
+        TemplateMatchingJob.heartbeat_at < datetime.now() - heartbeat_timeout,
+    )
+    requeued = session.execute(
+        update(TemplateMatchingJob)
+        .where(*orphaned, TemplateMatchingJob.attempts < max_attempts)
+        .values(job_state=JobState.SUBMITTED, worker_id=None, heartbeat_at=None)
+    )
+    failed = session.execute(
+        update(TemplateMatchingJob)
+        .where(*orphaned)
+        .values(
+            job_state=JobState.FAILED,
+            finished_at=datetime.now(),
+            error=f"Worker stopped responding, gave up after {max_attempts} attempts",
+        )
+    )
+    return int(requeued.rowcount + failed.rowcount)
+
+
+def create_shards(session: Session, claimed: ClaimedJob, template_batches: list[list[int]]) -> None:
+    """Shards of the run, a run claimed again after it was recovered keeps its shards and their progress"""
+    session.execute(
+        delete(TemplateMatchingJobShard).where(
+            TemplateMatchingJobShard.template_matching_job_id == claimed.id,
+            TemplateMatchingJobShard.run_id != claimed.run_id,
+        )
+    )
+    has_shards = session.scalar(
+        select(
+            exists().where(
+                TemplateMatchingJobShard.template_matching_job_id == claimed.id,
+                TemplateMatchingJobShard.run_id == claimed.run_id,
+            )
+        )
+    )
+    if has_shards:
+        return
+    session.add_all(
+        TemplateMatchingJobShard(
+            template_matching_job_id=claimed.id,
+            run_id=claimed.run_id,
+            shard_index=shard_index,
+            document_template_ids=template_ids,
+            state=JobState.SUBMITTED,
+            attempts=0,
+        )
+        for shard_index, template_ids in enumerate(template_batches)
+    )
+
+
+def claim_next_shard(session: Session, worker_id: str, job_id: int | None = None) -> ClaimedShard | None:
+    """Move a submitted shard of a running job (of `job_id` if given) to RUNNING on behalf of `worker_id`"""
+    now = datetime.now()
+    claimable = (
+        TemplateMatchingJobShard.state == JobState.SUBMITTED,
+        # Only shards of the current run of a job still running, shards of discarded runs are never claimed
+        exists().where(
+            TemplateMatchingJob.id == TemplateMatchingJobShard.template_matching_job_id,
+            TemplateMatchingJob.job_id == TemplateMatchingJobShard.run_id,
+            TemplateMatchingJob.job_state == JobState.RUNNING,
+        ),
+    )
+    next_shard_id = (
+        select(TemplateMatchingJobShard.id)
+        .where(
+            *claimable,
+            *((TemplateMatchingJobShard.template_matching_job_id == job_id,) if job_id is not None else ()),
+        )
+        .order_by(TemplateMatchingJobShard.template_matching_job_id, TemplateMatchingJobShard.shard_index)
+        .limit(1)
+        .scalar_subquery()
+    )
+    claimed = session.execute(
+        update(TemplateMatchingJobShard)
+        .where(TemplateMatchingJobShard.id == next_shard_id, *claimable)
+        .values(
+            state=JobState.RUNNING,
+            worker_id=worker_id,
+            started_at=now,
+            heartbeat_at=now,
+            attempts=TemplateMatchingJobShard.attempts + 1,
+        )
+        .returning(
+            TemplateMatchingJobShard.id,
+            TemplateMatchingJobShard.template_matching_job_id,
+            TemplateMatchingJobShard.run_id,
+            TemplateMatchingJobShard.document_template_ids,
+            TemplateMatchingJobShard.attempts,
+        )
+    ).one_or_none()
+    if claimed is None:
+        return None
+    return ClaimedShard(
+        id=claimed.id,
+        job_id=claimed.template_matching_job_id,
+        run_id=claimed.run_id,
+        worker_id=worker_id,
+        document_template_ids=claimed.document_template_ids,
+        attempts=claimed.attempts,
+    )
+
+
+def _cancel_shards(session: Session, job_id: int) -> None:
+    # Running shards stop sending heartbeats and their results are not recorded
+    session.execute(
+        update(TemplateMatchingJobShard)
+        .where(
+            TemplateMatchingJobShard.template_matching_job_id == job_id,
+            TemplateMatchingJobShard.state.in_([JobState.SUBMITTED, JobState.RUNNING]),
+        )
+        .values(state=JobState.CANCELLED, finished_at=datetime.now())
+    )
+
+
+def _shard_owned_by(claimed: ClaimedShard) -> tuple[ColumnElement[bool], ...]:
+    return (
+        TemplateMatchingJobShard.id == claimed.id,
+        TemplateMatchingJobShard.worker_id == claimed.worker_id,
+        TemplateMatchingJobShard.state == JobState.RUNNING,
+    )
+
+
+def shard_heartbeat(session: Session, claimed: ClaimedShard) -> bool:
+    result = session.execute(
+        update(TemplateMatchingJobShard).where(*_shard_owned_by(claimed)).values(heartbeat_at=datetime.now())
+    )
+    return bool(result.rowcount)
+
+
+def finish_shard(
+    session: Session, claimed: ClaimedShard, error: str | None = None, max_attempts: int | None = None
+) -> bool:
+    """Move the shard to SUCCEEDED, or with an `error` back to SUBMITTED until it was started `max_attempts` times"""
+    if error is None:
+        values = {"state": JobState.SUCCEEDED, "finished_at": datetime.now(), "error": None}
+    elif max_attempts is not None and claimed.attempts < max_attempts:
+        values = {"state": JobState.SUBMITTED, "worker_id": None, "heartbeat_at": None, "error": error}
+    else:
+        values = {"state": JobState.FAILED, "finished_at": datetime.now(), "error": error}
+    result = session.execute(update(TemplateMatchingJobShard).where(*_shard_owned_by(claimed)).values(**values))
+    return bool(result.rowcount)
+
+
+def shard_progress(session: Session, claimed: ClaimedJob) -> ShardProgress:
+    counts = dict(
+        session.execute(
+            select(TemplateMatchingJobShard.state, func.count())
+            .where(
+                TemplateMatchingJobShard.template_matching_job_id == claimed.id,
+                TemplateMatchingJobShard.run_id == claimed.run_id,
+            )
+            .group_by(TemplateMatchingJobShard.state)
+        ).tuples().all()
+    )
+    error = None
+    if counts.get(JobState.FAILED):
+        error = session.scalar(
+            select(TemplateMatchingJobShard.error)
+            .where(
+                TemplateMatchingJobShard.template_matching_job_id == claimed.id,
+                TemplateMatchingJobShard.run_id == claimed.run_id,
+                TemplateMatchingJobShard.state == JobState.FAILED,
+            )
+            .order_by(TemplateMatchingJobShard.shard_index)
+            .limit(1)
+        )
+    return ShardProgress(total=sum(counts.values()), succeeded=counts.get(JobState.SUCCEEDED, 0), error=error)
+
+
+def recover_orphaned_shards(session: Session, heartbeat_timeout: timedelta, max_attempts: int) -> int:
+    """Resubmit running shards whose worker stopped sending heartbeats, or fail them after `max_attempts` starts"""
+    orphaned = (
+        TemplateMatchingJobShard.state == JobState.RUNNING,
+        TemplateMatchingJobShard.heartbeat_at < datetime.now() - heartbeat_timeout,
+    )
+    requeued = session.execute(
+        update(TemplateMatchingJobShard)
+        .where(*orphaned, TemplateMatchingJobShard.attempts < max_attempts)
+        .values(state=JobState.SUBMITTED, worker_id=None, heartbeat_at=None)
+    )
+    failed = session.execute(
+        update(TemplateMatchingJobShard)
+        .where(*orphaned)
+        .values(
+            state=JobState.FAILED,
+            finished_at=datetime.now(),
+            error=f"Worker stopped responding, gave up after {max_attempts} attempts",
+        )
+    )
+    return int(requeued.rowcount + failed.rowcount)
@@ -0,0 +1,105 @@
+"""Fair sharing of the job workers between workspaces.
+
+Of the workspaces with submitted jobs and fewer running jobs than their `max_concurrent_jobs`, the next job is taken
+from the one served least relative to its `job_weight`. The service of a workspace is the number of its jobs that are
+running or that workers started within the fairness window, so workspaces take turns even when a single worker runs
+one job at a time, and run jobs in proportion to their weights however many jobs each of them submitted. The window
+bounds the history, a workspace that was busy long ago is not penalized anymore. Within a workspace, jobs with a
+higher priority are run first, then the longest waiting ones.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import ScalarSelect, and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from template_matching_api.api_models.template_matching_job import JobState, WorkspaceQueueMetrics
+from template_matching_api.db_model import TemplateMatchingJob, Workspace
+
+
+def next_job_id(fairness_window: timedelta) -> ScalarSelect[int]:
+    """Id of the job to run next, evaluated as part of the statement claiming it"""
+    is_running = TemplateMatchingJob.job_state == JobState.RUNNING
+    # Jobs that reused the results of another job never took a worker, recovered jobs waiting again were orphaned
+    # by a crashed one
+    recently_started = and_(
+        TemplateMatchingJob.started_at >= datetime.now() - fairness_window,
+        TemplateMatchingJob.memoized_from_id.is_(None),
+        TemplateMatchingJob.job_state != JobState.SUBMITTED,
+    )
+    service = (
+        select(
+            TemplateMatchingJob.workspace_id,
+            func.count().filter(is_running).label("running"),
+            func.count().label("served"),
+        )
+        .where(or_(is_running, recently_started))
+        .group_by(TemplateMatchingJob.workspace_id)
+        .subquery()
+    )
+    num_running = func.coalesce(service.c.running, 0)
+    num_served = func.coalesce(service.c.served, 0)
+    return (
+        select(TemplateMatchingJob.id)
+        .outerjoin(Workspace, Workspace.id == TemplateMatchingJob.workspace_id)
+        .outerjoin(service, service.c.workspace_id == TemplateMatchingJob.workspace_id)
+        .where(
+            TemplateMatchingJob.job_state == JobState.SUBMITTED,
+            TemplateMatchingJob.job_id.is_not(None),
+            or_(Workspace.max_concurrent_jobs.is_(None), num_running < Workspace.max_concurrent_jobs),
+        )
+        .order_by(
+            num_served / func.coalesce(Workspace.job_weight, 1.0),
+            TemplateMatchingJob.priority.desc(),
+            TemplateMatchingJob.submitted_at,
+            TemplateMatchingJob.id,
+        )
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+async def workspace_queue_metrics(session: AsyncSession, window: timedelta) -> list[WorkspaceQueueMetrics]:
+    """Queue depth and wait times per workspace with queued, running or recently started jobs"""
+    now = datetime.now()
+    queue_depths = await session.execute(
+        select(
+            TemplateMatchingJob.workspace_id,
+            func.count().filter(TemplateMatchingJob.job_state == JobState.SUBMITTED),
+            func.count().filter(TemplateMatchingJob.job_state == JobState.RUNNING),
+            func.min(TemplateMatchingJob.submitted_at).filter(TemplateMatchingJob.job_state == JobState.SUBMITTED),
+        )
+        .where(TemplateMatchingJob.job_state.in_([JobState.SUBMITTED, JobState.RUNNING]))
+        .group_by(TemplateMatchingJob.workspace_id)
+    )
+    depths = {workspace_id: (queued, running, oldest) for workspace_id, queued, running, oldest in queue_depths}
+    # Wait times are computed here, date arithmetic differs between databases. Jobs that reused the results of
+    # another job never waited for a worker.
+    started = await session.execute(
+        select(
+            TemplateMatchingJob.workspace_id, TemplateMatchingJob.submitted_at, TemplateMatchingJob.started_at
+        ).where(
+            TemplateMatchingJob.started_at >= now - window,
+            TemplateMatchingJob.submitted_at.is_not(None),
+            TemplateMatchingJob.memoized_from_id.is_(None),
+        )
+    )
+    waits: dict[int | None, list[float]] = {}
+    for workspace_id, submitted_at, started_at in started:
+        waits.setdefault(workspace_id, []).append(max((started_at - submitted_at).total_seconds(), 0.0))
+
+    metrics = []
+    for workspace_id in sorted(depths.keys() | waits.keys(), key=lambda key: (key is None, key or 0)):
+        queued, running, oldest = depths.get(workspace_id, (0, 0, None))
+        workspace_waits = waits.get(workspace_id, [])
+        metrics.append(
+            WorkspaceQueueMetrics(
+                workspace_id=workspace_id,
+                queued=queued,
+                running=running,
+                oldest_queued_seconds=(now - oldest).total_seconds() if oldest is not None else None,
+                started=len(workspace_waits),
+                mean_wait_seconds=sum(workspace_waits) / len(workspace_waits) if workspace_waits else None,
+                max_wait_seconds=max(workspace_waits, default=None),
+            )
+        )
+    return metrics
@@ -1,5 +1,7 @@
 import random
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+
+import numpy as np
 
 from template_matching_api.api_models.template_matching_job import (
     TemplateMatchingJobResults,
@@ -12,6 +14,7 @@ from template_matching_api.api_models.sample import (
 )
 from template_matching_api.api_models.data_specification import DataSpecification
 from template_matching_api.db_model import TemplateMatchingJob
+from template_matching_api.result_storage import FILE_TYPES, JobResultColumns
 
 
 def mock_job_results(job: TemplateMatchingJob) -> TemplateMatchingJobResults:
@@ -37,8 +40,22 @@ def mock_job_results(job: TemplateMatchingJob) -> TemplateMatchingJobResults:
     )
 
 
+def job_data_specification(job: TemplateMatchingJob) -> DataSpecification:
+    """Data specification of the job's workspace, the workspace has to be loaded"""
+    if job.workspace and job.workspace.data_specification:
+        return DataSpecification.model_validate(job.workspace.data_specification)
+    return DataSpecification()
+
+
+def sample_date_range(data_specification: DataSpecification) -> tuple[date, date]:
+    # Open ended specifications are limited to the last 30 days, samples always have a creation date
+    date_to = data_specification.date_to or date.today()
+    date_from = data_specification.date_from or date_to - timedelta(days=29)
+    return date_from, date_to
+
+
 def mock_job_results_with_data_spec(
-    job: TemplateMatchingJob, data_specification: DataSpecification
+    job: TemplateMatchingJob, data_specification: DataSpecification, num_samples: int | None = None
 ) -> TemplateMatchingJobResults:
     # This would normally accept Pydantic model with data specification instead of plain dict, but I did not want to prepare the model for the task
     template_ids = job.document_template_ids
@@ -51,10 +68,7 @@ def mock_job_results_with_data_spec(
         else list(FileType)
     )
 
-    available_dates: list[datetime] | None = None
-    if data_specification.date_from and data_specification.date_to:
-        date_from, date_to = data_specification.date_from, data_specification.date_to
-
+    date_from, date_to = sample_date_range(data_specification)
     num_days = (date_to - date_from + timedelta(days=1)).days
     available_dates = [
         datetime.combine(date_from + timedelta(days=day), datetime.min.time())
@@ -62,12 +76,9 @@ def mock_job_results_with_data_spec(
     ]
 
     for template_id in template_ids:
-        num_samples = random.randint(1, 100)
         sample_results: list[SampleResult] = []
-        for _ in range(num_samples):
-            created_at = (
-                random.choice(available_dates) if available_dates else None
-            )
+        for _ in range(num_samples or random.randint(1, 100)):
+            created_at = random.choice(available_dates)
             sample_results.append(
                 ExtendedSampleResult(
                     sample_id=next_sample_id,
@@ -86,3 +97,45 @@ def mock_job_results_with_data_spec(
         results_per_template=template_results,
         total_run_time=random.randint(1_000, 10_000),
     )
+
+
+def mock_job_result_columns(
+    template_ids: list[int],
+    data_specification: DataSpecification,
+    num_samples: int | None = None,
+    rng: np.random.Generator | None = None,
+) -> JobResultColumns:
+    """Vectorized counterpart of `mock_job_results_with_data_spec`, generates the result columns directly.
+
+    Every template gets `num_samples` sample results, between 1 and 100 if not given.
+    """
+    rng = rng or np.random.default_rng()
+    counts = (
+        rng.integers(1, 101, size=len(template_ids))
+        if num_samples is None
+        else np.full(len(template_ids), num_samples)
+    )
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    total = int(offsets[-1])
+
+    file_type_codes = np.array(
+        [FILE_TYPES.index(data_specification.file_type)]
+        if data_specification.file_type
+        else range(len(FILE_TYPES)),
+        dtype=np.uint8,
+    )
+    date_from, date_to = sample_date_range(data_specification)
+    num_days = (date_to - date_from + timedelta(days=1)).days
+    created_at = np.datetime64(date_from, "s") + rng.integers(0, num_days, size=total) * np.timedelta64(1, "D")
+
+    templates = np.array(template_ids, dtype=np.int64)
+    return JobResultColumns(
+        template_id=np.repeat(templates, counts),
+        sample_id=np.arange(1, total + 1, dtype=np.int64),
+        score=rng.random(total, dtype=np.float32),
+        file_type=rng.choice(file_type_codes, size=total),
+        created_at=created_at,
+        templates=templates,
+        offsets=offsets,
+        total_run_time=int(rng.integers(1_000, 10_001)),
+    )
@@ -0,0 +1,351 @@
+"""Job worker service, runs submitted template matching jobs in a pool of worker processes.
+
+The API only submits jobs, every worker process independently claims the next one from the queue, so throughput scales
+with the number of processes (on one or many machines sharing the DB). The templates of a job are split into shards
+that all idle workers help computing, the worker that claimed the job merges their results. The supervisor restarts
+crashed workers and resubmits jobs and shards orphaned by them.
+
+Run from the project root:
+    uv run --frozen python -m template_matching_api.jobs.worker --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+from multiprocessing.process import BaseProcess
+from multiprocessing.synchronize import Event as EventType
+from types import FrameType
+from typing import Callable, Iterator
+
+from sqlalchemy.orm import selectinload, sessionmaker, Session
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.template_matching_job import JobState
+from template_matching_api.db import dispose_db, get_db, session_scope
+from template_matching_api.db_model import DocumentTemplate, TemplateMatchingJob
+from template_matching_api.jobs.incremental import (
+    ComputeAbortedError,
+    IncrementalRun,
+    compute_partials,
+    merge_partials,
+    plan_incremental_run,
+)
+from template_matching_api.jobs.matching_engine import NccMatchingEngine, create_matching_engine
+from template_matching_api.jobs.queue import (
+    ClaimedJob,
+    claim_next_job,
+    claim_next_shard,
+    create_shards,
+    finish_job,
+    finish_shard,
+    heartbeat,
+    recover_orphaned_jobs,
+    recover_orphaned_shards,
+    shard_heartbeat,
+    shard_progress,
+)
+from template_matching_api.jobs.template_matching_job import job_data_specification, mock_job_result_columns
+from template_matching_api.result_storage import JobResultColumns, JobResultStorage, create_result_storage
+from template_matching_api.settings import Settings, get_settings
+
+logger = logging.getLogger(__name__)
+
+
+def _compute_template_results(template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+    return mock_job_result_columns([template.id], data_specification)
+
+
+def load_job_inputs(
+    session_maker: sessionmaker[Session], job_id: int
+) -> tuple[list[DocumentTemplate], DataSpecification]:
+    """Templates of the job in result order and its data specification"""
+    # Never committed, the session only loads the job and is closed before the matching starts
+    with session_maker() as session:
+        job = session.get(
+            TemplateMatchingJob,
+            job_id,
+            options=[
+                selectinload(TemplateMatchingJob.workspace),
+                selectinload(TemplateMatchingJob.template_matching_job_templates),
+                selectinload(TemplateMatchingJob.document_templates),
+            ],
+        )
+        if job is None:
+            raise LookupError(f"Template matching job {job_id} was deleted")
+        templates_by_id = {template.id: template for template in job.document_templates}
+        return [templates_by_id[template_id] for template_id in job.document_template_ids], job_data_specification(job)
+
+
+def _split_into_shards(templates: list[DocumentTemplate], shard_size: int) -> list[list[int]]:
+    return [
+        [template.id for template in templates[start:start + shard_size]]
+        for start in range(0, len(templates), shard_size)
+    ]
+
+
+class RunDiscardedError(Exception):
+    pass
+
+
+class ShardFailedError(Exception):
+    pass
+
+
+class JobTimeoutError(Exception):
+    pass
+
+
+class JobWorker:
+    def __init__(
+        self,
+        session_maker: sessionmaker[Session],
+        worker_id: str,
+        settings: Settings,
+        result_storage: JobResultStorage,
+        matching_engine: NccMatchingEngine | None = None,
+    ) -> None:
+        self.session_maker = session_maker
+        self.worker_id = worker_id
+        self.settings = settings
+        self.result_storage = result_storage
+        # Random scores of the mock engine if None
+        self.matching_engine = matching_engine
+
+    def run_once(self) -> bool:
+        """Run a shard of a running job, or else claim and run the next submitted job.
+
+        Returns False if there was neither.
+        """
+        if self.run_next_shard():
+            return True
+        with session_scope(self.session_maker) as session:
+            claimed = claim_next_job(
+                session, self.worker_id, timedelta(seconds=self.settings.job_fairness_window_seconds)
+            )
+        if claimed is None:
+            return False
+
+        logger.info("Running template matching job %s (run %s)", claimed.id, claimed.run_id)
+        error: str | None = None
+        try:
+            with self._sending_heartbeats(partial(heartbeat, claimed=claimed), f"template matching job {claimed.id}"):
+                run = self._run_job(claimed)
+                # Stored before the job succeeds, so that results of a SUCCEEDED job are always there
+                self.result_storage.save(claimed.id, claimed.run_id, run.columns)
+        except Exception as e:
+            logger.exception("Template matching job %s failed", claimed.id)
+            state, error, summary = JobState.FAILED, f"{type(e).__name__}: {e}", None
+        else:
+            state, summary = JobState.SUCCEEDED, run.summary
+            logger.info(
+                "Template matching job %s computed %s templates, reused the results of %s",
+                claimed.id,
+                summary.templates_computed,
+                summary.templates_reused,
+            )
+
+        with session_scope(self.session_maker) as session:
+            finished = finish_job(session, claimed, state, error, summary)
+        if not finished:
+            logger.warning(
+                "Template matching job %s was resubmitted or cancelled while running, run %s discarded",
+                claimed.id,
+                claimed.run_id,
+            )
+        elif state == JobState.SUCCEEDED:
+            self.result_storage.prune(claimed.id, keep_run_id=claimed.run_id)
+            self.result_storage.prune_partials(claimed.id, keep_keys=run.partial_keys)
+        return True
+
+    def run_next_shard(self, job_id: int | None = None, deadline: float | None = None) -> bool:
+        """Claim and compute the next submitted shard (of `job_id` if given), returns False if there was none.
+
+        The shard is aborted between templates once it is cancelled, recovered or the `time.monotonic()` `deadline`
+        of its job passes.
+        """
+        with session_scope(self.session_maker) as session:
+            claimed = claim_next_shard(session, self.worker_id, job_id)
+        if claimed is None:
+            return False
+
+        error: str | None = None
+        try:
+            beat = partial(shard_heartbeat, claimed=claimed)
+            with self._sending_heartbeats(beat, f"shard {claimed.id}", deadline) as aborted:
+                templates, data_specification = load_job_inputs(self.session_maker, claimed.job_id)
+                # Templates removed from the job since the shards were created are skipped
+                shard_template_ids = set(claimed.document_template_ids)
+                shard_templates = [template for template in templates if template.id in shard_template_ids]
+                compute_partials(
+                    claimed.job_id,
+                    shard_templates,
+                    data_specification,
+                    self.result_storage,
+                    self._compute_template,
+                    aborted,
+                )
+        except ComputeAbortedError:
+            # The job is cancelled or failed by now, or the shard was handed to another worker
+            logger.info("Shard %s of template matching job %s aborted", claimed.id, claimed.job_id)
+            return True
+        except Exception as e:
+            logger.exception("Shard %s of template matching job %s failed", claimed.id, claimed.job_id)
+            error = f"{type(e).__name__}: {e}"
+        with session_scope(self.session_maker) as session:
+            finish_shard(session, claimed, error, self.settings.job_max_attempts)
+        return True
+
+    def _run_job(self, claimed: ClaimedJob) -> IncrementalRun:
+        """Split the templates without reusable results into shards, help computing them and merge the results.
+
+        Cancellation and the timeout are checked between shards, shards being computed are aborted between templates.
+        """
+        timeout = claimed.timeout_seconds or self.settings.job_timeout_seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+        templates, data_specification = load_job_inputs(self.session_maker, claimed.id)
+        plan = plan_incremental_run(claimed.id, templates, data_specification, self.result_storage)
+        with session_scope(self.session_maker) as session:
+            create_shards(session, claimed, _split_into_shards(plan.missing, self.settings.job_shard_size))
+
+        while True:
+            with session_scope(self.session_maker) as session:
+                if not heartbeat(session, claimed):
+                    raise RunDiscardedError(f"Run {claimed.run_id} is not running anymore")
+                if deadline is not None and time.monotonic() > deadline:
+                    raise JobTimeoutError(f"Run {claimed.run_id} did not finish within {timeout} seconds")
+                progress = shard_progress(session, claimed)
+            if progress.error is not None:
+                raise ShardFailedError(progress.error)
+            if progress.done:
+                break
+            # Shards of the job first, the remaining ones are being computed by other workers
+            if not self.run_next_shard(claimed.id, deadline):
+                time.sleep(self.settings.job_poll_interval_seconds)
+        return merge_partials(claimed.id, plan, data_specification, self.result_storage, self._compute_template)
+
+    def _compute_template(self, template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+        if self.matching_engine is None:
+            return _compute_template_results(template, data_specification)
+        return self.matching_engine.template_results(template, data_specification)
+
+    @contextmanager
+    def _sending_heartbeats(
+        self, beat: Callable[[Session], bool], name: str, deadline: float | None = None
+    ) -> Iterator[threading.Event]:
+        """Yields an event set once a heartbeat finds the work not owned anymore or the `deadline` has passed"""
+        stop = threading.Event()
+        aborted = threading.Event()
+        heartbeats = threading.Thread(
+            target=self._send_heartbeats, args=(beat, name, deadline, stop, aborted), daemon=True
+        )
+        heartbeats.start()
+        try:
+            yield aborted
+        finally:
+            stop.set()
+            heartbeats.join()
+
+    def _send_heartbeats(
+        self,
+        beat: Callable[[Session], bool],
+        name: str,
+        deadline: float | None,
+        stop: threading.Event,
+        aborted: threading.Event,
+    ) -> None:
+        while not stop.wait(self.settings.job_heartbeat_interval_seconds):
+            if deadline is not None and time.monotonic() > deadline:
+                aborted.set()
+                return
+            try:
+                with session_scope(self.session_maker) as session:
+                    if not beat(session):
+                        aborted.set()
+                        return
+            except Exception:
+                # e.g. the DB being briefly locked, the job is only recovered after several missed heartbeats
+                logger.exception("Heartbeat of %s failed", name)
+
+
+def worker_process(stop_event: EventType) -> None:
+    # Interrupts are handled by the supervisor, which lets the workers finish their current job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    settings = get_settings()
+    worker = JobWorker(
+        sessionmaker(bind=get_db()),
+        f"{socket.gethostname()}:{os.getpid()}",
+        settings,
+        create_result_storage(settings),
+        create_matching_engine(settings),
+    )
+    try:
+        while not stop_event.is_set():
+            if not worker.run_once():
+                stop_event.wait(settings.job_poll_interval_seconds)
+    finally:
+        dispose_db()
+
+
+def run_workers(num_processes: int, settings: Settings) -> None:
+    context = multiprocessing.get_context("spawn")
+    stop_event = context.Event()
+
+    def request_stop(signum: int, _frame: FrameType | None) -> None:
+        logger.info("Received %s, stopping after the running jobs", signal.Signals(signum).name)
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    session_maker = sessionmaker(bind=get_db())
+    processes: dict[int, BaseProcess] = {}
+    try:
+        while not stop_event.is_set():
+            for index in range(num_processes):
+                process = processes.get(index)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.warning("Worker %s exited with code %s, restarting it", process.name, process.exitcode)
+                process = context.Process(target=worker_process, args=(stop_event,), name=f"job-worker-{index}")
+                process.start()
+                processes[index] = process
+
+            with session_scope(session_maker) as session:
+                recovered = recover_orphaned_jobs(
+                    session, timedelta(seconds=settings.job_heartbeat_timeout_seconds), settings.job_max_attempts
+                )
+                recovered_shards = recover_orphaned_shards(
+                    session, timedelta(seconds=settings.job_heartbeat_timeout_seconds), settings.job_max_attempts
+                )
+            if recovered:
+                logger.warning("Recovered %s template matching jobs orphaned by crashed workers", recovered)
+            if recovered_shards:
+                logger.warning("Recovered %s shards orphaned by crashed workers", recovered_shards)
+            stop_event.wait(settings.job_heartbeat_interval_seconds)
+    finally:
+        stop_event.set()
+        for process in processes.values():
+            process.join()
+        dispose_db()
+
+
+def main() -> None:
+    settings = get_settings()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=settings.job_workers)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    run_workers(args.processes, settings)
+
+
+if __name__ == '__main__':
+    main()
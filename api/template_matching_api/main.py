@@ -1,13 +1,34 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import anyio.to_thread
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import AnyHttpUrl
 
 from template_matching_api.api.api import api_router
+from template_matching_api.api.dependencies import get_job_event_broker
+from template_matching_api.db import dispose_async_db, dispose_db
+from template_matching_api.derivatives import shutdown_process_pool
+from template_matching_api.settings import get_settings
 
 BACKEND_CORS_ORIGINS: list[AnyHttpUrl] = [
     "http://localhost:5173",  # type: ignore
 ]
-app = FastAPI(title="Template matching management API")
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI) -> AsyncIterator[None]:
+    # Only blocking code paths (file IO, sync dependencies) run in this pool, async endpoints stay on the event loop
+    anyio.to_thread.current_default_thread_limiter().total_tokens = get_settings().threadpool_size
+    yield
+    await get_job_event_broker().close()
+    shutdown_process_pool()
+    await dispose_async_db()
+    dispose_db()
+
+
+app = FastAPI(title="Template matching management API", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[str(origin).rstrip("/") for origin in BACKEND_CORS_ORIGINS],
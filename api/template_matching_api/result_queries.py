@@ -0,0 +1,137 @@
+"""Filtering, top-k and cursor pagination of stored job results.
+
+Everything is computed per template on the memory-mapped result columns, only the columns of the templates a page
+reaches are read. Pages are cut at `limit` sample results and may end within a template, the next page then continues
+with the rest of its sample results.
+"""
+import base64
+import binascii
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+import numpy as np
+import numpy.typing as npt
+
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.result_storage import (
+    FILE_TYPES,
+    JobResultColumns,
+    ResultSelection,
+    Rows,
+    count_rows,
+    slice_rows,
+)
+
+
+class InvalidCursorError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ResultQuery:
+    # Only the `top_k` best scoring sample results of every template, best first
+    top_k: int | None = None
+    min_score: float | None = None
+    file_type: FileType | None = None
+    # Inclusive, like the dates of a `DataSpecification`
+    date_from: date | None = None
+    date_to: date | None = None
+
+    @property
+    def filters_rows(self) -> bool:
+        return any(
+            value is not None
+            for value in (self.top_k, self.min_score, self.file_type, self.date_from, self.date_to)
+        )
+
+    def fingerprint(self) -> str:
+        return hashlib.blake2b(repr(self).encode(), digest_size=8).hexdigest()
+
+
+@dataclass(frozen=True)
+class ResultPage:
+    selection: ResultSelection
+    # Cursor of the following page, None for the last one
+    next_cursor: str | None
+
+
+def encode_cursor(run_id: str, query: ResultQuery, template_idx: int, offset: int) -> str:
+    payload = {"run": run_id, "query": query.fingerprint(), "template": template_idx, "offset": offset}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor: str, run_id: str, query: ResultQuery) -> tuple[int, int]:
+    """Template index and offset within its selected rows where the page starts"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        template_idx, offset = int(payload["template"]), int(payload["offset"])
+        cursor_run_id, fingerprint = payload["run"], payload["query"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursorError("Malformed cursor")
+    if cursor_run_id != run_id:
+        raise InvalidCursorError("Cursor belongs to results of another run of the job")
+    if fingerprint != query.fingerprint():
+        raise InvalidCursorError("Cursor was issued for different query parameters")
+    if template_idx < 0 or offset < 0:
+        raise InvalidCursorError("Malformed cursor")
+    return template_idx, offset
+
+
+def select_template_rows(columns: JobResultColumns, query: ResultQuery, template_idx: int) -> Rows:
+    rows = columns.template_rows(template_idx)
+    if not query.filters_rows:
+        return rows
+
+    mask = np.ones(count_rows(rows), dtype=bool)
+    if query.min_score is not None:
+        mask &= columns.score[rows] >= query.min_score
+    if query.file_type is not None:
+        mask &= columns.file_type[rows] == FILE_TYPES.index(query.file_type)
+    if query.date_from is not None:
+        mask &= columns.created_at[rows] >= np.datetime64(query.date_from, "s")
+    if query.date_to is not None:
+        mask &= columns.created_at[rows] < np.datetime64(query.date_to + timedelta(days=1), "s")
+    selected: npt.NDArray[np.int64] = np.flatnonzero(mask) + rows.start
+
+    if query.top_k is not None:
+        scores = columns.score[selected]
+        if query.top_k < len(selected):
+            # Partial sort, only the k best are ordered below
+            best = np.argpartition(-scores, query.top_k - 1)[: query.top_k]
+            selected, scores = selected[best], scores[best]
+        # Ties keep the stored order of the rows
+        selected = selected[np.lexsort((selected, -scores))]
+    return selected
+
+
+def select_results(
+    columns: JobResultColumns,
+    query: ResultQuery,
+    run_id: str,
+    cursor: str | None = None,
+    limit: int | None = None,
+) -> ResultPage:
+    """Page of the results matching `query`, of at most `limit` sample results"""
+    start_template_idx, start_offset = (0, 0) if cursor is None else decode_cursor(cursor, run_id, query)
+    num_templates = len(columns.templates)
+    if start_template_idx > num_templates:
+        raise InvalidCursorError("Cursor is out of range")
+
+    selection: list[tuple[int, Rows]] = []
+    remaining = limit
+    for template_idx in range(start_template_idx, num_templates):
+        if remaining == 0:
+            return ResultPage(selection, encode_cursor(run_id, query, template_idx, 0))
+        rows = select_template_rows(columns, query, template_idx)
+        offset = start_offset if template_idx == start_template_idx else 0
+        rows = slice_rows(rows, offset, count_rows(rows))
+        template_id = int(columns.templates[template_idx])
+        if remaining is not None and count_rows(rows) > remaining:
+            selection.append((template_id, slice_rows(rows, 0, remaining)))
+            return ResultPage(selection, encode_cursor(run_id, query, template_idx, offset + remaining))
+        selection.append((template_id, rows))
+        if remaining is not None:
+            remaining -= count_rows(rows)
+    return ResultPage(selection, None)
@@ -0,0 +1,145 @@
+"""Score histograms, percentiles and counts of stored job results for dashboards.
+
+Computed vectorized over the whole result columns, per template statistics use the contiguous template rows rather
+than a loop over templates. Results of a run never change, so the statistics are cached next to the run.
+"""
+import hashlib
+from dataclasses import dataclass
+
+import numpy as np
+import numpy.typing as npt
+
+from template_matching_api.api_models.template_matching_job import (
+    ScoreHistogram,
+    ScorePercentile,
+    ScoreStats,
+    TemplateMatchingJobResultStats,
+    TemplateResultStats,
+)
+from template_matching_api.result_storage import FILE_TYPES, JobResultColumns
+
+
+@dataclass(frozen=True)
+class StatsQuery:
+    bins: int = 10
+    percentiles: tuple[float, ...] = (50.0, 90.0, 99.0)
+    # Sample results scored outside of the range are not counted in the histograms
+    range_min: float = 0.0
+    range_max: float = 1.0
+
+    def cache_name(self) -> str:
+        return f"stats-{hashlib.blake2b(repr(self).encode(), digest_size=8).hexdigest()}.json"
+
+
+def _grouped_percentiles(
+    sorted_scores: npt.NDArray[np.float64], offsets: npt.NDArray[np.int64], percentiles: tuple[float, ...]
+) -> npt.NDArray[np.float64]:
+    """Percentiles (linearly interpolated like `np.percentile`) of every group of rows, NaN for empty groups"""
+    counts = np.diff(offsets)
+    positions = np.asarray(percentiles, dtype=np.float64)[None, :] / 100 * np.maximum(counts - 1, 0)[:, None]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    last_row = max(len(sorted_scores) - 1, 0)
+    lower_idx = np.minimum(offsets[:-1, None] + lower, last_row)
+    upper_idx = np.minimum(offsets[:-1, None] + upper, last_row)
+    if not len(sorted_scores):
+        return np.full(positions.shape, np.nan)
+    values: npt.NDArray[np.float64] = (
+        sorted_scores[lower_idx] + (sorted_scores[upper_idx] - sorted_scores[lower_idx]) * (positions - lower)
+    )
+    values[counts == 0] = np.nan
+    return values
+
+
+def _optional(value: float) -> float | None:
+    return None if np.isnan(value) else float(value)
+
+
+def _score_stats(
+    count: int,
+    min_score: float,
+    max_score: float,
+    mean_score: float,
+    percentiles: npt.NDArray[np.float64],
+    histogram: npt.NDArray[np.int64],
+    query: StatsQuery,
+    bin_edges: list[float],
+) -> ScoreStats:
+    return ScoreStats(
+        count=count,
+        min_score=_optional(min_score),
+        max_score=_optional(max_score),
+        mean_score=_optional(mean_score),
+        percentiles=[
+            ScorePercentile(percentile=percentile, score=_optional(score))
+            for percentile, score in zip(query.percentiles, percentiles.tolist())
+        ],
+        histogram=ScoreHistogram(bin_edges=bin_edges, counts=histogram.tolist()),
+    )
+
+
+def compute_result_stats(columns: JobResultColumns, query: StatsQuery) -> TemplateMatchingJobResultStats:
+    num_templates = len(columns.templates)
+    counts = np.diff(columns.offsets)
+    template_idx = np.repeat(np.arange(num_templates), counts)
+    scores = np.asarray(columns.score, dtype=np.float64)
+
+    # Rows are grouped by template already, sorting by score within the groups keeps the groups in place
+    sorted_scores = scores[np.lexsort((scores, template_idx))]
+    group_offsets = np.asarray(columns.offsets)
+    nonempty = counts > 0
+    template_min = np.full(num_templates, np.nan)
+    template_max = np.full(num_templates, np.nan)
+    template_min[nonempty] = sorted_scores[group_offsets[:-1][nonempty]]
+    template_max[nonempty] = sorted_scores[group_offsets[1:][nonempty] - 1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        template_mean = np.bincount(template_idx, weights=scores, minlength=num_templates) / counts
+    template_percentiles = _grouped_percentiles(sorted_scores, group_offsets, query.percentiles)
+
+    bin_idx = np.floor((scores - query.range_min) / (query.range_max - query.range_min) * query.bins)
+    bin_idx[scores == query.range_max] = query.bins - 1
+    in_range = (bin_idx >= 0) & (bin_idx < query.bins)
+    template_histograms = np.bincount(
+        template_idx[in_range] * query.bins + bin_idx[in_range].astype(np.int64), minlength=num_templates * query.bins
+    ).reshape(num_templates, query.bins)
+    bin_edges = np.linspace(query.range_min, query.range_max, query.bins + 1).tolist()
+
+    num_results = len(scores)
+    overall_percentiles = _grouped_percentiles(
+        np.sort(scores), np.array([0, num_results], dtype=np.int64), query.percentiles
+    )[0]
+    file_type_counts = np.bincount(columns.file_type, minlength=len(FILE_TYPES))
+    days = np.asarray(columns.created_at).astype("datetime64[D]")
+    unique_days, day_counts = np.unique(days[~np.isnat(days)], return_counts=True)
+
+    overall = _score_stats(
+        num_results,
+        float(sorted_scores.min()) if num_results else np.nan,
+        float(sorted_scores.max()) if num_results else np.nan,
+        float(scores.mean()) if num_results else np.nan,
+        overall_percentiles,
+        template_histograms.sum(axis=0),
+        query,
+        bin_edges,
+    )
+    return TemplateMatchingJobResultStats(
+        **overall.model_dump(),
+        count_per_file_type=dict(zip(FILE_TYPES, file_type_counts.tolist())),
+        count_per_day=dict(zip(unique_days.tolist(), day_counts.tolist())),
+        per_template=[
+            TemplateResultStats(
+                template_id=template_id,
+                **_score_stats(
+                    int(counts[idx]),
+                    template_min[idx],
+                    template_max[idx],
+                    template_mean[idx],
+                    template_percentiles[idx],
+                    template_histograms[idx],
+                    query,
+                    bin_edges,
+                ).model_dump(),
+            )
+            for idx, template_id in enumerate(columns.templates.tolist())
+        ],
+    )
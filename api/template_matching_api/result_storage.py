@@ -0,0 +1,366 @@
+"""Results of template matching job runs, written once by the job worker and memory-mapped on read.
+
+A run is a directory of fixed-width columns with one row per sample result, rows of a template are contiguous:
+
+    results/<job id>/<run id>/
+        template_id.npy   int64
+        sample_id.npy     int64
+        score.npy         float32
+        file_type.npy     uint8, index into `FILE_TYPES`
+        created_at.npy    datetime64[s]
+        templates.npy     int64, template ids in result order
+        offsets.npy       int64, the rows of `templates[i]` are `offsets[i]:offsets[i + 1]`
+        meta.json
+        aggregates/       data computed from the results on demand, e.g. statistics
+    results/<job id>/partials/<key>/
+                          columns of a single template, reused by later runs of the job with the same inputs
+
+Runs are written to a temporary directory and renamed into place, readers never see a partially written run.
+"""
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass, fields
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Literal
+
+import numpy as np
+import numpy.typing as npt
+import orjson
+
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.api_models.template_matching_job import TemplateMatchingJobResults
+from template_matching_api.settings import STORAGE_LOCATION, Settings
+
+FILE_TYPES = tuple(FileType)
+_FILE_TYPE_NAMES = tuple(file_type.value for file_type in FILE_TYPES)
+META_NAME = "meta.json"
+AGGREGATES_DIR = "aggregates"
+PARTIALS_DIR = "partials"
+FORMAT_VERSION = 1
+_TMP_PREFIX = ".run-"
+# Sample results rendered at once by the JSON encoder
+ENCODE_CHUNK_ROWS = 64 * 1024
+
+
+# Sample results of one template, a contiguous range of rows or the indices of selected rows in output order
+Rows = slice | npt.NDArray[np.int64]
+# Templates with the rows of their sample results to output
+ResultSelection = Iterable[tuple[int, Rows]]
+
+
+def count_rows(rows: Rows) -> int:
+    return rows.stop - rows.start if isinstance(rows, slice) else len(rows)
+
+
+def slice_rows(rows: Rows, start: int, stop: int) -> Rows:
+    """The `start:stop` part of `rows`, positions are relative to the first of `rows`"""
+    if isinstance(rows, slice):
+        return slice(min(rows.start + start, rows.stop), min(rows.start + stop, rows.stop))
+    return rows[start:stop]
+
+
+class ResultsNotFoundError(Exception):
+    def __init__(self, job_id: int, run_id: str) -> None:
+        super().__init__(f"No stored results for run {run_id} of template matching job {job_id}")
+        self.job_id = job_id
+        self.run_id = run_id
+
+
+@dataclass(frozen=True)
+class JobResultColumns:
+    template_id: npt.NDArray[np.int64]
+    sample_id: npt.NDArray[np.int64]
+    score: npt.NDArray[np.float32]
+    file_type: npt.NDArray[np.uint8]
+    created_at: npt.NDArray[np.datetime64]
+    templates: npt.NDArray[np.int64]
+    offsets: npt.NDArray[np.int64]
+    total_run_time: int
+
+    @property
+    def num_results(self) -> int:
+        return len(self.sample_id)
+
+    def template_rows(self, template_idx: int) -> slice:
+        return slice(int(self.offsets[template_idx]), int(self.offsets[template_idx + 1]))
+
+    def iter_templates(self) -> Iterator[tuple[int, slice]]:
+        """Template ids with the rows of their sample results"""
+        for template_idx, template_id in enumerate(self.templates.tolist()):
+            yield template_id, self.template_rows(template_idx)
+
+    @classmethod
+    def from_results(cls, results: TemplateMatchingJobResults) -> "JobResultColumns":
+        rows: dict[str, list[Any]] = {
+            "template_id": [], "sample_id": [], "score": [], "file_type": [], "created_at": []
+        }
+        offsets = [0]
+        file_type_codes = {file_type: code for code, file_type in enumerate(FILE_TYPES)}
+        for template_results in results.results_per_template:
+            for sample_result in template_results.sample_results:
+                rows["template_id"].append(template_results.template_id)
+                rows["sample_id"].append(sample_result.sample_id)
+                rows["score"].append(sample_result.score)
+                rows["file_type"].append(file_type_codes[getattr(sample_result, "file_type", FileType.IMAGE)])
+                rows["created_at"].append(getattr(sample_result, "created_at", None))
+            offsets.append(len(rows["sample_id"]))
+        return cls(
+            template_id=np.array(rows["template_id"], dtype=np.int64),
+            sample_id=np.array(rows["sample_id"], dtype=np.int64),
+            score=np.array(rows["score"], dtype=np.float32),
+            file_type=np.array(rows["file_type"], dtype=np.uint8),
+            created_at=np.array(rows["created_at"], dtype="datetime64[s]"),
+            templates=np.array(
+                [template_results.template_id for template_results in results.results_per_template], dtype=np.int64
+            ),
+            offsets=np.array(offsets, dtype=np.int64),
+            total_run_time=results.total_run_time,
+        )
+
+
+_COLUMN_NAMES = tuple(field.name for field in fields(JobResultColumns) if field.name != "total_run_time")
+
+
+def concat_columns(parts: list[JobResultColumns]) -> JobResultColumns:
+    """Results of the templates of all `parts` in order, the run times add up"""
+    if not parts:
+        return JobResultColumns.from_results(TemplateMatchingJobResults(results_per_template=[], total_run_time=0))
+    row_offsets = np.cumsum([0] + [part.num_results for part in parts[:-1]], dtype=np.int64)
+    return JobResultColumns(
+        **{
+            name: np.concatenate([getattr(part, name) for part in parts])
+            for name in _COLUMN_NAMES
+            if name != "offsets"
+        },
+        offsets=np.concatenate(
+            [np.zeros(1, dtype=np.int64)]
+            + [part.offsets[1:] + row_offset for part, row_offset in zip(parts, row_offsets)]
+        ),
+        total_run_time=sum(part.total_run_time for part in parts),
+    )
+
+
+class JobResultStorage:
+    def __init__(self, root: Path | None = None) -> None:
+        self.location = (root or STORAGE_LOCATION) / "results"
+
+    def _get_location_for_job(self, job_id: int) -> Path:
+        return self.location / str(job_id)
+
+    def _get_location_for_run(self, job_id: int, run_id: str) -> Path:
+        return self._get_location_for_job(job_id) / run_id
+
+    def _get_location_for_partial(self, job_id: int, key: str) -> Path:
+        return self._get_location_for_job(job_id) / PARTIALS_DIR / key
+
+    def _create_tmp_run(self, job_id: int) -> Path:
+        job_location = self._get_location_for_job(job_id)
+        os.makedirs(job_location, exist_ok=True)
+        return Path(tempfile.mkdtemp(dir=job_location, prefix=_TMP_PREFIX))
+
+    def _install(self, tmp_location: Path, location: Path) -> None:
+        try:
+            os.rename(tmp_location, location)
+        except OSError:
+            shutil.rmtree(tmp_location, ignore_errors=True)
+            # A recovered run may have been completed by two workers, the results written first are kept
+            if not location.is_dir():
+                raise
+
+    def _write(self, job_id: int, location: Path, columns: JobResultColumns) -> None:
+        tmp_location = self._create_tmp_run(job_id)
+        try:
+            for name in _COLUMN_NAMES:
+                np.save(tmp_location / f"{name}.npy", getattr(columns, name), allow_pickle=False)
+            (tmp_location / META_NAME).write_text(
+                json.dumps({"version": FORMAT_VERSION, "total_run_time": columns.total_run_time})
+            )
+        except BaseException:
+            shutil.rmtree(tmp_location, ignore_errors=True)
+            raise
+        self._install(tmp_location, location)
+
+    def _read(self, location: Path) -> JobResultColumns:
+        meta = json.loads((location / META_NAME).read_text())
+        arrays = {
+            name: np.load(location / f"{name}.npy", mmap_mode="r", allow_pickle=False) for name in _COLUMN_NAMES
+        }
+        return JobResultColumns(**arrays, total_run_time=meta["total_run_time"])
+
+    def save(self, job_id: int, run_id: str, columns: JobResultColumns) -> None:
+        self._write(job_id, self._get_location_for_run(job_id, run_id), columns)
+
+    def link_run(self, source_job_id: int, source_run_id: str, job_id: int, run_id: str) -> None:
+        """Reuse the results of another run as the results of `run_id`, the files are hard links if possible"""
+        source_location = self._get_location_for_run(source_job_id, source_run_id)
+        tmp_location = self._create_tmp_run(job_id)
+        try:
+            for name in (*(f"{column_name}.npy" for column_name in _COLUMN_NAMES), META_NAME):
+                try:
+                    os.link(source_location / name, tmp_location / name)
+                except FileNotFoundError:
+                    raise
+                except OSError:
+                    # e.g. a filesystem without hard links
+                    shutil.copyfile(source_location / name, tmp_location / name)
+        except FileNotFoundError:
+            shutil.rmtree(tmp_location, ignore_errors=True)
+            raise ResultsNotFoundError(source_job_id, source_run_id)
+        except BaseException:
+            shutil.rmtree(tmp_location, ignore_errors=True)
+            raise
+        self._install(tmp_location, self._get_location_for_run(job_id, run_id))
+
+    def load(self, job_id: int, run_id: str) -> JobResultColumns:
+        """Columns are memory-mapped, only the rows that are read are paged in"""
+        try:
+            return self._read(self._get_location_for_run(job_id, run_id))
+        except FileNotFoundError:
+            raise ResultsNotFoundError(job_id, run_id)
+
+    def save_partial(self, job_id: int, key: str, columns: JobResultColumns) -> None:
+        """Results of a single template, `key` identifies the inputs they were computed from"""
+        partials_location = self._get_location_for_job(job_id) / PARTIALS_DIR
+        os.makedirs(partials_location, exist_ok=True)
+        self._write(job_id, partials_location / key, columns)
+
+    def load_partial(self, job_id: int, key: str) -> JobResultColumns | None:
+        try:
+            return self._read(self._get_location_for_partial(job_id, key))
+        except FileNotFoundError:
+            return None
+
+    def prune_partials(self, job_id: int, keep_keys: Iterable[str]) -> None:
+        """Remove the partial results no run of the job will reuse, e.g. of removed or re-uploaded templates"""
+        keep_keys = set(keep_keys)
+        try:
+            partial_locations = list((self._get_location_for_job(job_id) / PARTIALS_DIR).iterdir())
+        except FileNotFoundError:
+            return
+        for partial_location in partial_locations:
+            if partial_location.name not in keep_keys:
+                shutil.rmtree(partial_location, ignore_errors=True)
+
+    def load_aggregate(self, job_id: int, run_id: str, name: str) -> bytes | None:
+        """Data derived from the results of a run (e.g. statistics), None if it was not saved yet"""
+        try:
+            return (self._get_location_for_run(job_id, run_id) / AGGREGATES_DIR / name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def save_aggregate(self, job_id: int, run_id: str, name: str, data: bytes) -> None:
+        run_location = self._get_location_for_run(job_id, run_id)
+        if not (run_location / META_NAME).exists():
+            # The run was pruned in the meantime
+            return
+        aggregate_location = run_location / AGGREGATES_DIR / name
+        os.makedirs(aggregate_location.parent, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=aggregate_location.parent, prefix=f".{name}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_name, aggregate_location)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+    def prune(self, job_id: int, keep_run_id: str) -> None:
+        """Remove the results of every other finished run of the job, partial results are kept"""
+        try:
+            run_locations = list(self._get_location_for_job(job_id).iterdir())
+        except FileNotFoundError:
+            return
+        for run_location in run_locations:
+            if run_location.name not in (keep_run_id, PARTIALS_DIR) and not run_location.name.startswith(_TMP_PREFIX):
+                shutil.rmtree(run_location, ignore_errors=True)
+
+    def delete(self, job_id: int) -> None:
+        shutil.rmtree(self._get_location_for_job(job_id), ignore_errors=True)
+
+
+def _json_tokens(values: npt.NDArray[Any]) -> list[str]:
+    # orjson renders the whole column in one call (floats in their shortest round-tripping form)
+    if not len(values):
+        return []
+    return orjson.dumps(np.asarray(values), option=orjson.OPT_SERIALIZE_NUMPY).decode()[1:-1].split(",")
+
+
+def _encode_sample_results(
+    columns: JobResultColumns, rows: Rows, object_start: str = '{"sample_id":', separator: str = ","
+) -> str:
+    created_at = columns.created_at[rows]
+    file_type = columns.file_type[rows]
+    # Samples share few distinct (created_at, file_type) pairs, the end of each JSON object is rendered once per pair
+    dates, date_idx = np.unique(created_at, return_inverse=True)
+    tails = [
+        f',"created_at":"{date}","file_type":"{file_type_name}"}}'
+        for date in np.datetime_as_string(dates, unit="s").tolist()
+        for file_type_name in _FILE_TYPE_NAMES
+    ]
+    tail_idx = date_idx.reshape(-1) * len(FILE_TYPES) + file_type
+
+    num_rows = len(created_at)
+    parts: list[str] = [separator + object_start] * (5 * num_rows)
+    parts[1::5] = _json_tokens(columns.sample_id[rows])
+    parts[2::5] = [',"score":'] * num_rows
+    parts[3::5] = _json_tokens(columns.score[rows])
+    parts[4::5] = np.array(tails, dtype=object)[tail_idx].tolist()
+    # Without the separator in front of the first object
+    return "".join(parts)[len(separator):]
+
+
+def _iter_chunks(rows: Rows, chunk_rows: int) -> Iterator[Rows]:
+    for chunk_start in range(0, count_rows(rows), chunk_rows):
+        yield slice_rows(rows, chunk_start, chunk_start + chunk_rows)
+
+
+def iter_encoded_results(
+    columns: JobResultColumns, selection: ResultSelection | None = None, chunk_rows: int = ENCODE_CHUNK_ROWS
+) -> Iterator[bytes]:
+    """JSON document of `TemplateMatchingJobResults` in chunks of at most `chunk_rows` sample results.
+
+    Only the `selection` of the results is encoded if given. Every column is rendered with one vectorized call per
+    chunk, no Python object is created per sample result.
+    """
+    yield b'{"results_per_template":['
+    for template_idx, (template_id, rows) in enumerate(columns.iter_templates() if selection is None else selection):
+        yield f'{"," if template_idx else ""}{{"template_id":{template_id},"sample_results":['.encode()
+        for chunk_idx, chunk in enumerate(_iter_chunks(rows, chunk_rows)):
+            yield f'{"," if chunk_idx else ""}{_encode_sample_results(columns, chunk)}'.encode()
+        yield b"]}"
+    yield f'],"total_run_time":{columns.total_run_time}}}'.encode()
+
+
+def encode_results(columns: JobResultColumns, selection: ResultSelection | None = None) -> bytes:
+    return b"".join(iter_encoded_results(columns, selection))
+
+
+def iter_ndjson_results(
+    columns: JobResultColumns,
+    selection: ResultSelection | None = None,
+    record: Literal["sample", "chunk"] = "chunk",
+    chunk_rows: int = ENCODE_CHUNK_ROWS,
+) -> Iterator[bytes]:
+    """Newline delimited JSON of the results (or their `selection`), rendered lazily `chunk_rows` at a time.
+
+    With `record="sample"` every line is one sample result with its `template_id`. With `record="chunk"` every line
+    is a `TemplateMatchingJobTempLateResults` of at most `chunk_rows` sample results, templates without any sample
+    results get one line with empty `sample_results`.
+    """
+    for template_id, rows in columns.iter_templates() if selection is None else selection:
+        if not count_rows(rows) and record == "chunk":
+            yield f'{{"template_id":{template_id},"sample_results":[]}}\n'.encode()
+        for chunk in _iter_chunks(rows, chunk_rows):
+            if record == "sample":
+                object_start = f'{{"template_id":{template_id},"sample_id":'
+                lines = _encode_sample_results(columns, chunk, object_start, separator="\n")
+                yield f"{lines}\n".encode()
+            else:
+                sample_results = _encode_sample_results(columns, chunk)
+                yield f'{{"template_id":{template_id},"sample_results":[{sample_results}]}}\n'.encode()
+
+
+def create_result_storage(settings: Settings) -> JobResultStorage:
+    return JobResultStorage(root=settings.storage_location)
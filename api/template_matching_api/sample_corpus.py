@@ -0,0 +1,395 @@
+"""Local catalog of the samples templates are matched against, partitioned by file type and day.
+
+Samples are float32 grayscale arrays in [0, 1] (like the `grayscale.npy` derivative of templates). Every ingestion
+writes immutable segments of samples of equal size to their partition, `<root>/<file type>/<YYYY-MM-DD>/`:
+
+    <segment>.ids.npy     sample ids
+    <segment>.images.npy  (samples, height, width) images, memory-mapped when read
+    manifest.bin          one fixed-size record per segment
+
+and then appends the records of its segments to the partition's manifest, so new samples never rewrite the index or
+existing segments. Reading a data specification looks up the selected days in the sorted days of the selected file
+types, and reads the manifests and segments of those days only. Day lists and manifests are cached until they change,
+the cost follows the selected samples rather than the size of the corpus. Segments only become visible once their
+record is appended, a crashed ingestion leaves unreferenced files behind at worst.
+
+Ingesting samples one by one leaves many small segments, which are merged by size-tiered compaction: once a partition
+has `compaction_fanout` segments of the same image size and about the same number of samples, they are merged into one.
+Every sample is thus rewritten a logarithmic number of times until its segment reaches `max_segment_bytes`. Appends and
+compactions of a partition are serialized by an flock, the compacted manifest atomically replaces the previous one.
+Replaced segments are removed by a later compaction after `segment_grace_period`, readers of the previous manifest can
+still open them until then.
+"""
+import bisect
+import fcntl
+import hashlib
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Generator, Iterator
+
+import numpy as np
+import numpy.typing as npt
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.result_storage import FILE_TYPES
+from template_matching_api.settings import Settings
+
+MANIFEST_NAME = "manifest.bin"
+LOCK_NAME = ".lock"
+# One record per segment, little endian and unpadded so that the file format does not depend on the platform
+MANIFEST_DTYPE = np.dtype([
+    ("segment", "<u8"),
+    ("day", "<M8[D]"),
+    ("file_type", "u1"),
+    ("height", "<u4"),
+    ("width", "<u4"),
+    ("count", "<u4"),
+])
+COMPACTION_FANOUT = 8
+MAX_SEGMENT_BYTES = 256 * 1024 * 1024
+SEGMENT_GRACE_PERIOD = timedelta(hours=1)
+
+
+@dataclass(frozen=True)
+class SampleBatch:
+    sample_id: npt.NDArray[np.int64]
+    file_type: npt.NDArray[np.uint8]
+    created_at: npt.NDArray[np.datetime64]
+    # (samples, height, width)
+    images: npt.NDArray[np.float32]
+
+    def __len__(self) -> int:
+        return len(self.sample_id)
+
+
+def _save_array(location: Path, array: npt.NDArray[np.generic]) -> None:
+    fd, tmp_name = tempfile.mkstemp(dir=location.parent, prefix=f".{location.name}.")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            np.save(tmp_file, array)
+        os.replace(tmp_name, location)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def _segment_bytes(records: npt.NDArray[np.void]) -> npt.NDArray[np.int64]:
+    images_bytes: npt.NDArray[np.int64] = (
+        records["count"].astype(np.int64) * records["height"] * records["width"] * np.dtype(np.float32).itemsize
+    )
+    return images_bytes
+
+
+class LocalSampleCorpus:
+    def __init__(
+        self,
+        root: Path,
+        compaction_fanout: int = COMPACTION_FANOUT,
+        max_segment_bytes: int = MAX_SEGMENT_BYTES,
+        segment_grace_period: timedelta = SEGMENT_GRACE_PERIOD,
+    ) -> None:
+        self.root = root
+        self.compaction_fanout = compaction_fanout
+        self.max_segment_bytes = max_segment_bytes
+        self.segment_grace_period = segment_grace_period
+        # Manifests by location, with the (inode, size, mtime) they were read at
+        self._manifests: dict[Path, tuple[tuple[int, int, int], npt.NDArray[np.void]]] = {}
+        # Sorted days of the partitions by file type, with the (inode, mtime) of its directory they were listed at
+        self._days_by_file_type: dict[FileType, tuple[tuple[int, int], list[date]]] = {}
+
+    def _partition(self, file_type: FileType, day: date) -> Path:
+        return self.root / file_type.value / day.isoformat()
+
+    def manifest_location(self, file_type: FileType, day: date) -> Path:
+        return self._partition(file_type, day) / MANIFEST_NAME
+
+    def _segment_files(self, file_type: FileType, day: date, segment: int) -> tuple[Path, Path]:
+        """Locations of the sample ids and of the images of a segment"""
+        partition = self._partition(file_type, day)
+        return partition / f"{segment:016x}.ids.npy", partition / f"{segment:016x}.images.npy"
+
+    @contextmanager
+    def _lock_partition(self, file_type: FileType, day: date) -> Generator[None, None, None]:
+        with open(self._partition(file_type, day) / LOCK_NAME, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def add_samples(
+        self, file_type: FileType, day: date, sample_ids: list[int], images: list[npt.NDArray[np.float32]]
+    ) -> None:
+        """Ingest samples created on `day`, one segment per image size"""
+        by_size: dict[tuple[int, ...], list[int]] = {}
+        for idx, image in enumerate(images):
+            by_size.setdefault(image.shape, []).append(idx)
+
+        records = np.zeros(len(by_size), dtype=MANIFEST_DTYPE)
+        os.makedirs(self._partition(file_type, day), exist_ok=True)
+        for record_idx, ((height, width), indices) in enumerate(by_size.items()):
+            # Random rather than sequential, concurrent ingestions need no coordination
+            segment = random.getrandbits(64)
+            ids_location, images_location = self._segment_files(file_type, day, segment)
+            _save_array(ids_location, np.array([sample_ids[idx] for idx in indices], dtype=np.int64))
+            _save_array(images_location, np.stack([np.asarray(images[idx], dtype=np.float32) for idx in indices]))
+            records[record_idx] = (
+                segment, np.datetime64(day, "D"), FILE_TYPES.index(file_type), height, width, len(indices)
+            )
+
+        with self._lock_partition(file_type, day):
+            fd = os.open(self.manifest_location(file_type, day), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, records.tobytes())
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._compact(file_type, day)
+
+    def add(self, sample_id: int, file_type: FileType, created_at: date, image: npt.NDArray[np.float32]) -> None:
+        self.add_samples(file_type, created_at, [sample_id], [image])
+
+    def load_manifest(self, file_type: FileType, day: date) -> npt.NDArray[np.void]:
+        location = self.manifest_location(file_type, day)
+        try:
+            stat = os.stat(location)
+        except FileNotFoundError:
+            return np.zeros(0, dtype=MANIFEST_DTYPE)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._manifests.get(location)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        try:
+            manifest_bytes = location.read_bytes()
+        except FileNotFoundError:
+            return np.zeros(0, dtype=MANIFEST_DTYPE)
+        # A record being appended concurrently is not complete yet
+        complete = len(manifest_bytes) // MANIFEST_DTYPE.itemsize * MANIFEST_DTYPE.itemsize
+        manifest = np.frombuffer(manifest_bytes[:complete], dtype=MANIFEST_DTYPE)
+        self._manifests[location] = (key, manifest)
+        return manifest
+
+    def _days(self, file_type: FileType) -> list[date]:
+        """Sorted days of the partitions of a file type, cached until a partition is added"""
+        location = self.root / file_type.value
+        try:
+            stat = os.stat(location)
+        except FileNotFoundError:
+            return []
+        # Creating a day partition changes the mtime of its parent directory
+        key = (stat.st_ino, stat.st_mtime_ns)
+        cached = self._days_by_file_type.get(file_type)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        days = []
+        with os.scandir(location) as entries:
+            for entry in entries:
+                try:
+                    days.append(date.fromisoformat(entry.name))
+                except ValueError:
+                    continue
+        days.sort()
+        self._days_by_file_type[file_type] = (key, days)
+        return days
+
+    def _selected_partitions(self, data_specification: DataSpecification) -> list[tuple[FileType, date]]:
+        """Existing partitions of the data specification, by file type and day"""
+        # Unlike the mock results, the corpus is not limited to recent days, missing bounds select all of them
+        date_from = data_specification.date_from or date.min
+        date_to = data_specification.date_to or date.max
+        file_types = FILE_TYPES if data_specification.file_type is None else (data_specification.file_type,)
+        partitions: list[tuple[FileType, date]] = []
+        for file_type in file_types:
+            days = self._days(file_type)
+            selected = days[bisect.bisect_left(days, date_from) : bisect.bisect_right(days, date_to)]
+            partitions.extend((file_type, day) for day in selected)
+        return partitions
+
+    def select_segments(self, data_specification: DataSpecification) -> npt.NDArray[np.void]:
+        """Manifest records of the partitions the data specification selects, by file type, day and ingestion"""
+        manifests = [
+            self.load_manifest(file_type, day) for file_type, day in self._selected_partitions(data_specification)
+        ]
+        return np.concatenate([np.zeros(0, dtype=MANIFEST_DTYPE), *manifests])
+
+    def version(self, data_specification: DataSpecification) -> str:
+        """Identifies the samples the data specification selects, it changes whenever samples are ingested into them"""
+        segments = self.select_segments(data_specification)
+        digest = hashlib.sha256()
+        # Samples are only ever added, so the number of samples of every selected partition tells them apart
+        partition_keys = segments["day"].astype("<i8") * len(FILE_TYPES) + segments["file_type"]
+        partitions, partition_idx = np.unique(partition_keys, return_inverse=True)
+        counts = np.bincount(partition_idx, weights=segments["count"], minlength=len(partitions)).astype("<u8")
+        digest.update(partitions.astype("<i8").tobytes())
+        digest.update(counts.tobytes())
+        return digest.hexdigest()
+
+    def iter_batches(self, data_specification: DataSpecification, batch_size: int) -> Iterator[SampleBatch]:
+        """Samples of the data specification in batches of at most `batch_size` samples of the same size"""
+        segments = self.select_segments(data_specification)
+        sizes = np.stack([segments["height"], segments["width"]], axis=1)
+        for size in np.unique(sizes, axis=0):
+            pending: list[SampleBatch] = []
+            num_pending = 0
+            for record in segments[(sizes == size).all(axis=1)]:
+                segment = self._load_segment(record)
+                start = 0
+                while start < len(segment):
+                    stop = min(len(segment), start + batch_size - num_pending)
+                    pending.append(_slice_batch(segment, start, stop))
+                    num_pending += stop - start
+                    start = stop
+                    if num_pending == batch_size:
+                        yield _concat_batches(pending)
+                        pending, num_pending = [], 0
+            if pending:
+                yield _concat_batches(pending)
+
+    def _load_segment(self, record: np.void) -> SampleBatch:
+        ids_location, images_location = self._segment_files(
+            FILE_TYPES[int(record["file_type"])], record["day"].item(), int(record["segment"])
+        )
+        count = int(record["count"])
+        return SampleBatch(
+            sample_id=np.load(ids_location),
+            file_type=np.full(count, record["file_type"], dtype=np.uint8),
+            created_at=np.full(count, record["day"], dtype="datetime64[s]"),
+            images=np.load(images_location, mmap_mode="r"),
+        )
+
+    def _compaction_groups(self, manifest: npt.NDArray[np.void]) -> list[npt.NDArray[np.intp]]:
+        """Indices of the records to merge into one segment each"""
+        segment_bytes = _segment_bytes(manifest)
+        candidates = np.flatnonzero(segment_bytes < self.max_segment_bytes)
+        # Tier 0 holds segments of less than `compaction_fanout` samples, tier 1 of less than its square...
+        tiers = np.zeros(len(candidates), dtype=np.int64)
+        counts = manifest["count"][candidates].astype(np.int64) // self.compaction_fanout
+        while counts.any():
+            tiers += counts > 0
+            counts //= self.compaction_fanout
+        keys = np.stack([manifest["height"][candidates], manifest["width"][candidates], tiers], axis=1)
+        groups = []
+        for key in np.unique(keys, axis=0):
+            tier_candidates = candidates[(keys == key).all(axis=1)]
+            if len(tier_candidates) < self.compaction_fanout:
+                continue
+            # In ingestion order, merged segments stay below `max_segment_bytes`
+            group: list[int] = []
+            group_bytes = 0
+            for idx in tier_candidates.tolist():
+                if group and group_bytes + int(segment_bytes[idx]) > self.max_segment_bytes:
+                    groups.append(np.array(group))
+                    group, group_bytes = [], 0
+                group.append(idx)
+                group_bytes += int(segment_bytes[idx])
+            groups.append(np.array(group))
+        return [group for group in groups if len(group) > 1]
+
+    def _compact(self, file_type: FileType, day: date) -> None:
+        """Merge the partition's segments of a tier once there are enough of them, the partition has to be locked"""
+        manifest = self.load_manifest(file_type, day)
+        compacted = manifest
+        replaced_segments: list[npt.NDArray[np.void]] = []
+        # Merged segments can complete the next tier, which is then merged as well
+        while groups := self._compaction_groups(compacted):
+            merged = {int(group[0]): self._merge_segments(file_type, day, compacted[group]) for group in groups}
+            replaced = {int(idx) for group in groups for idx in group[1:]}
+            replaced_segments.append(compacted[np.concatenate(groups)])
+            # Merged segments take the place of their first segment, samples keep the order they were ingested in
+            compacted = np.array(
+                [merged.get(idx, record) for idx, record in enumerate(compacted) if idx not in replaced],
+                dtype=MANIFEST_DTYPE,
+            )
+        if not replaced_segments:
+            return
+
+        manifest_location = self.manifest_location(file_type, day)
+        fd, tmp_name = tempfile.mkstemp(dir=manifest_location.parent, prefix=f".{MANIFEST_NAME}.")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(compacted.tobytes())
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_name, manifest_location)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+        # The grace period of the replaced segments starts now
+        now = time.time()
+        for record in np.concatenate(replaced_segments):
+            for location in self._segment_files(file_type, day, int(record["segment"])):
+                os.utime(location, (now, now))
+        self._remove_unreferenced_segments(file_type, day, compacted)
+
+    def _merge_segments(self, file_type: FileType, day: date, records: npt.NDArray[np.void]) -> np.void:
+        segment = random.getrandbits(64)
+        ids_location, images_location = self._segment_files(file_type, day, segment)
+        _save_array(ids_location, np.concatenate([self._load_segment(record).sample_id for record in records]))
+
+        height, width, count = int(records[0]["height"]), int(records[0]["width"]), int(records["count"].sum())
+        fd, tmp_name = tempfile.mkstemp(dir=images_location.parent, prefix=f".{images_location.name}.")
+        os.close(fd)
+        try:
+            # Copied segment by segment into a memory-mapped file, the merged images are never all in memory
+            images = np.lib.format.open_memmap(tmp_name, mode="w+", dtype=np.float32, shape=(count, height, width))
+            offset = 0
+            for record in records:
+                segment_images = self._load_segment(record).images
+                images[offset : offset + len(segment_images)] = segment_images
+                offset += len(segment_images)
+            images.flush()
+            del images
+            os.replace(tmp_name, images_location)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+        merged = np.zeros(1, dtype=MANIFEST_DTYPE)
+        merged[0] = (segment, np.datetime64(day, "D"), FILE_TYPES.index(file_type), height, width, count)
+        merged_record: np.void = merged[0]
+        return merged_record
+
+    def _remove_unreferenced_segments(
+        self, file_type: FileType, day: date, manifest: npt.NDArray[np.void]
+    ) -> None:
+        """Remove files of segments replaced, or left behind by a crashed ingestion, over the grace period ago"""
+        referenced = {f"{segment:016x}" for segment in manifest["segment"].tolist()}
+        deadline = time.time() - self.segment_grace_period.total_seconds()
+        with os.scandir(self._partition(file_type, day)) as entries:
+            for entry in entries:
+                if entry.name in (MANIFEST_NAME, LOCK_NAME) or entry.name.split(".")[0] in referenced:
+                    continue
+                # Temporary files too, files of ingestions in progress were written within the grace period
+                if entry.stat(follow_symlinks=False).st_mtime <= deadline:
+                    Path(entry.path).unlink(missing_ok=True)
+
+
+def _slice_batch(batch: SampleBatch, start: int, stop: int) -> SampleBatch:
+    return SampleBatch(
+        sample_id=batch.sample_id[start:stop],
+        file_type=batch.file_type[start:stop],
+        created_at=batch.created_at[start:stop],
+        images=batch.images[start:stop],
+    )
+
+
+def _concat_batches(batches: list[SampleBatch]) -> SampleBatch:
+    # Also reads the memory-mapped images into memory
+    return SampleBatch(
+        sample_id=np.concatenate([batch.sample_id for batch in batches]),
+        file_type=np.concatenate([batch.file_type for batch in batches]),
+        created_at=np.concatenate([batch.created_at for batch in batches]),
+        images=np.concatenate([batch.images for batch in batches]),
+    )
+
+
+def create_sample_corpus(settings: Settings) -> LocalSampleCorpus:
+    return LocalSampleCorpus(root=settings.storage_location / "samples")
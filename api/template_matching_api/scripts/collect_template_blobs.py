@@ -0,0 +1,26 @@
+"""Remove content addressed template blobs no template references anymore, e.g. from a cron job.
+
+Blobs are removed when their last template is deleted or re-uploaded, this removes the ones kept by their grace period
+or left behind by a crash, and reference markers of earlier versions.
+
+Run from the project root:
+    uv run --frozen python -m template_matching_api.scripts.collect_template_blobs
+"""
+from template_matching_api.db import dispose_db
+from template_matching_api.file_storage import ContentAddressedTemplateStorage, create_template_backend
+from template_matching_api.settings import get_settings
+
+
+def main() -> None:
+    storage = create_template_backend(get_settings())
+    if not isinstance(storage, ContentAddressedTemplateStorage):
+        print("Template storage backend is not content addressed, nothing to collect")
+        return
+    try:
+        print(f"Removed {storage.collect_garbage()} unreferenced template blobs")
+    finally:
+        dispose_db()
+
+
+if __name__ == '__main__':
+    main()
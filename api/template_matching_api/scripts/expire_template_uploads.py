@@ -0,0 +1,30 @@
+"""Remove expired resumable template uploads and their staged files, e.g. from a cron job.
+
+Uploads are also expired whenever a new one is created, this only matters when no uploads are started for a while.
+
+Run from the project root:
+    uv run --frozen python -m template_matching_api.scripts.expire_template_uploads
+"""
+import asyncio
+
+from template_matching_api.api.dependencies import get_async_session_maker, get_template_storage
+from template_matching_api.db import dispose_async_db
+from template_matching_api.file_storage import AsyncDocumentTemplateStorage
+from template_matching_api.template_uploads import expire_template_uploads
+
+
+async def run() -> int:
+    try:
+        return await expire_template_uploads(
+            get_async_session_maker(), AsyncDocumentTemplateStorage(get_template_storage())
+        )
+    finally:
+        await dispose_async_db()
+
+
+def main() -> None:
+    print(f"Removed {asyncio.run(run())} expired template uploads")
+
+
+if __name__ == '__main__':
+    main()
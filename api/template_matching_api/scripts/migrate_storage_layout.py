@@ -0,0 +1,20 @@
+"""Move template files from the flat `templates/<id>` layout into the hashed `templates/shards/<b1>/<b2>/<id>` layout.
+
+Safe to run while the API is serving: every template is moved with an atomic rename (or, for the content addressed
+backend, relinked) and reads fall back to the legacy layout until then. Interrupted runs can simply be restarted.
+
+Run from the project root:
+    uv run --frozen python -m template_matching_api.scripts.migrate_storage_layout
+"""
+from template_matching_api.file_storage import create_template_backend
+from template_matching_api.settings import get_settings
+
+
+def main() -> None:
+    storage = create_template_backend(get_settings())
+    migrated = storage.migrate_legacy_layout()
+    print(f"Migrated {migrated} templates to {storage.sharded_location}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+from functools import cache
+from pathlib import Path
+from typing import Literal
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import make_url
+
+STORAGE_LOCATION = Path(os.path.realpath(__file__)).parents[1] / "storage"
+DB_STORAGE_LOCATION = STORAGE_LOCATION / "matching_api.db"
+
+
+class Settings(BaseSettings):
+    """Runtime configuration, every field can be overridden by a `TEMPLATE_MATCHING_<FIELD>` environment variable."""
+
+    model_config = SettingsConfigDict(env_prefix="TEMPLATE_MATCHING_", extra="ignore")
+
+    db_url: str = f"sqlite+pysqlite:///{DB_STORAGE_LOCATION}"
+    # Defaults to `db_url` with the aiosqlite driver, required for other databases
+    async_db_url: str | None = None
+    db_echo: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_pre_ping: bool = True
+    db_pool_recycle_seconds: int = 3600
+
+    sqlite_busy_timeout_ms: int = 5_000
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+
+    storage_location: Path = STORAGE_LOCATION
+    # "content_addressed" deduplicates identical template files into one blob
+    template_storage_backend: Literal["local", "content_addressed"] = "local"
+    # Total bytes of template files kept in the in-process LRU cache, 0 disables the cache
+    template_cache_max_bytes: int = 0
+    # Content addressed blobs stored this recently are not removed, see `ContentAddressedTemplateStorage`
+    template_blob_grace_period_seconds: float = 60 * 60
+    template_upload_chunk_size: int = 1024 * 1024
+    template_max_size: int = 512 * 1024 * 1024
+    # Resumable uploads without a new chunk for this long are removed
+    template_upload_expiry_seconds: int = 24 * 60 * 60
+    # Processes generating thumbnails and grayscale arrays of uploaded templates
+    derivative_workers: int = 2
+
+    # Processes started by the job worker service (`python -m template_matching_api.jobs.worker`)
+    job_workers: int = 2
+    job_poll_interval_seconds: float = 1.0
+    job_heartbeat_interval_seconds: float = 5.0
+    # Running jobs without a heartbeat for this long are considered orphaned by a crashed worker
+    job_heartbeat_timeout_seconds: float = 30.0
+    # Orphaned jobs are resubmitted until they were started this many times, then they fail
+    job_max_attempts: int = 3
+    # Templates per shard, the shards of a job are computed in parallel by all worker processes
+    job_shard_size: int = 8
+    # Wall-clock seconds a run may take before it fails, unlimited if None. Jobs can set their own timeout
+    job_timeout_seconds: float | None = None
+    # Jobs workspaces started this recently count against their fair share of the workers, see `jobs.scheduler`
+    job_fairness_window_seconds: float = 60 * 60
+    # "mock" generates random scores, "ncc" matches the templates against the sample corpus in `<storage>/samples`
+    matching_engine: Literal["mock", "ncc"] = "mock"
+    # Samples of equal size matched at once
+    matching_batch_size: int = 32
+    # Template pyramid levels searched, i.e. the template at full, half, quarter... size
+    matching_scale_levels: int = 3
+    # Samples scoring at least this much are not searched at the remaining levels
+    matching_score_threshold: float | None = None
+    # Job state changes are published to subscribed clients this often
+    job_events_poll_interval_seconds: float = 0.5
+    # Comment lines sent on idle Server-Sent Events streams, so that proxies do not close them
+    job_events_keepalive_seconds: float = 15.0
+    # Long polling requests for a job state are answered after this long at the latest, whatever their timeout
+    job_wait_max_timeout_seconds: float = 60.0
+
+    # Worker threads available to code paths that stay blocking (file IO, sync dependencies)
+    threadpool_size: int = 40
+
+    def get_async_db_url(self) -> str:
+        if self.async_db_url is not None:
+            return self.async_db_url
+        url = make_url(self.db_url)
+        if url.get_backend_name() != "sqlite":
+            raise ValueError(
+                f"No asyncio driver is known for {url.get_backend_name()} databases, "
+                "set TEMPLATE_MATCHING_ASYNC_DB_URL"
+            )
+        return url.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+
+
+@cache
+def get_settings() -> Settings:
+    return Settings()
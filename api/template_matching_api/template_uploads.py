@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from template_matching_api.db_model import TemplateUpload
+from template_matching_api.file_storage import AsyncDocumentTemplateStorage
+
+
+async def expire_template_uploads(
+    session_maker: async_sessionmaker[AsyncSession], template_storage: AsyncDocumentTemplateStorage
+) -> int:
+    """Remove resumable uploads past their expiry together with their staged files, returns how many were removed.
+
+    Uploads being written to are never removed, their expiry is extended before a chunk is written.
+    """
+    async with session_maker.begin() as session:
+        expired_ids = (
+            await session.scalars(
+                delete(TemplateUpload).where(TemplateUpload.expires_at < datetime.now()).returning(TemplateUpload.id)
+            )
+        ).all()
+    for upload_id in expired_ids:
+        await template_storage.delete_upload(upload_id)
+    return len(expired_ids)
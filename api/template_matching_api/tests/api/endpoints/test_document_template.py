@@ -1,17 +1,28 @@
+import hashlib
+import io
 import json
 from datetime import datetime
+from pathlib import Path
 
 import pytest
+from PIL import Image
 from sqlalchemy import select
 from sqlalchemy.orm import Session
+from fastapi import FastAPI
 from starlette.testclient import TestClient
 
+from template_matching_api.api.dependencies import get_template_storage
 from template_matching_api.api_models.document_template import (
+    DocumentTemplateBatchItem,
     DocumentTemplateOut,
     DocumentTemplateUpdate,
 )
 from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.derivatives import GRAYSCALE_NAME, thumbnail_name
+from template_matching_api.file_storage import DocumentTemplateStorage
+from template_matching_api.settings import Settings, get_settings
 from template_matching_api.tests.storage import InMemoryTemplateStorage
+from template_matching_api.tests.test_derivatives import image_bytes
 
 
 @pytest.fixture
@@ -74,11 +85,29 @@ def test_create_document_template(client: TestClient) -> None:
     assert document_template_id is not None
     assert resp_body["template_filename"] == filename
 
+    assert resp_body["template_sha256"] == hashlib.sha256(file_bytes).hexdigest()
+    assert resp_body["template_size"] == len(file_bytes)
+
     storage = InMemoryTemplateStorage()
     loaded_bytes = storage.load(document_template_id)
     assert loaded_bytes == file_bytes
 
 
+def test_create_document_template_too_large(
+    app: FastAPI, client: TestClient, session: Session
+) -> None:
+    app.dependency_overrides[get_settings] = lambda: Settings(
+        template_max_size=4, template_upload_chunk_size=2
+    )
+    resp = client.post(
+        "/api/document-template/",
+        data={"json_body": json.dumps({"name": "test_template"})},
+        files={"file": ("testFile.jpg", b"abcdef", "image/jpeg")},
+    )
+    assert resp.status_code == 413
+    assert session.scalar(select(DocumentTemplate)) is None
+
+
 def test_update_document_template(
     with_document_templates: list[DocumentTemplate],
     session: "Session",
@@ -114,6 +143,8 @@ def test_upload_document_template(
         assert resp.status_code == 204
         session.refresh(template)
         assert template.template_filename == filename
+        assert template.template_sha256 == hashlib.sha256(file_bytes).hexdigest()
+        assert template.template_size == len(file_bytes)
 
         loaded_bytes = storage.load(template.id)
         assert loaded_bytes == file_bytes
@@ -159,3 +190,217 @@ def test_delete_document_template(
         assert db_record is None
         with pytest.raises(FileNotFoundError):
             storage.load(template_id)
+
+
+@pytest.fixture
+def with_stored_template(
+    with_document_templates: list[DocumentTemplate], session: Session
+) -> DocumentTemplate:
+    file_bytes = b"0123456789"
+    template = with_document_templates[0]
+    stored = InMemoryTemplateStorage().save_stream(template.id, [file_bytes])
+    template.template_sha256 = stored.sha256
+    template.template_size = stored.size
+    session.commit()
+    return template
+
+
+def test_download_document_template_etag(
+    with_stored_template: DocumentTemplate, client: TestClient
+) -> None:
+    url = f"/api/document-template/{with_stored_template.id}/download"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+    assert etag == f'"{with_stored_template.template_sha256}"'
+    assert "Last-Modified" in resp.headers
+
+    resp = client.get(url, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.content == b""
+    assert resp.headers["ETag"] == etag
+
+    resp = client.get(url, headers={"If-None-Match": '"other"'})
+    assert resp.status_code == 200
+    assert resp.content == b"0123456789"
+
+
+@pytest.mark.parametrize(
+    "http_range,content_range,content",
+    [
+        ("bytes=2-4", "bytes 2-4/10", b"234"),
+        ("bytes=7-", "bytes 7-9/10", b"789"),
+        ("bytes=-2", "bytes 8-9/10", b"89"),
+        ("bytes=8-100", "bytes 8-9/10", b"89"),
+    ],
+)
+def test_download_document_template_range(
+    with_stored_template: DocumentTemplate,
+    client: TestClient,
+    http_range: str,
+    content_range: str,
+    content: bytes,
+) -> None:
+    resp = client.get(
+        f"/api/document-template/{with_stored_template.id}/download",
+        headers={"Range": http_range},
+    )
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == content_range
+    assert resp.content == content
+
+
+def test_download_document_template_range_not_satisfiable(
+    with_stored_template: DocumentTemplate, client: TestClient
+) -> None:
+    resp = client.get(
+        f"/api/document-template/{with_stored_template.id}/download",
+        headers={"Range": "bytes=10-"},
+    )
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == "bytes */10"
+
+
+def test_download_document_template_from_local_storage(
+    with_document_templates: list[DocumentTemplate],
+    app: FastAPI,
+    client: TestClient,
+    tmp_path: Path,
+) -> None:
+    storage = DocumentTemplateStorage(root=tmp_path)
+    app.dependency_overrides[get_template_storage] = lambda: storage
+    template = with_document_templates[0]
+    storage.save(template.id, b"0123456789")
+
+    url = f"/api/document-template/{template.id}/download"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.content == b"0123456789"
+    assert template.template_filename in resp.headers["Content-Disposition"]
+
+    resp = client.get(url, headers={"Range": "bytes=2-4"})
+    assert resp.status_code == 206
+    assert resp.content == b"234"
+
+    storage.delete(template.id)
+    assert client.get(url).status_code == 404
+
+
+def test_upload_document_template_generates_derivatives(
+    with_document_templates: list[DocumentTemplate],
+    session: Session,
+    client: TestClient,
+) -> None:
+    template = with_document_templates[0]
+    resp = client.post(
+        f"/api/document-template/{template.id}/upload",
+        files={"file": ("image.png", image_bytes(300, 150), "image/png")},
+    )
+    assert resp.status_code == 204
+    session.refresh(template)
+    assert template.template_sha256 is not None
+
+    storage = InMemoryTemplateStorage()
+    assert storage.load_derivative(template.id, template.template_sha256, thumbnail_name(128))
+    assert storage.load_derivative(template.id, template.template_sha256, GRAYSCALE_NAME)
+
+
+def test_upload_document_template_skips_derivatives_of_other_files(
+    with_document_templates: list[DocumentTemplate],
+    session: Session,
+    client: TestClient,
+) -> None:
+    template = with_document_templates[0]
+    resp = client.post(
+        f"/api/document-template/{template.id}/upload",
+        files={"file": ("document.pdf", b"%PDF-1.7", "application/pdf")},
+    )
+    assert resp.status_code == 204
+    session.refresh(template)
+    assert template.template_sha256 is not None
+
+    with pytest.raises(FileNotFoundError):
+        InMemoryTemplateStorage().load_derivative(template.id, template.template_sha256, GRAYSCALE_NAME)
+
+
+def test_get_document_template_thumbnail(
+    with_stored_template: DocumentTemplate,
+    session: Session,
+    client: TestClient,
+) -> None:
+    assert with_stored_template.template_sha256 is not None
+    InMemoryTemplateStorage().save(with_stored_template.id, image_bytes(300, 150))
+    url = f"/api/document-template/{with_stored_template.id}/thumbnail"
+
+    # Nothing was generated on upload, the thumbnail is generated on the first request
+    resp = client.get(url, params={"size": 100})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "image/webp"
+    with Image.open(io.BytesIO(resp.content)) as thumbnail:
+        assert thumbnail.size == (128, 64)
+    etag = resp.headers["ETag"]
+    assert etag == f'"{with_stored_template.template_sha256}-128"'
+    assert InMemoryTemplateStorage().load_derivative(
+        with_stored_template.id, with_stored_template.template_sha256, thumbnail_name(128)
+    ) == resp.content
+
+    resp = client.get(url, params={"size": 100}, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    resp = client.get(url)
+    assert resp.status_code == 200
+    with Image.open(io.BytesIO(resp.content)) as thumbnail:
+        assert thumbnail.size == (256, 128)
+
+
+def test_get_document_template_thumbnail_not_an_image(
+    with_stored_template: DocumentTemplate,
+    client: TestClient,
+) -> None:
+    resp = client.get(f"/api/document-template/{with_stored_template.id}/thumbnail")
+    assert resp.status_code == 415
+
+    assert client.get("/api/document-template/1000/thumbnail").status_code == 404
+
+
+def _parse_batch_frames(body: bytes) -> list[tuple[DocumentTemplateBatchItem, bytes]]:
+    frames = []
+    offset = 0
+    while offset < len(body):
+        metadata_length = int.from_bytes(body[offset : offset + 4], "big")
+        metadata = DocumentTemplateBatchItem.model_validate_json(body[offset + 4 : offset + 4 + metadata_length])
+        offset += 4 + metadata_length
+        thumbnail_length = int.from_bytes(body[offset : offset + 4], "big")
+        frames.append((metadata, body[offset + 4 : offset + 4 + thumbnail_length]))
+        offset += 4 + thumbnail_length
+    return frames
+
+
+def test_batch_document_templates(
+    with_document_templates: list[DocumentTemplate],
+    client: TestClient,
+) -> None:
+    storage = InMemoryTemplateStorage()
+    image_template, other_template, missing_file_template = with_document_templates
+    storage.save(image_template.id, image_bytes(300, 150))
+    storage.save(other_template.id, b"not an image")
+    requested_ids = [other_template.id, 1000, image_template.id, missing_file_template.id, image_template.id]
+
+    resp = client.post("/api/document-template/batch", json={"ids": requested_ids, "thumbnail_size": 64})
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "application/octet-stream"
+
+    frames = _parse_batch_frames(resp.content)
+    assert [metadata.template.id for metadata, _ in frames] == [
+        other_template.id, image_template.id, missing_file_template.id
+    ]
+    assert [metadata.thumbnail_media_type for metadata, _ in frames] == [None, "image/webp", None]
+    assert frames[1][0].template.name == image_template.name
+    with Image.open(io.BytesIO(frames[1][1])) as thumbnail:
+        assert thumbnail.size == (64, 32)
+    assert frames[0][1] == frames[2][1] == b""
+
+
+def test_batch_document_templates_limit(client: TestClient) -> None:
+    resp = client.post("/api/document-template/batch", json={"ids": list(range(1001))})
+    assert resp.status_code == 422
@@ -1,20 +1,32 @@
+import json
+import time
 import random
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any
 
 import pytest
+from pytest import MonkeyPatch
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 
 from template_matching_api.api_models.template_matching_job import (
     JobState,
     TemplateMatchingJobOut,
     TemplateMatchingJobIn,
+    TemplateMatchingJobResults,
+    TemplateMatchingJobResultStats,
 )
 from .test_document_template import with_document_templates
 from .test_workspace import with_workspaces
 from template_matching_api.db_model import DocumentTemplate, TemplateMatchingJob, Workspace
+from template_matching_api.jobs.queue import claim_next_job, submit_job
+from template_matching_api.jobs.worker import JobWorker
+from template_matching_api.result_storage import JobResultStorage
+from template_matching_api.api.endpoints import template_matching_job as template_matching_job_endpoints
 
 
 @pytest.fixture
@@ -78,6 +90,8 @@ def test_create_template_matching_job(
     assert [
         template["id"] for template in resp_body["document_templates"]
     ] == template_ids
+    assert resp_body["job_state"] == JobState.SUBMITTED
+    assert resp_body["job_id"] is not None
 
 
 def test_create_template_matching_job_without_workspace(
@@ -129,31 +143,290 @@ def test_get_template_matching_job(
         assert resp_body["workspace"]["id"] == job.workspace_id
 
 
+def test_get_template_matching_job_waiting_for_state(
+    with_template_matching_jobs: list[TemplateMatchingJob], client: TestClient, session: Session
+) -> None:
+    job = with_template_matching_jobs[0]
+    submit_job(job)
+    session.commit()
+    url = f"/api/template-matching-job/{job.id}"
+
+    # Already in the state
+    resp = client.get(url, params={"wait_for_state": JobState.SUBMITTED, "timeout": 30})
+    assert resp.json()["job_state"] == JobState.SUBMITTED
+
+    started = time.monotonic()
+    resp = client.get(url, params={"wait_for_state": JobState.SUCCEEDED, "timeout": 0.1})
+    assert resp.status_code == 200
+    assert resp.json()["job_state"] == JobState.SUBMITTED
+    assert time.monotonic() - started >= 0.1
+
+    def fail_job() -> None:
+        time.sleep(0.1)
+        job.job_state = JobState.FAILED
+        session.commit()
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(fail_job)
+        # Finished without reaching the state
+        resp = client.get(url, params={"wait_for_state": JobState.SUCCEEDED, "timeout": 30})
+    assert resp.json()["job_state"] == JobState.FAILED
+
+    assert client.get(url, params={"wait_for_state": JobState.SUCCEEDED, "timeout": 0}).status_code == 422
+    resp = client.get("/api/template-matching-job/99999", params={"wait_for_state": JobState.SUCCEEDED})
+    assert resp.status_code == 404
+
+
+def _run_jobs(jobs: list[TemplateMatchingJob], job_worker: JobWorker, session: Session) -> None:
+    for job in jobs:
+        submit_job(job)
+    session.commit()
+    while job_worker.run_once():
+        pass
+    for job in jobs:
+        session.refresh(job)
+        assert job.job_state == JobState.SUCCEEDED
+
+
 def test_get_template_matching_job_results(
     with_template_matching_jobs: list[TemplateMatchingJob],
     with_workspaces: list[Workspace],
+    job_worker: JobWorker,
     client: TestClient,
     session: Session,
 ) -> None:
     for job in with_template_matching_jobs:
-        ws = with_workspaces[0]
-        job.workspace_id = ws.id
-        job.job_state = JobState.SUCCEEDED
-        session.commit()
+        job.workspace_id = with_workspaces[0].id
+    _run_jobs(with_template_matching_jobs, job_worker, session)
 
+    for job in with_template_matching_jobs:
         resp = client.get(f"/api/template-matching-job/{job.id}/results")
         assert resp.status_code == 200
         resp_body = resp.json()
+        TemplateMatchingJobResults.model_validate(resp_body)
 
         assert (
             {template_result["template_id"] for template_result in resp_body["results_per_template"]}
             == set(job.document_template_ids)
         )
+        # Written once by the worker, every read returns the same results
+        assert client.get(f"/api/template-matching-job/{job.id}/results").json() == resp_body
+
+
+def test_stream_template_matching_job_results(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    with_workspaces: list[Workspace],
+    job_worker: JobWorker,
+    client: TestClient,
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[2]
+    job.workspace_id = with_workspaces[0].id
+    _run_jobs([job], job_worker, session)
+    results = client.get(f"/api/template-matching-job/{job.id}/results").json()
+
+    with client.stream(
+        "GET", f"/api/template-matching-job/{job.id}/results/stream", params={"chunk_size": 10}
+    ) as resp:
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/x-ndjson"
+        assert resp.headers["x-total-run-time"] == str(results["total_run_time"])
+        chunks = [json.loads(line) for line in resp.iter_lines()]
+    assert all(len(chunk["sample_results"]) <= 10 for chunk in chunks)
+    for template_results in results["results_per_template"]:
+        assert [
+            sample_result
+            for chunk in chunks
+            if chunk["template_id"] == template_results["template_id"]
+            for sample_result in chunk["sample_results"]
+        ] == template_results["sample_results"]
+
+    resp = client.get(f"/api/template-matching-job/{job.id}/results/stream", params={"record": "sample"})
+    samples = [json.loads(line) for line in resp.iter_lines()]
+    assert len(samples) == int(resp.headers["x-result-count"])
+    assert samples == [
+        {"template_id": template_results["template_id"], **sample_result}
+        for template_results in results["results_per_template"]
+        for sample_result in template_results["sample_results"]
+    ]
+
+
+def test_query_template_matching_job_results(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    with_workspaces: list[Workspace],
+    job_worker: JobWorker,
+    client: TestClient,
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[2]
+    job.workspace_id = with_workspaces[0].id
+    _run_jobs([job], job_worker, session)
+    url = f"/api/template-matching-job/{job.id}/results"
+    results = client.get(url).json()
+
+    resp = client.get(url, params={"top_k": 3, "min_score": 0.2})
+    assert resp.status_code == 200
+    assert "x-next-cursor" not in resp.headers
+    for template_results, top_results in zip(results["results_per_template"], resp.json()["results_per_template"]):
+        expected_scores = sorted(
+            (sample["score"] for sample in template_results["sample_results"] if sample["score"] >= 0.2),
+            reverse=True,
+        )[:3]
+        assert [sample["score"] for sample in top_results["sample_results"]] == expected_scores
+
+    paged = []
+    params: dict[str, str | int] = {"limit": 7}
+    while True:
+        resp = client.get(url, params=params)
+        assert resp.status_code == 200
+        page_samples = [
+            sample for template_results in resp.json()["results_per_template"]
+            for sample in template_results["sample_results"]
+        ]
+        assert len(page_samples) <= 7
+        paged.extend(page_samples)
+        if "x-next-cursor" not in resp.headers:
+            break
+        params["cursor"] = resp.headers["x-next-cursor"]
+    assert paged == [
+        sample for template_results in results["results_per_template"] for sample in template_results["sample_results"]
+    ]
+
+    assert client.get(url, params={"cursor": "invalid", "limit": 7}).status_code == 400
+    assert client.get(url, params={"top_k": 0}).status_code == 422
+
+
+def test_get_template_matching_job_result_stats(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    with_workspaces: list[Workspace],
+    job_worker: JobWorker,
+    result_storage: JobResultStorage,
+    client: TestClient,
+    session: Session,
+    monkeypatch: MonkeyPatch,
+) -> None:
+    job = with_template_matching_jobs[1]
+    job.workspace_id = with_workspaces[0].id
+    _run_jobs([job], job_worker, session)
+    url = f"/api/template-matching-job/{job.id}/results/stats"
+    results = client.get(f"/api/template-matching-job/{job.id}/results").json()
+
+    resp = client.get(url, params={"bins": 5, "percentiles": [10, 90]})
+    assert resp.status_code == 200
+    stats = TemplateMatchingJobResultStats.model_validate(resp.json())
+    assert stats.count == sum(len(template["sample_results"]) for template in results["results_per_template"])
+    assert len(stats.histogram.counts) == 5
+    assert [p.percentile for p in stats.percentiles] == [10, 90]
+    assert [template.template_id for template in stats.per_template] == job.document_template_ids
+
+    # Cached per run and query
+    def not_computed(*_args: object) -> None:
+        raise AssertionError("statistics were computed again")
+
+    monkeypatch.setattr(template_matching_job_endpoints, "compute_result_stats", not_computed)
+    assert client.get(url, params={"bins": 5, "percentiles": [10, 90]}).json() == resp.json()
+
+    assert client.get(url, params={"range_min": 1, "range_max": 0}).status_code == 422
+    assert client.get(url, params={"percentiles": [101]}).status_code == 422
+
+
+def test_list_template_matching_job_shards(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    job_worker: JobWorker,
+    client: TestClient,
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[2]
+    submit_job(job)
+    session.commit()
+    assert client.get(f"/api/template-matching-job/{job.id}/shards").json() == []
+
+    _run_jobs([job], job_worker, session)
+    shards = client.get(f"/api/template-matching-job/{job.id}/shards").json()
+    assert [shard["document_template_ids"] for shard in shards] == [job.document_template_ids]
+    assert [shard["state"] for shard in shards] == [JobState.SUCCEEDED]
+
+    # Nothing left to compute on a rerun
+    _run_jobs([job], job_worker, session)
+    assert client.get(f"/api/template-matching-job/{job.id}/shards").json() == []
+    assert client.get("/api/template-matching-job/99999/shards").status_code == 404
+
+
+def test_get_job_queue_metrics(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    with_workspaces: list[Workspace],
+    client: TestClient,
+    session: Session,
+) -> None:
+    for job in with_template_matching_jobs:
+        job.workspace_id = with_workspaces[0].id
+        submit_job(job)
+        job.submitted_at = datetime.now() - timedelta(minutes=5)
+    session.commit()
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    session.commit()
+
+    resp = client.get("/api/template-matching-job/queue-metrics")
+    assert resp.status_code == 200
+    [metrics] = resp.json()
+    assert metrics["workspace_id"] == with_workspaces[0].id
+    assert (metrics["queued"], metrics["running"], metrics["started"]) == (2, 1, 1)
+    assert metrics["oldest_queued_seconds"] >= 5 * 60
+    assert metrics["mean_wait_seconds"] == metrics["max_wait_seconds"] >= 5 * 60
+    assert client.get("/api/template-matching-job/queue-metrics?window_seconds=0").status_code == 422
+
+
+def test_template_matching_job_events_websocket(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    client: TestClient,
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[0]
+    with client.websocket_connect(f"/api/template-matching-job/events/ws?job_id={job.id}") as websocket:
+        event = websocket.receive_json()
+        assert (event["id"], event["job_state"], event["deleted"]) == (job.id, job.job_state, False)
+
+        submit_job(job)
+        session.commit()
+        event = websocket.receive_json()
+        assert (event["id"], event["job_state"]) == (job.id, JobState.SUBMITTED)
+
+        session.delete(job)
+        session.commit()
+        assert websocket.receive_json()["deleted"]
+
+
+def test_template_matching_job_events_require_one_topic(client: TestClient) -> None:
+    assert client.get("/api/template-matching-job/events").status_code == 422
+    assert client.get("/api/template-matching-job/events?job_id=1&workspace_id=1").status_code == 422
+    with pytest.raises(WebSocketDisconnect) as disconnect:
+        with client.websocket_connect("/api/template-matching-job/events/ws"):
+            pass
+    assert disconnect.value.code == 1008
+
+
+def test_get_template_matching_job_results_not_finished(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    client: TestClient,
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[0]
+    submit_job(job)
+    session.commit()
+    assert client.get(f"/api/template-matching-job/{job.id}/results").status_code == 404
+    assert client.get(f"/api/template-matching-job/{job.id}/results/stream").status_code == 404
+
+    # Succeeded without stored results, e.g. the results directory was lost
+    job.job_state = JobState.SUCCEEDED
+    session.commit()
+    assert client.get(f"/api/template-matching-job/{job.id}/results").status_code == 404
 
 
 def test_results_respect_workspace_data_spec(
     with_template_matching_jobs: list[TemplateMatchingJob],
     with_workspaces: list[Workspace],
+    job_worker: JobWorker,
     client: TestClient,
     session: Session,
 ) -> None:
@@ -167,8 +440,7 @@ def test_results_respect_workspace_data_spec(
 
     job = with_template_matching_jobs[0]
     job.workspace_id = ws_pdf.id
-    job.job_state = JobState.SUCCEEDED
-    session.commit()
+    _run_jobs([job], job_worker, session)
 
     resp = client.get(f"/api/template-matching-job/{job.id}/results")
     assert resp.status_code == 200
@@ -195,6 +467,24 @@ def test_rerun_template_matching_job(
         assert resp.status_code == 204
 
 
+def test_cancel_template_matching_job(
+    with_template_matching_jobs: list[TemplateMatchingJob], client: TestClient, session: Session
+) -> None:
+    job = with_template_matching_jobs[0]
+    submit_job(job)
+    session.commit()
+
+    resp = client.post(f"/api/template-matching-job/{job.id}/cancel")
+    assert resp.status_code == 200
+    assert (resp.json()["job_state"], resp.json()["error"]) == (JobState.CANCELLED, "Cancelled")
+    assert client.post(f"/api/template-matching-job/{job.id}/cancel").status_code == 409
+    assert client.post("/api/template-matching-job/99999/cancel").status_code == 404
+
+    # Waiting for a cancelled job ends right away
+    resp = client.get(f"/api/template-matching-job/{job.id}", params={"wait_for_state": JobState.SUCCEEDED})
+    assert resp.json()["job_state"] == JobState.CANCELLED
+
+
 def test_delete_template_matching_job(
     with_template_matching_jobs: list[TemplateMatchingJob],
     client: TestClient,
@@ -211,3 +501,70 @@ def test_delete_template_matching_job(
             select(TemplateMatchingJob).where(TemplateMatchingJob.id == job_id)
         )
         assert db_record is None
+
+
+def _create_job(client: TestClient, template_ids: list[int], workspace_id: int) -> dict[str, Any]:
+    resp = client.post(
+        "/api/template-matching-job/",
+        json=TemplateMatchingJobIn(document_template_ids=template_ids, workspace_id=workspace_id).model_dump(
+            mode="json"
+        ),
+    )
+    assert resp.status_code == 201
+    body: dict[str, Any] = resp.json()
+    return body
+
+
+def test_create_template_matching_job_reuses_results(
+    with_document_templates: list[DocumentTemplate],
+    with_workspaces: list[Workspace],
+    job_worker: JobWorker,
+    client: TestClient,
+) -> None:
+    template_ids = [template.id for template in with_document_templates[:2]]
+    first = _create_job(client, template_ids, with_workspaces[0].id)
+    assert first["memoized_from_id"] is None
+    while job_worker.run_once():
+        pass
+
+    # Same templates in another order, completed without running
+    second = _create_job(client, template_ids[::-1], with_workspaces[0].id)
+    assert second["job_state"] == JobState.SUCCEEDED
+    assert second["memoized_from_id"] == first["id"]
+    assert not job_worker.run_once()
+    assert (
+        client.get(f"/api/template-matching-job/{second['id']}/results").content
+        == client.get(f"/api/template-matching-job/{first['id']}/results").content
+    )
+    # Reruns are memoized too
+    assert client.post(f"/api/template-matching-job/{first['id']}/submit").status_code == 204
+    rerun = client.get(f"/api/template-matching-job/{first['id']}").json()
+    assert rerun["job_state"] == JobState.SUCCEEDED
+    assert rerun["memoized_from_id"] == second["id"]
+
+    # Different inputs are run
+    other_templates = _create_job(client, template_ids[:1], with_workspaces[0].id)
+    assert other_templates["job_state"] == JobState.SUBMITTED
+    other_workspace = next(
+        ws for ws in with_workspaces if ws.data_specification != with_workspaces[0].data_specification
+    )
+    assert _create_job(client, template_ids, other_workspace.id)["job_state"] == JobState.SUBMITTED
+
+
+def test_template_upload_invalidates_memoized_results(
+    with_document_templates: list[DocumentTemplate],
+    with_workspaces: list[Workspace],
+    job_worker: JobWorker,
+    client: TestClient,
+) -> None:
+    template_ids = [template.id for template in with_document_templates[:2]]
+    _create_job(client, template_ids, with_workspaces[0].id)
+    while job_worker.run_once():
+        pass
+
+    resp = client.post(
+        f"/api/document-template/{template_ids[0]}/upload",
+        files={"file": ("template.png", b"new template content", "image/png")},
+    )
+    assert resp.status_code == 204
+    assert _create_job(client, template_ids, with_workspaces[0].id)["job_state"] == JobState.SUBMITTED
@@ -0,0 +1,211 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+from typing import Any, Iterable
+
+import anyio.from_thread
+import pytest
+from fastapi import FastAPI
+from httpx import Response
+from pytest import MonkeyPatch
+from sqlalchemy import event, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from sqlalchemy.orm import Session
+from starlette.testclient import TestClient
+
+from template_matching_api.db_model import DocumentTemplate, TemplateUpload
+from template_matching_api.file_storage import AsyncDocumentTemplateStorage
+from template_matching_api.settings import Settings, get_settings
+from template_matching_api.template_uploads import expire_template_uploads
+from template_matching_api.tests.storage import DT_STORAGE, DT_UPLOADS, InMemoryTemplateStorage
+from .test_document_template import with_document_templates
+
+FILE_BYTES = b"%PDF-" + bytes(range(256)) * 4
+
+
+def create_upload(client: TestClient, **overrides: Any) -> dict[str, Any]:
+    resp = client.post(
+        "/api/template-upload/",
+        json={
+            "name": "large_template",
+            "template_filename": "large.pdf",
+            "template_file_type": "application/pdf",
+            "total_size": len(FILE_BYTES),
+        } | overrides,
+    )
+    assert resp.status_code == 201, resp.text
+    upload: dict[str, Any] = resp.json()
+    return upload
+
+
+def patch_chunk(client: TestClient, upload_id: str, offset: int, chunk: bytes) -> Response:
+    return client.patch(
+        f"/api/template-upload/{upload_id}",
+        content=chunk,
+        headers={"Upload-Offset": str(offset), "Content-Type": "application/offset+octet-stream"},
+    )
+
+
+def test_resumable_upload(client: TestClient, session: Session) -> None:
+    upload = create_upload(client)
+    assert upload["offset"] == 0
+    upload_id = upload["id"]
+
+    resp = patch_chunk(client, upload_id, 0, FILE_BYTES[:500])
+    assert resp.status_code == 204
+    assert resp.headers["Upload-Offset"] == "500"
+
+    # A dropped connection: the client asks where to resume
+    resp = client.head(f"/api/template-upload/{upload_id}")
+    assert resp.status_code == 200
+    assert resp.headers["Upload-Offset"] == "500"
+    assert resp.headers["Upload-Length"] == str(len(FILE_BYTES))
+
+    resp = client.post(f"/api/template-upload/{upload_id}/finalize")
+    assert resp.status_code == 409
+
+    resp = patch_chunk(client, upload_id, 500, FILE_BYTES[500:])
+    assert resp.status_code == 204
+    assert client.get(f"/api/template-upload/{upload_id}").json()["offset"] == len(FILE_BYTES)
+
+    resp = client.post(f"/api/template-upload/{upload_id}/finalize")
+    assert resp.status_code == 201
+    template = resp.json()
+    assert template["name"] == "large_template"
+    assert template["template_filename"] == "large.pdf"
+    assert template["template_sha256"] == hashlib.sha256(FILE_BYTES).hexdigest()
+    assert template["template_size"] == len(FILE_BYTES)
+    assert InMemoryTemplateStorage().load(template["id"]) == FILE_BYTES
+    assert upload_id not in DT_UPLOADS
+    assert session.scalar(select(TemplateUpload)) is None
+
+    assert client.post(f"/api/template-upload/{upload_id}/finalize").status_code == 404
+
+
+def test_resumable_upload_offset_mismatch(client: TestClient) -> None:
+    upload_id = create_upload(client)["id"]
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES[:100]).status_code == 204
+
+    resp = patch_chunk(client, upload_id, 200, FILE_BYTES[200:300])
+    assert resp.status_code == 409
+    assert resp.headers["Upload-Offset"] == "100"
+
+    # Retrying the acknowledged chunk is a conflict too, the client resumes from the current offset
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES[:100]).status_code == 409
+
+
+def test_resumable_upload_too_large(app: FastAPI, client: TestClient) -> None:
+    upload_id = create_upload(client)["id"]
+
+    resp = patch_chunk(client, upload_id, 0, FILE_BYTES + b"overflow")
+    assert resp.status_code == 413
+    assert client.head(f"/api/template-upload/{upload_id}").headers["Upload-Offset"] == "0"
+
+    app.dependency_overrides[get_settings] = lambda: Settings(template_max_size=10)
+    resp = client.post(
+        "/api/template-upload/",
+        json={"name": "n", "template_filename": "f", "template_file_type": "t", "total_size": 11},
+    )
+    assert resp.status_code == 413
+
+
+def test_resumable_upload_replaces_template_file(
+    with_document_templates: list[DocumentTemplate],
+    session: Session,
+    client: TestClient,
+) -> None:
+    template = with_document_templates[0]
+    upload_id = create_upload(client, template_id=template.id)["id"]
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES).status_code == 204
+
+    resp = client.post(f"/api/template-upload/{upload_id}/finalize")
+    assert resp.status_code == 201
+    assert resp.json()["id"] == template.id
+    session.refresh(template)
+    assert template.name == "dt_0"
+    assert template.template_filename == "large.pdf"
+    assert InMemoryTemplateStorage().load(template.id) == FILE_BYTES
+
+    resp = client.post(
+        "/api/template-upload/",
+        json={"name": "n", "template_filename": "f", "template_file_type": "t", "total_size": 1, "template_id": 1000},
+    )
+    assert resp.status_code == 404
+
+
+def test_expired_uploads_are_removed(app: FastAPI, client: TestClient, session: Session) -> None:
+    app.dependency_overrides[get_settings] = lambda: Settings(template_upload_expiry_seconds=-1)
+    upload_id = create_upload(client)["id"]
+    DT_UPLOADS[upload_id] = bytearray(b"staged")
+
+    assert client.head(f"/api/template-upload/{upload_id}").status_code == 410
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES).status_code == 410
+
+    app.dependency_overrides[get_settings] = lambda: Settings()
+    create_upload(client)
+
+    assert client.head(f"/api/template-upload/{upload_id}").status_code == 404
+    assert upload_id not in DT_UPLOADS
+    assert len(session.scalars(select(TemplateUpload)).all()) == 1
+
+
+def test_expiring_uploads_skips_uploads_being_written(
+    client: TestClient,
+    session: Session,
+    async_sessionmaker_f: async_sessionmaker[AsyncSession],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    upload_id = create_upload(client)["id"]
+    # About to expire when the chunk starts, expired by the time it was written
+    session.execute(update(TemplateUpload).values(expires_at=datetime.now() + timedelta(seconds=0.2)))
+    session.commit()
+    write_upload_chunk = InMemoryTemplateStorage.write_upload_chunk
+
+    def slow_write_upload_chunk(
+        storage: InMemoryTemplateStorage,
+        upload_id: str,
+        offset: int,
+        chunks: Iterable[bytes],
+        max_size: int | None = None,
+    ) -> int:
+        time.sleep(0.3)
+        expired = anyio.from_thread.run(
+            expire_template_uploads, async_sessionmaker_f, AsyncDocumentTemplateStorage(storage)
+        )
+        assert expired == 0
+        return write_upload_chunk(storage, upload_id, offset, chunks, max_size)
+
+    monkeypatch.setattr(InMemoryTemplateStorage, "write_upload_chunk", slow_write_upload_chunk)
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES[:10]).status_code == 204
+    assert client.head(f"/api/template-upload/{upload_id}").headers["Upload-Offset"] == "10"
+
+
+def test_failed_finalization_removes_the_moved_file(client: TestClient, session: Session) -> None:
+    upload_id = create_upload(client)["id"]
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES).status_code == 204
+
+    def fail_commit(_session: Session) -> None:
+        raise RuntimeError("commit failed")
+
+    event.listen(Session, "before_commit", fail_commit)
+    try:
+        with pytest.raises(RuntimeError, match="commit failed"):
+            client.post(f"/api/template-upload/{upload_id}/finalize")
+    finally:
+        event.remove(Session, "before_commit", fail_commit)
+
+    assert session.scalars(select(DocumentTemplate)).all() == []
+    assert DT_STORAGE == {}
+    # The claim of the upload is rolled back as well
+    assert session.scalar(select(TemplateUpload.id)) == upload_id
+
+
+def test_delete_upload(client: TestClient) -> None:
+    upload_id = create_upload(client)["id"]
+    assert patch_chunk(client, upload_id, 0, FILE_BYTES[:10]).status_code == 204
+
+    assert client.delete(f"/api/template-upload/{upload_id}").status_code == 204
+
+    assert upload_id not in DT_UPLOADS
+    assert client.head(f"/api/template-upload/{upload_id}").status_code == 404
+    assert client.delete(f"/api/template-upload/{upload_id}").status_code == 404
@@ -150,3 +150,19 @@ def test_delete_workspace(with_workspaces: list[Workspace], client: TestClient,
     
     db_ws = session.scalar(select(Workspace).where(Workspace.id == ws.id))
     assert db_ws is None
+
+
+def test_update_workspace_scheduling(with_workspaces: list[Workspace], client: TestClient) -> None:
+    ws = with_workspaces[0]
+    resp = client.patch(f"/api/workspace/{ws.id}", json={"max_concurrent_jobs": 2, "job_weight": 0.5})
+    assert resp.status_code == 204
+    resp_data = client.get(f"/api/workspace/{ws.id}").json()
+    assert (resp_data["max_concurrent_jobs"], resp_data["job_weight"]) == (2, 0.5)
+
+    # Only removed if explicitly set
+    assert client.patch(f"/api/workspace/{ws.id}", json={"name": "renamed"}).status_code == 204
+    assert client.get(f"/api/workspace/{ws.id}").json()["max_concurrent_jobs"] == 2
+    assert client.patch(f"/api/workspace/{ws.id}", json={"max_concurrent_jobs": None}).status_code == 204
+    assert client.get(f"/api/workspace/{ws.id}").json()["max_concurrent_jobs"] is None
+
+    assert client.patch(f"/api/workspace/{ws.id}", json={"job_weight": 0}).status_code == 422
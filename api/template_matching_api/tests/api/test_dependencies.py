@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
+
+from template_matching_api.api.dependencies import get_async_read_only_session, get_read_only_session
+from template_matching_api.db import ReadOnlySessionError
+from template_matching_api.db_model import Workspace
+
+
+def test_read_only_session_refuses_writes(sessionmaker_f: sessionmaker[Session], session: Session) -> None:
+    session.add(Workspace(name="workspace", data_specification={}))
+    session.commit()
+    sessions = get_read_only_session(sessionmaker_f)
+    read_only_session = next(sessions)
+
+    workspace = read_only_session.scalars(select(Workspace)).one()
+    workspace.name = "renamed"
+    with pytest.raises(ReadOnlySessionError):
+        read_only_session.commit()
+    read_only_session.rollback()
+    read_only_session.add(Workspace(name="added", data_specification={}))
+    with pytest.raises(ReadOnlySessionError):
+        read_only_session.flush()
+    with pytest.raises(ReadOnlySessionError):
+        read_only_session.execute(insert(Workspace).values(name="inserted", data_specification={}))
+    sessions.close()
+
+    assert session.scalars(select(Workspace.name)).all() == ["workspace"]
+
+
+def test_async_read_only_session_refuses_writes(
+    async_sessionmaker_f: async_sessionmaker[AsyncSession], session: Session
+) -> None:
+    async def write() -> None:
+        sessions = get_async_read_only_session(async_sessionmaker_f)
+        read_only_session = await anext(sessions)
+        assert await read_only_session.scalar(select(func.count()).select_from(Workspace)) == 0
+        read_only_session.add(Workspace(name="added", data_specification={}))
+        try:
+            with pytest.raises(ReadOnlySessionError):
+                await read_only_session.commit()
+            with pytest.raises(ReadOnlySessionError):
+                await read_only_session.execute(insert(Workspace).values(name="inserted", data_specification={}))
+        finally:
+            await sessions.aclose()
+
+    asyncio.run(write())
+    assert session.scalars(select(Workspace)).all() == []
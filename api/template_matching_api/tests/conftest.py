@@ -1,31 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from typing import TypeVar, TypeAlias, Generator
 
 import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from pytest import MonkeyPatch
-from sqlalchemy import Engine, create_engine, StaticPool
+from sqlalchemy import Engine, create_engine, NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.orm import configure_mappers, sessionmaker, Session
 
 from template_matching_api.db_model import Base
-from template_matching_api.tests.storage import DT_STORAGE, InMemoryTemplateStorage
+from template_matching_api.job_events import JobEventBroker
+from template_matching_api.jobs.worker import JobWorker
+from template_matching_api.result_storage import JobResultStorage
+from template_matching_api.settings import Settings
+from template_matching_api.tests.storage import DT_DERIVATIVES, DT_STORAGE, DT_UPLOADS, InMemoryTemplateStorage
 
 _T = TypeVar("_T")
 YieldFixtureResult: TypeAlias = Generator[_T, None, None]
 
 
 @pytest.fixture
-def engine() -> Engine:
-    connection = f"sqlite+pysqlite:///:memory:"
+def db_path(tmp_path: Path) -> Path:
+    # A file rather than :memory: so that the sync and the async engine see the same database
+    return tmp_path / "matching_api.db"
+
+
+@pytest.fixture
+def engine(db_path: Path) -> YieldFixtureResult[Engine]:
+    connection = f"sqlite+pysqlite:///{db_path}"
     engine = create_engine(
         connection,
         echo=True,
         connect_args={"check_same_thread": False},
-        poolclass=StaticPool,
     )
     configure_mappers()
     Base.metadata.create_all(engine)
-    return engine
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def async_engine(engine: Engine, db_path: Path) -> AsyncEngine:
+    return create_async_engine(
+        f"sqlite+aiosqlite:///{db_path}", echo=True, poolclass=NullPool
+    )
 
 
 @pytest.fixture
@@ -33,6 +53,11 @@ def sessionmaker_f(engine: Engine) -> sessionmaker[Session]:
     return sessionmaker(bind=engine)
 
 
+@pytest.fixture
+def async_sessionmaker_f(async_engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
 @pytest.fixture
 def session(sessionmaker_f: sessionmaker[Session]) -> YieldFixtureResult[Session]:
     session = sessionmaker_f()
@@ -41,14 +66,48 @@ def session(sessionmaker_f: sessionmaker[Session]) -> YieldFixtureResult[Session
     session.close()
 
 
+@pytest.fixture
+def derivative_executor() -> YieldFixtureResult[ThreadPoolExecutor]:
+    # Threads rather than the spawned process pool, tests do not pay for starting worker processes
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield executor
+
+
+@pytest.fixture
+def result_storage(tmp_path: Path) -> JobResultStorage:
+    return JobResultStorage(root=tmp_path)
+
+
+@pytest.fixture
+def job_worker(sessionmaker_f: sessionmaker[Session], result_storage: JobResultStorage) -> JobWorker:
+    return JobWorker(sessionmaker_f, "worker-1", Settings(job_heartbeat_interval_seconds=0.01), result_storage)
+
+
+@pytest.fixture
+def job_event_broker() -> JobEventBroker:
+    return JobEventBroker(poll_interval_seconds=0.01)
+
+
 @pytest.fixture(scope="function")
-def app(sessionmaker_f: sessionmaker[Session]) -> YieldFixtureResult[FastAPI]:
+def app(
+    sessionmaker_f: sessionmaker[Session],
+    async_sessionmaker_f: async_sessionmaker[AsyncSession],
+    derivative_executor: ThreadPoolExecutor,
+    result_storage: JobResultStorage,
+    job_event_broker: JobEventBroker,
+) -> YieldFixtureResult[FastAPI]:
     import template_matching_api.main as entrypoint
     import template_matching_api.api.dependencies as dependencies
 
     app = entrypoint.app
     app.dependency_overrides[dependencies.get_session_maker] = lambda: sessionmaker_f
+    app.dependency_overrides[dependencies.get_async_session_maker] = lambda: async_sessionmaker_f
+    app.dependency_overrides[dependencies.get_template_storage] = InMemoryTemplateStorage
+    app.dependency_overrides[dependencies.get_derivative_executor] = lambda: derivative_executor
+    app.dependency_overrides[dependencies.get_result_storage] = lambda: result_storage
+    app.dependency_overrides[dependencies.get_job_event_broker] = lambda: job_event_broker
     yield app
+    app.dependency_overrides.clear()
 
 
 @pytest.fixture(scope="function")
@@ -69,6 +128,11 @@ def with_test_db(
 @pytest.fixture(scope="function", autouse=True)
 def with_mock_storage(monkeypatch: MonkeyPatch) -> YieldFixtureResult[None]:
     with monkeypatch.context() as m:
-        m.setattr("template_matching_api.file_storage.DocumentTemplateStorage", InMemoryTemplateStorage)
+        m.setattr(
+            "template_matching_api.file_storage.create_template_storage",
+            lambda _settings: InMemoryTemplateStorage(),
+        )
         yield
     DT_STORAGE.clear()
+    DT_DERIVATIVES.clear()
+    DT_UPLOADS.clear()
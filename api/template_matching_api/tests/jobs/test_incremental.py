@@ -0,0 +1,51 @@
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.jobs.incremental import run_incrementally
+from template_matching_api.jobs.queue import RunSummary
+from template_matching_api.jobs.template_matching_job import mock_job_result_columns
+from template_matching_api.result_storage import JobResultColumns, JobResultStorage
+
+
+def _template(template_id: int, sha256: str) -> DocumentTemplate:
+    return DocumentTemplate(id=template_id, template_sha256=sha256, uploaded_at=datetime(2024, 1, 1))
+
+
+def test_run_incrementally(tmp_path: Path) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    computed: list[int] = []
+
+    def compute(template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+        computed.append(template.id)
+        return mock_job_result_columns([template.id], data_specification)
+
+    templates = [_template(1, "a"), _template(2, "b"), _template(3, "c")]
+    first = run_incrementally(1, templates, DataSpecification(), storage, compute)
+    assert computed == [1, 2, 3]
+    assert first.summary == RunSummary(templates_computed=3, templates_reused=0, reused_run_time=0)
+    assert first.columns.templates.tolist() == [1, 2, 3]
+    assert first.columns.num_results == first.columns.offsets[-1]
+
+    # Template 2 re-uploaded, template 4 added, template 1 removed
+    computed.clear()
+    templates = [_template(2, "b2"), _template(3, "c"), _template(4, "d")]
+    second = run_incrementally(1, templates, DataSpecification(), storage, compute)
+    assert computed == [2, 4]
+    assert second.summary.templates_computed == 2
+    assert second.summary.templates_reused == 1
+    assert second.columns.templates.tolist() == [2, 3, 4]
+    reused_rows, previous_rows = second.columns.template_rows(1), first.columns.template_rows(2)
+    assert np.array_equal(second.columns.score[reused_rows], first.columns.score[previous_rows])
+    reused = storage.load_partial(1, second.partial_keys[1])
+    assert reused is not None
+    assert second.summary.reused_run_time == reused.total_run_time
+
+    # Another data specification changes the inputs of every template
+    computed.clear()
+    run_incrementally(1, templates, DataSpecification(file_type=FileType.PDF), storage, compute)
+    assert computed == [2, 3, 4]
@@ -0,0 +1,157 @@
+import io
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+from PIL import Image
+from pytest import MonkeyPatch
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.derivatives import PYRAMID_NAME, UNVERSIONED, build_pyramid
+from template_matching_api.jobs import memoization, template_matching_job
+from template_matching_api.jobs.matching_engine import NccMatchingEngine, ncc_scores
+from template_matching_api.jobs.memoization import compute_input_hash, compute_template_input_hash
+from template_matching_api.result_storage import FILE_TYPES
+from template_matching_api.sample_corpus import LocalSampleCorpus, create_sample_corpus
+from template_matching_api.settings import Settings
+from template_matching_api.tests.storage import InMemoryTemplateStorage
+
+
+def _random_images(rng: np.random.Generator, num_images: int, height: int, width: int) -> npt.NDArray[np.float32]:
+    return rng.random((num_images, height, width), dtype=np.float32)
+
+
+def _brute_force_ncc(template: npt.NDArray[np.float32], image: npt.NDArray[np.float32]) -> float:
+    height, width = template.shape
+    centered = template - template.mean()
+    best = 0.0
+    for y in range(image.shape[0] - height + 1):
+        for x in range(image.shape[1] - width + 1):
+            window = image[y:y + height, x:x + width]
+            window = window - window.mean()
+            best = max(best, float((window * centered).sum() / np.sqrt((window**2).sum() * (centered**2).sum())))
+    return best
+
+
+def test_ncc_scores_match_brute_force() -> None:
+    rng = np.random.default_rng(0)
+    images = _random_images(rng, 3, 20, 24)
+    template = images[1, 5:13, 7:17].copy()
+    template[0, 0] = 0.5
+
+    scores = ncc_scores([template], images, scale_levels=1)
+    np.testing.assert_allclose(scores, [_brute_force_ncc(template, image) for image in images], atol=1e-4)
+    assert scores[1] > 0.95
+
+
+def test_ncc_scores_flat_and_oversized() -> None:
+    rng = np.random.default_rng(1)
+    template = _random_images(rng, 1, 8, 8)[0]
+    images = np.stack([np.full((16, 16), 0.5, dtype=np.float32), _random_images(rng, 1, 16, 16)[0]])
+
+    scores = ncc_scores([template], images, scale_levels=1)
+    assert scores[0] == 0 and 0 <= scores[1] < 1
+    assert ncc_scores([np.full((8, 8), 0.5, dtype=np.float32)], images, scale_levels=1).tolist() == [0, 0]
+    assert ncc_scores([_random_images(rng, 1, 32, 8)[0]], images, scale_levels=1).tolist() == [0, 0]
+
+
+def test_ncc_scores_multi_scale_and_early_exit() -> None:
+    rng = np.random.default_rng(2)
+    pyramid = build_pyramid(_random_images(rng, 1, 64, 64)[0])
+    images = _random_images(rng, 3, 96, 96)
+    # The template at half size
+    images[0, 10:42, 20:52] = pyramid[1]
+    images[2, :64, :64] = pyramid[0]
+
+    full_size = ncc_scores(pyramid, images, scale_levels=1)
+    assert full_size[0] < 0.5 and full_size[2] > 0.99
+    scores = ncc_scores(pyramid, images, scale_levels=2)
+    assert scores[0] > 0.99 and scores[1] < 0.5 and scores[2] > 0.99
+
+    # Matching samples skip the remaining levels, the others are searched at every level
+    early_exit = ncc_scores(pyramid, images, scale_levels=2, score_threshold=0.9)
+    np.testing.assert_array_equal(early_exit >= 0.9, scores >= 0.9)
+    np.testing.assert_allclose(early_exit[[0, 1]], scores[[0, 1]], atol=1e-6)
+    assert early_exit[2] == full_size[2]
+
+
+def test_template_results(tmp_path: Path) -> None:
+    rng = np.random.default_rng(3)
+    template_image = _random_images(rng, 1, 24, 32)[0]
+    corpus = LocalSampleCorpus(tmp_path / "samples")
+    matching = _random_images(rng, 1, 48, 48)[0]
+    matching[4:28, 8:40] = template_image
+    corpus.add(3, FileType.IMAGE, date(2024, 5, 2), matching)
+    corpus.add(1, FileType.IMAGE, date(2024, 5, 1), _random_images(rng, 1, 48, 48)[0])
+    corpus.add(2, FileType.PDF, date(2024, 5, 1), _random_images(rng, 1, 64, 48)[0])
+
+    buffer = io.BytesIO()
+    Image.fromarray(np.round(template_image * 255).astype(np.uint8)).save(buffer, format="PNG")
+    template_storage = InMemoryTemplateStorage()
+    template_storage.save(7, buffer.getvalue())
+    template = DocumentTemplate(
+        id=7, name="t", template_filename="t.png", template_file_type="image/png", uploaded_at=datetime.now()
+    )
+    engine = NccMatchingEngine(template_storage, corpus, batch_size=8, scale_levels=2)
+
+    spec = DataSpecification(date_from=date(2024, 5, 1), date_to=date(2024, 5, 2))
+    columns = engine.template_results(template, spec)
+    # Batched by sample size
+    assert columns.sample_id.tolist() == [1, 3, 2]
+    assert columns.template_id.tolist() == [7, 7, 7]
+    assert columns.templates.tolist() == [7] and columns.offsets.tolist() == [0, 3]
+    assert [FILE_TYPES[code] for code in columns.file_type] == [FileType.IMAGE, FileType.IMAGE, FileType.PDF]
+    assert columns.created_at.astype("datetime64[D]").astype(str).tolist() == ["2024-05-01", "2024-05-02", "2024-05-01"]
+    assert columns.score[1] > 0.99 and columns.score[[0, 2]].max() < 0.5
+    # The missing pyramid was generated and stored
+    template_storage.load_derivative(7, UNVERSIONED, PYRAMID_NAME)
+
+    empty = engine.template_results(template, DataSpecification(date_from=date(2020, 1, 1), date_to=date(2020, 1, 1)))
+    assert empty.num_results == 0 and empty.offsets.tolist() == [0, 0]
+
+
+def test_matching_engine_version_keys_memoized_results(monkeypatch: MonkeyPatch) -> None:
+    template = DocumentTemplate(id=1, template_sha256="abc")
+    spec = DataSpecification(date_from=date(2024, 5, 1), date_to=date(2024, 5, 2))
+    mock_hash = compute_template_input_hash(template, spec)
+
+    monkeypatch.setattr(memoization, "get_settings", lambda: Settings(matching_engine="ncc"))
+    ncc_hash = compute_template_input_hash(template, spec)
+    monkeypatch.setattr(memoization, "get_settings", lambda: Settings(matching_engine="ncc", matching_scale_levels=1))
+    assert len({mock_hash, ncc_hash, compute_template_input_hash(template, spec)}) == 3
+
+
+def test_ingested_samples_key_memoized_results(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    settings = Settings(matching_engine="ncc", storage_location=tmp_path)
+    monkeypatch.setattr(memoization, "get_settings", lambda: settings)
+    corpus = create_sample_corpus(settings)
+    template = DocumentTemplate(id=1, template_sha256="abc")
+    spec = DataSpecification(date_from=date(2024, 5, 1), date_to=date(2024, 5, 2))
+    corpus.add(1, FileType.IMAGE, date(2024, 5, 1), np.zeros((8, 8), dtype=np.float32))
+    hashes = compute_input_hash([template], spec), compute_template_input_hash(template, spec)
+
+    corpus.add(2, FileType.IMAGE, date(2024, 5, 3), np.zeros((8, 8), dtype=np.float32))
+    assert (compute_input_hash([template], spec), compute_template_input_hash(template, spec)) == hashes
+    corpus.add(3, FileType.IMAGE, date(2024, 5, 2), np.zeros((8, 8), dtype=np.float32))
+    assert compute_input_hash([template], spec) != hashes[0]
+    assert compute_template_input_hash(template, spec) != hashes[1]
+
+
+def test_open_ended_specification_keys_memoized_results_across_days(monkeypatch: MonkeyPatch, tmp_path: Path) -> None:
+    settings = Settings(matching_engine="ncc", storage_location=tmp_path)
+    monkeypatch.setattr(memoization, "get_settings", lambda: settings)
+    template = DocumentTemplate(id=1, template_sha256="abc")
+    spec = DataSpecification(file_type=FileType.IMAGE)
+    create_sample_corpus(settings).add(1, FileType.IMAGE, date(2024, 5, 1), np.zeros((8, 8), dtype=np.float32))
+    hashes = compute_input_hash([template], spec), compute_template_input_hash(template, spec)
+
+    class Tomorrow(date):
+        @classmethod
+        def today(cls) -> "Tomorrow":
+            return cls.fromordinal(date.today().toordinal() + 1)
+
+    monkeypatch.setattr(template_matching_job, "date", Tomorrow)
+    assert (compute_input_hash([template], spec), compute_template_input_hash(template, spec)) == hashes
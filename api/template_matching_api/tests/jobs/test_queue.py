@@ -0,0 +1,282 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import sessionmaker, Session
+
+from template_matching_api.api_models.template_matching_job import JobState
+from template_matching_api.db import session_scope
+from template_matching_api.db_model import DocumentTemplate, TemplateMatchingJob, TemplateMatchingJobShard, Workspace
+from template_matching_api.jobs.queue import (
+    ShardProgress,
+    cancel_job,
+    claim_next_job,
+    claim_next_shard,
+    create_shards,
+    finish_job,
+    finish_shard,
+    heartbeat,
+    recover_orphaned_jobs,
+    recover_orphaned_shards,
+    shard_heartbeat,
+    shard_progress,
+    submit_job,
+)
+from template_matching_api.tests.api.endpoints.test_document_template import with_document_templates
+from template_matching_api.tests.api.endpoints.test_workspace import with_workspaces
+
+
+@pytest.fixture
+def with_submitted_jobs(
+    with_document_templates: list[DocumentTemplate], with_workspaces: list[Workspace], session: Session
+) -> list[TemplateMatchingJob]:
+    jobs = []
+    for idx, ws in enumerate(with_workspaces[:3]):
+        job = TemplateMatchingJob(workspace_id=ws.id)
+        job.document_templates = with_document_templates[: idx + 1]
+        submit_job(job)
+        job.submitted_at = datetime.now() - timedelta(minutes=10 - idx)
+        session.add(job)
+        jobs.append(job)
+    session.commit()
+    return jobs
+
+
+def test_submit_job_resets_the_run(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    job = with_submitted_jobs[0]
+    run_id = job.job_id
+    claim_next_job(session, "worker-1")
+    session.commit()
+    session.refresh(job)
+
+    submit_job(job)
+    assert job.job_state == JobState.SUBMITTED
+    assert job.job_id != run_id
+    assert job.worker_id is None
+    assert job.attempts == 0
+
+
+def test_claim_next_job_oldest_first(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    claimed = [claim_next_job(session, "worker-1") for _ in with_submitted_jobs]
+    session.commit()
+
+    assert [c.id for c in claimed if c is not None] == [job.id for job in with_submitted_jobs]
+    assert claim_next_job(session, "worker-1") is None
+    for job in with_submitted_jobs:
+        session.refresh(job)
+        assert job.job_state == JobState.RUNNING
+        assert job.worker_id == "worker-1"
+        assert job.attempts == 1
+        assert job.started_at is not None
+        assert job.heartbeat_at is not None
+
+
+def test_claim_next_job_skips_jobs_without_run_id(
+    session: Session, with_submitted_jobs: list[TemplateMatchingJob]
+) -> None:
+    job = with_submitted_jobs[0]
+    job.job_id = None
+    session.commit()
+
+    claimed = [claim_next_job(session, "worker-1") for _ in with_submitted_jobs]
+    session.commit()
+
+    assert [c.id for c in claimed if c is not None] == [job.id for job in with_submitted_jobs[1:]]
+    session.refresh(job)
+    assert job.job_state == JobState.SUBMITTED
+    assert job.worker_id is None
+
+
+def test_concurrent_workers_claim_every_job_once(
+    sessionmaker_f: sessionmaker[Session], with_submitted_jobs: list[TemplateMatchingJob]
+) -> None:
+    def claim_all(worker_id: str) -> list[int]:
+        claimed_ids: list[int] = []
+        while True:
+            with session_scope(sessionmaker_f) as session:
+                claimed = claim_next_job(session, worker_id)
+            if claimed is None:
+                return claimed_ids
+            claimed_ids.append(claimed.id)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        claimed_per_worker = list(executor.map(claim_all, [f"worker-{idx}" for idx in range(4)]))
+
+    claimed_ids = [job_id for claimed_ids in claimed_per_worker for job_id in claimed_ids]
+    assert sorted(claimed_ids) == sorted(job.id for job in with_submitted_jobs)
+
+
+def test_heartbeat_and_finish_require_ownership(
+    session: Session, with_submitted_jobs: list[TemplateMatchingJob]
+) -> None:
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    session.commit()
+    assert heartbeat(session, claimed)
+
+    job = session.get_one(TemplateMatchingJob, claimed.id)
+    submit_job(job)
+    session.commit()
+
+    assert not heartbeat(session, claimed)
+    assert not finish_job(session, claimed, JobState.SUCCEEDED)
+    session.commit()
+    session.refresh(job)
+    assert job.job_state == JobState.SUBMITTED
+
+
+def test_finish_job(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    assert finish_job(session, claimed, JobState.FAILED, "ValueError: broken")
+    session.commit()
+
+    job = session.get_one(TemplateMatchingJob, claimed.id)
+    assert job.job_state == JobState.FAILED
+    assert job.error == "ValueError: broken"
+    assert job.finished_at is not None
+    # Finishing twice is a no-op
+    assert not finish_job(session, claimed, JobState.SUCCEEDED)
+
+
+def test_recover_orphaned_jobs(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    timeout = timedelta(seconds=30)
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    session.commit()
+    assert recover_orphaned_jobs(session, timeout, max_attempts=2) == 0
+
+    job = session.get_one(TemplateMatchingJob, claimed.id)
+    job.heartbeat_at = datetime.now() - 2 * timeout
+    session.commit()
+    assert recover_orphaned_jobs(session, timeout, max_attempts=2) == 1
+    session.commit()
+    session.refresh(job)
+    assert job.job_state == JobState.SUBMITTED
+    assert job.worker_id is None
+    # The run is kept, the worker that lost it can not finish it anymore
+    assert job.job_id == claimed.run_id
+    assert not finish_job(session, claimed, JobState.SUCCEEDED)
+
+    # Oldest first again, the recovered job is picked up before the others
+    reclaimed = claim_next_job(session, "worker-2")
+    assert reclaimed is not None and reclaimed.id == job.id
+    session.commit()
+    session.refresh(job)
+    assert job.attempts == 2
+
+    job.heartbeat_at = datetime.now() - 2 * timeout
+    session.commit()
+    assert recover_orphaned_jobs(session, timeout, max_attempts=2) == 1
+    session.commit()
+    session.refresh(job)
+    assert job.job_state == JobState.FAILED
+    assert job.error is not None
+
+
+def test_shards(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    create_shards(session, claimed, [[1], [2, 3]])
+    # Claimed again after a recovery, the shards of the run are kept
+    create_shards(session, claimed, [[1, 2, 3]])
+    session.commit()
+    assert shard_progress(session, claimed) == ShardProgress(total=2, succeeded=0, error=None)
+
+    first = claim_next_shard(session, "worker-2")
+    second = claim_next_shard(session, "worker-1", job_id=claimed.id)
+    assert first is not None and second is not None
+    assert (first.document_template_ids, second.document_template_ids) == ([1], [2, 3])
+    assert claim_next_shard(session, "worker-1") is None
+    assert shard_heartbeat(session, first)
+
+    assert finish_shard(session, first)
+    # Retried until it was started `max_attempts` times
+    assert finish_shard(session, second, "ValueError: broken", max_attempts=2)
+    assert shard_progress(session, claimed) == ShardProgress(total=2, succeeded=1, error=None)
+    retried = claim_next_shard(session, "worker-2")
+    assert retried is not None and retried.id == second.id and retried.attempts == 2
+    assert not finish_shard(session, second)
+    assert finish_shard(session, retried, "ValueError: still broken", max_attempts=2)
+    assert shard_progress(session, claimed) == ShardProgress(total=2, succeeded=1, error="ValueError: still broken")
+    assert claim_next_shard(session, "worker-2") is None
+
+
+def test_shards_of_discarded_runs(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    create_shards(session, claimed, [[1]])
+    session.commit()
+
+    job = session.get_one(TemplateMatchingJob, claimed.id)
+    submit_job(job)
+    job.submitted_at = datetime.now() - timedelta(days=1)
+    session.commit()
+    assert claim_next_shard(session, "worker-2") is None
+
+    reclaimed = claim_next_job(session, "worker-2")
+    assert reclaimed is not None and reclaimed.id == job.id
+    create_shards(session, reclaimed, [[1], [2]])
+    session.commit()
+    assert shard_progress(session, reclaimed).total == 2
+    assert session.scalar(select(func.count()).select_from(TemplateMatchingJobShard)) == 2
+
+
+def test_cancel_job(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    create_shards(session, claimed, [[1], [2]])
+    session.commit()
+    shard = claim_next_shard(session, "worker-2")
+    assert shard is not None
+
+    queued = next(job for job in with_submitted_jobs if job.id != claimed.id)
+    assert cancel_job(session, queued.id)
+    assert cancel_job(session, claimed.id)
+    assert not cancel_job(session, claimed.id)
+    session.commit()
+    assert claim_next_job(session, "worker-2") is not None
+    assert claim_next_job(session, "worker-2") is None
+
+    # The workers notice through their heartbeats, their results are not recorded
+    assert not heartbeat(session, claimed)
+    assert not shard_heartbeat(session, shard)
+    assert not finish_shard(session, shard)
+    assert not finish_job(session, claimed, JobState.SUCCEEDED)
+    assert claim_next_shard(session, "worker-2") is None
+    job = session.get_one(TemplateMatchingJob, claimed.id)
+    session.refresh(job)
+    assert (job.job_state, job.error) == (JobState.CANCELLED, "Cancelled")
+    states = session.scalars(select(TemplateMatchingJobShard.state)).all()
+    assert states == [JobState.CANCELLED, JobState.CANCELLED]
+
+
+def test_failed_job_cancels_its_shards(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    create_shards(session, claimed, [[1], [2]])
+    first = claim_next_shard(session, "worker-1")
+    assert first is not None and finish_shard(session, first)
+    assert finish_job(session, claimed, JobState.FAILED, "JobTimeoutError: too slow")
+    session.commit()
+    states = session.scalars(
+        select(TemplateMatchingJobShard.state).order_by(TemplateMatchingJobShard.shard_index)
+    ).all()
+    assert states == [JobState.SUCCEEDED, JobState.CANCELLED]
+
+
+def test_recover_orphaned_shards(session: Session, with_submitted_jobs: list[TemplateMatchingJob]) -> None:
+    timeout = timedelta(seconds=30)
+    claimed = claim_next_job(session, "worker-1")
+    assert claimed is not None
+    create_shards(session, claimed, [[1]])
+    shard = claim_next_shard(session, "worker-2")
+    assert shard is not None
+    session.commit()
+    assert recover_orphaned_shards(session, timeout, max_attempts=1) == 0
+
+    session.execute(update(TemplateMatchingJobShard).values(heartbeat_at=datetime.now() - 2 * timeout))
+    assert recover_orphaned_shards(session, timeout, max_attempts=1) == 1
+    assert not finish_shard(session, shard)
+    assert shard_progress(session, claimed).error == "Worker stopped responding, gave up after 1 attempts"
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from template_matching_api.api_models.template_matching_job import JobState
+from template_matching_api.db_model import TemplateMatchingJob, Workspace
+from template_matching_api.jobs.queue import claim_next_job, finish_job, submit_job
+from template_matching_api.tests.api.endpoints.test_workspace import with_workspaces
+
+
+def _submit_jobs(session: Session, workspace: Workspace, num_jobs: int, priority: int = 0) -> list[int]:
+    jobs = []
+    num_submitted = session.scalar(select(func.count()).select_from(TemplateMatchingJob)) or 0
+    for idx in range(num_jobs):
+        job = TemplateMatchingJob(workspace_id=workspace.id, priority=priority)
+        submit_job(job)
+        # Submitted one after the other
+        job.submitted_at = datetime.now() - timedelta(hours=1) + timedelta(seconds=num_submitted + idx)
+        session.add(job)
+        jobs.append(job)
+    session.commit()
+    return [job.id for job in jobs]
+
+
+def _claim_workspaces(session: Session, num_claims: int) -> list[int | None]:
+    workspace_ids = []
+    for _ in range(num_claims):
+        claimed = claim_next_job(session, "worker-1")
+        job = None if claimed is None else session.get_one(TemplateMatchingJob, claimed.id)
+        workspace_ids.append(None if job is None else job.workspace_id)
+    session.commit()
+    return workspace_ids
+
+
+def test_workspaces_share_workers(session: Session, with_workspaces: list[Workspace]) -> None:
+    busy, other = with_workspaces[:2]
+    _submit_jobs(session, busy, 6)
+    _submit_jobs(session, other, 2)
+    # The busy workspace submitted its jobs first, but does not starve the other one
+    assert _claim_workspaces(session, 5) == [busy.id, other.id, busy.id, other.id, busy.id]
+
+
+def _run_workspaces_one_at_a_time(session: Session, num_runs: int) -> list[int | None]:
+    """Workspaces of the jobs a single worker runs one after the other"""
+    workspace_ids: list[int | None] = []
+    for _ in range(num_runs):
+        claimed = claim_next_job(session, "worker-1")
+        if claimed is None:
+            workspace_ids.append(None)
+            continue
+        workspace_ids.append(session.get_one(TemplateMatchingJob, claimed.id).workspace_id)
+        assert finish_job(session, claimed, JobState.SUCCEEDED)
+        session.commit()
+    return workspace_ids
+
+
+def test_workspaces_take_turns_on_a_single_worker(session: Session, with_workspaces: list[Workspace]) -> None:
+    busy, other = with_workspaces[:2]
+    _submit_jobs(session, busy, 6)
+    _submit_jobs(session, other, 2)
+    # Nothing is running when the next job is claimed, jobs run recently still count
+    assert _run_workspaces_one_at_a_time(session, 9) == [
+        busy.id, other.id, busy.id, other.id, busy.id, busy.id, busy.id, busy.id, None
+    ]
+
+
+def test_workspace_weights_on_a_single_worker(session: Session, with_workspaces: list[Workspace]) -> None:
+    heavy, light = with_workspaces[:2]
+    heavy.job_weight = 2.0
+    _submit_jobs(session, heavy, 6)
+    _submit_jobs(session, light, 6)
+    assert _run_workspaces_one_at_a_time(session, 6) == [heavy.id, light.id, heavy.id, heavy.id, light.id, heavy.id]
+
+
+def test_fairness_window(session: Session, with_workspaces: list[Workspace]) -> None:
+    busy, other = with_workspaces[:2]
+    _submit_jobs(session, busy, 2)
+    assert _run_workspaces_one_at_a_time(session, 1) == [busy.id]
+    _submit_jobs(session, other, 1)
+    # Jobs started before the window do not count anymore
+    assert claim_next_job(session, "worker-1", fairness_window=timedelta(0)) is not None
+    session.commit()
+    assert session.scalars(
+        select(TemplateMatchingJob.workspace_id).where(TemplateMatchingJob.job_state == JobState.RUNNING)
+    ).one() == busy.id
+
+
+def test_workspace_weights(session: Session, with_workspaces: list[Workspace]) -> None:
+    heavy, light = with_workspaces[:2]
+    heavy.job_weight = 2.0
+    _submit_jobs(session, heavy, 6)
+    _submit_jobs(session, light, 6)
+    assert _claim_workspaces(session, 6) == [heavy.id, light.id, heavy.id, heavy.id, light.id, heavy.id]
+
+
+def test_workspace_concurrency_limit(session: Session, with_workspaces: list[Workspace]) -> None:
+    limited, other = with_workspaces[:2]
+    limited.max_concurrent_jobs = 1
+    _submit_jobs(session, limited, 3)
+    _submit_jobs(session, other, 1)
+    assert _claim_workspaces(session, 3) == [limited.id, other.id, None]
+
+    running = session.scalars(
+        select(TemplateMatchingJob).where(
+            TemplateMatchingJob.workspace_id == limited.id, TemplateMatchingJob.job_state == JobState.RUNNING
+        )
+    ).one()
+    running.job_state = JobState.SUCCEEDED
+    session.commit()
+    assert _claim_workspaces(session, 1) == [limited.id]
+
+
+def test_job_priority(session: Session, with_workspaces: list[Workspace]) -> None:
+    low = _submit_jobs(session, with_workspaces[0], 2)
+    high = _submit_jobs(session, with_workspaces[0], 1, priority=5)
+    claimed = [claim_next_job(session, "worker-1") for _ in range(3)]
+    assert [c.id for c in claimed if c is not None] == high + low
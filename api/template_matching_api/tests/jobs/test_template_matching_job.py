@@ -0,0 +1,36 @@
+from datetime import date, datetime
+
+import numpy as np
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import ExtendedSampleResult, FileType
+from template_matching_api.api_models.template_matching_job import TemplateMatchingJobResults
+from template_matching_api.jobs.template_matching_job import mock_job_result_columns
+from template_matching_api.result_storage import FILE_TYPES, encode_results
+
+
+def test_mock_job_result_columns() -> None:
+    columns = mock_job_result_columns([5, 3, 8], DataSpecification(), rng=np.random.default_rng(0))
+
+    assert columns.templates.tolist() == [5, 3, 8]
+    assert columns.offsets[0] == 0 and columns.offsets[-1] == columns.num_results
+    for template_id, rows in columns.iter_templates():
+        assert 1 <= rows.stop - rows.start <= 100
+        assert set(columns.template_id[rows].tolist()) == {template_id}
+    assert columns.sample_id.tolist() == list(range(1, columns.num_results + 1))
+    assert ((columns.score >= 0) & (columns.score < 1)).all()
+
+
+def test_mock_job_result_columns_respect_data_spec() -> None:
+    data_spec = DataSpecification(file_type=FileType.PDF, date_from=date(2024, 2, 27), date_to=date(2024, 3, 2))
+    columns = mock_job_result_columns([1, 2], data_spec, num_samples=500)
+
+    assert columns.num_results == 1000
+    assert (columns.file_type == FILE_TYPES.index(FileType.PDF)).all()
+
+    results = TemplateMatchingJobResults.model_validate_json(encode_results(columns))
+    for template_results in results.results_per_template:
+        for sample_result in template_results.sample_results:
+            assert isinstance(sample_result, ExtendedSampleResult)
+            assert sample_result.file_type == FileType.PDF
+            assert datetime(2024, 2, 27) <= sample_result.created_at <= datetime(2024, 3, 2)
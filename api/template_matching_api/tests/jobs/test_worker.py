@@ -0,0 +1,384 @@
+import io
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pytest import MonkeyPatch
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker, Session
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.api_models.template_matching_job import JobState
+from template_matching_api.db import session_scope
+from template_matching_api.db_model import DocumentTemplate, TemplateMatchingJob, TemplateMatchingJobShard
+from template_matching_api.derivatives import PYRAMID_NAME, UNVERSIONED
+from template_matching_api.jobs import memoization, worker
+from template_matching_api.jobs.matching_engine import NccMatchingEngine
+from template_matching_api.jobs.memoization import compute_template_input_hash
+from template_matching_api.jobs.queue import ClaimedJob, cancel_job, submit_job
+from template_matching_api.jobs.template_matching_job import job_data_specification, mock_job_result_columns
+from template_matching_api.jobs.worker import JobWorker
+from template_matching_api.result_storage import PARTIALS_DIR, JobResultColumns, JobResultStorage, ResultsNotFoundError
+from template_matching_api.sample_corpus import LocalSampleCorpus, create_sample_corpus
+from template_matching_api.settings import Settings
+from template_matching_api.tests.storage import InMemoryTemplateStorage
+from template_matching_api.tests.api.endpoints.test_document_template import with_document_templates
+from template_matching_api.tests.api.endpoints.test_workspace import with_workspaces
+from .test_queue import with_submitted_jobs
+
+
+def test_run_once(
+    job_worker: JobWorker,
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+) -> None:
+    for _ in with_submitted_jobs:
+        assert job_worker.run_once()
+    assert not job_worker.run_once()
+
+    for job in with_submitted_jobs:
+        session.refresh(job)
+        assert job.job_state == JobState.SUCCEEDED
+        assert job.finished_at is not None
+        assert job.error is None
+        assert job.job_id is not None
+        columns = result_storage.load(job.id, job.job_id)
+        assert columns.templates.tolist() == job.document_template_ids
+
+
+def test_run_once_prunes_previous_runs(
+    job_worker: JobWorker,
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+) -> None:
+    job = with_submitted_jobs[0]
+    assert job_worker.run_once()
+    session.refresh(job)
+    previous_run_id = job.job_id
+    assert previous_run_id is not None
+
+    submit_job(job)
+    job.submitted_at = datetime.now() - timedelta(days=1)
+    session.commit()
+    assert job_worker.run_once()
+    session.refresh(job)
+
+    assert job.job_id != previous_run_id
+    assert job.job_id is not None
+    result_storage.load(job.id, job.job_id)
+    with pytest.raises(ResultsNotFoundError):
+        result_storage.load(job.id, previous_run_id)
+
+
+def test_run_once_reuses_results_of_unchanged_templates(
+    job_worker: JobWorker,
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+) -> None:
+    job = with_submitted_jobs[2]
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    assert job_worker.run_once()
+    session.refresh(job)
+    assert (job.templates_computed, job.templates_reused, job.reused_run_time) == (3, 0, 0)
+    assert job.job_id is not None
+    previous = result_storage.load(job.id, job.job_id)
+
+    # Re-upload of the first template
+    job.document_templates[0].template_sha256 = "0" * 64
+    submit_job(job)
+    session.commit()
+    assert job_worker.run_once()
+    session.refresh(job)
+    assert (job.templates_computed, job.templates_reused) == (1, 2)
+    assert job.job_id is not None
+    columns = result_storage.load(job.id, job.job_id)
+    assert columns.templates.tolist() == previous.templates.tolist()
+    for template_idx in (1, 2):
+        assert np.array_equal(
+            columns.score[columns.template_rows(template_idx)], previous.score[previous.template_rows(template_idx)]
+        )
+    reused = [
+        result_storage.load_partial(job.id, compute_template_input_hash(template, job_data_specification(job)))
+        for template in job.document_templates[1:]
+    ]
+    assert job.reused_run_time == sum(partial.total_run_time for partial in reused if partial is not None)
+    # Only the partial results of the current inputs are kept
+    assert len(list((result_storage.location / str(job.id) / PARTIALS_DIR).iterdir())) == 3
+
+
+def test_run_once_failing_job(
+    job_worker: JobWorker,
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    def failing_load_job_inputs(_session_maker: sessionmaker[Session], _job_id: int) -> None:
+        raise RuntimeError("no samples")
+
+    monkeypatch.setattr(worker, "load_job_inputs", failing_load_job_inputs)
+    assert job_worker.run_once()
+
+    job = with_submitted_jobs[0]
+    session.refresh(job)
+    assert job.job_state == JobState.FAILED
+    assert job.error == "RuntimeError: no samples"
+    assert job.job_id is not None
+    with pytest.raises(ResultsNotFoundError):
+        result_storage.load(job.id, job.job_id)
+
+
+def test_run_once_retries_failed_shards(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    job = with_submitted_jobs[2]
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    failing_template_id = job.document_template_ids[1]
+    computed: list[int] = []
+
+    def flaky_compute(template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+        computed.append(template.id)
+        if template.id == failing_template_id and computed.count(template.id) == 1:
+            raise RuntimeError("flaky")
+        return mock_job_result_columns([template.id], data_specification)
+
+    monkeypatch.setattr(worker, "_compute_template_results", flaky_compute)
+    settings = Settings(job_heartbeat_interval_seconds=0.01, job_shard_size=1)
+    assert JobWorker(sessionmaker_f, "worker-1", settings, result_storage).run_once()
+
+    session.refresh(job)
+    assert job.job_state == JobState.SUCCEEDED
+    # Only the failed shard was computed again
+    assert sorted(computed) == sorted([*job.document_template_ids, failing_template_id])
+    shards = session.scalars(
+        select(TemplateMatchingJobShard).order_by(TemplateMatchingJobShard.shard_index)
+    ).all()
+    assert [shard.document_template_ids for shard in shards] == [
+        [template_id] for template_id in job.document_template_ids
+    ]
+    assert [shard.attempts for shard in shards] == [1, 2, 1]
+    assert all(shard.state == JobState.SUCCEEDED for shard in shards)
+    assert job.job_id is not None
+    assert result_storage.load(job.id, job.job_id).templates.tolist() == job.document_template_ids
+
+
+def test_run_once_failing_shard(
+    job_worker: JobWorker,
+    session: Session,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    def failing_compute(_template: DocumentTemplate, _data_specification: DataSpecification) -> JobResultColumns:
+        raise RuntimeError("no samples")
+
+    monkeypatch.setattr(worker, "_compute_template_results", failing_compute)
+    assert job_worker.run_once()
+
+    job = with_submitted_jobs[0]
+    session.refresh(job)
+    assert job.job_state == JobState.FAILED
+    assert job.error == "ShardFailedError: RuntimeError: no samples"
+
+
+def test_run_once_timeout(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+) -> None:
+    job = with_submitted_jobs[0]
+    job.timeout_seconds = 1e-6
+    session.commit()
+    # The job's own timeout takes precedence
+    settings = Settings(job_heartbeat_interval_seconds=0.01, job_timeout_seconds=3600)
+    assert JobWorker(sessionmaker_f, "worker-1", settings, result_storage).run_once()
+
+    session.refresh(job)
+    assert job.job_state == JobState.FAILED
+    assert job.error is not None and job.error.startswith("JobTimeoutError: ")
+    shards = session.scalars(select(TemplateMatchingJobShard.state)).all()
+    assert shards == [JobState.CANCELLED]
+
+
+def test_run_once_cancelled_job(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    job = with_submitted_jobs[2]
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    computed: list[int] = []
+
+    def cancelling_compute(template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+        computed.append(template.id)
+        with session_scope(sessionmaker_f) as cancel_session:
+            assert cancel_job(cancel_session, job.id)
+        return mock_job_result_columns([template.id], data_specification)
+
+    monkeypatch.setattr(worker, "_compute_template_results", cancelling_compute)
+    settings = Settings(job_heartbeat_interval_seconds=0.01, job_shard_size=1)
+    assert JobWorker(sessionmaker_f, "worker-1", settings, result_storage).run_once()
+
+    # Stopped after the shard it was computing
+    assert computed == job.document_template_ids[:1]
+    session.refresh(job)
+    assert job.job_state == JobState.CANCELLED
+    assert job.job_id is not None
+    with pytest.raises(ResultsNotFoundError):
+        result_storage.load(job.id, job.job_id)
+
+
+def test_run_once_cancelled_in_the_middle_of_a_shard(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    job = with_submitted_jobs[2]
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    computed: list[int] = []
+
+    def cancelling_compute(template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+        computed.append(template.id)
+        with session_scope(sessionmaker_f) as cancel_session:
+            assert cancel_job(cancel_session, job.id)
+        # Until the shard heartbeat notices the cancellation
+        time.sleep(0.2)
+        return mock_job_result_columns([template.id], data_specification)
+
+    monkeypatch.setattr(worker, "_compute_template_results", cancelling_compute)
+    settings = Settings(job_heartbeat_interval_seconds=0.01, job_shard_size=10)
+    assert JobWorker(sessionmaker_f, "worker-1", settings, result_storage).run_once()
+
+    # The remaining templates of the shard were not computed
+    assert len(job.document_template_ids) > 1
+    assert computed == job.document_template_ids[:1]
+    session.refresh(job)
+    assert job.job_state == JobState.CANCELLED
+    assert session.scalars(select(TemplateMatchingJobShard.state)).all() == [JobState.CANCELLED]
+
+
+def test_run_once_timeout_in_the_middle_of_a_shard(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+) -> None:
+    job = with_submitted_jobs[2]
+    job.timeout_seconds = 0.1
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    computed: list[int] = []
+
+    def slow_compute(template: DocumentTemplate, data_specification: DataSpecification) -> JobResultColumns:
+        computed.append(template.id)
+        time.sleep(0.3)
+        return mock_job_result_columns([template.id], data_specification)
+
+    monkeypatch.setattr(worker, "_compute_template_results", slow_compute)
+    settings = Settings(job_heartbeat_interval_seconds=0.01, job_shard_size=10)
+    assert JobWorker(sessionmaker_f, "worker-1", settings, result_storage).run_once()
+
+    assert computed == job.document_template_ids[:1]
+    session.refresh(job)
+    assert job.job_state == JobState.FAILED
+    assert job.error is not None and job.error.startswith("JobTimeoutError: ")
+
+
+def test_run_once_with_ncc_engine(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    tmp_path: Path,
+) -> None:
+    job = with_submitted_jobs[0]
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    rng = np.random.default_rng(0)
+    template_storage = InMemoryTemplateStorage()
+    [template] = job.document_templates
+    template_image = rng.random((16, 16), dtype=np.float32)
+    buffer = io.BytesIO()
+    np.savez(buffer, level_0=template_image)
+    template_storage.save_derivative(template.id, UNVERSIONED, PYRAMID_NAME, buffer.getvalue())
+    corpus = LocalSampleCorpus(tmp_path / "samples")
+    matching = rng.random((32, 32), dtype=np.float32)
+    matching[8:24, 4:20] = template_image
+    corpus.add(1, FileType.PDF, date.today(), matching)
+    corpus.add(2, FileType.PDF, date.today(), rng.random((32, 32), dtype=np.float32))
+    # Not part of the job's data specification
+    corpus.add(3, FileType.IMAGE, date.today(), matching)
+
+    engine = NccMatchingEngine(template_storage, corpus, batch_size=4, scale_levels=1)
+    settings = Settings(job_heartbeat_interval_seconds=0.01)
+    assert JobWorker(sessionmaker_f, "worker-1", settings, result_storage, engine).run_once()
+
+    session.refresh(job)
+    assert job.job_state == JobState.SUCCEEDED
+    assert job.job_id is not None
+    columns = result_storage.load(job.id, job.job_id)
+    assert columns.sample_id.tolist() == [1, 2]
+    assert columns.score[0] > 0.99 and columns.score[1] < 0.5
+
+
+def test_run_once_with_ncc_engine_recomputes_after_ingestion(
+    sessionmaker_f: sessionmaker[Session],
+    session: Session,
+    result_storage: JobResultStorage,
+    with_submitted_jobs: list[TemplateMatchingJob],
+    monkeypatch: MonkeyPatch,
+    tmp_path: Path,
+) -> None:
+    job = with_submitted_jobs[0]
+    session.execute(update(TemplateMatchingJob).where(TemplateMatchingJob.id != job.id).values(job_state=None))
+    session.commit()
+    settings = Settings(job_heartbeat_interval_seconds=0.01, matching_engine="ncc", storage_location=tmp_path)
+    monkeypatch.setattr(memoization, "get_settings", lambda: settings)
+    rng = np.random.default_rng(0)
+    template_storage = InMemoryTemplateStorage()
+    [template] = job.document_templates
+    buffer = io.BytesIO()
+    np.savez(buffer, level_0=rng.random((8, 8), dtype=np.float32))
+    template_storage.save_derivative(template.id, UNVERSIONED, PYRAMID_NAME, buffer.getvalue())
+    corpus = create_sample_corpus(settings)
+    corpus.add(1, FileType.PDF, date.today(), rng.random((16, 16), dtype=np.float32))
+    job_worker = JobWorker(
+        sessionmaker_f, "worker-1", settings, result_storage, NccMatchingEngine(template_storage, corpus, 4, 1)
+    )
+
+    def rerun() -> JobResultColumns:
+        submit_job(job)
+        session.commit()
+        assert job_worker.run_once()
+        session.refresh(job)
+        assert job.job_state == JobState.SUCCEEDED and job.job_id is not None
+        return result_storage.load(job.id, job.job_id)
+
+    assert rerun().sample_id.tolist() == [1]
+    assert (job.templates_computed, job.templates_reused) == (1, 0)
+    assert rerun().sample_id.tolist() == [1]
+    assert (job.templates_computed, job.templates_reused) == (0, 1)
+
+    # Ingested into a partition the job selects
+    corpus.add(2, FileType.PDF, date.today(), rng.random((16, 16), dtype=np.float32))
+    assert rerun().sample_id.tolist() == [1, 2]
+    assert (job.templates_computed, job.templates_reused) == (1, 0)
@@ -1,10 +1,36 @@
+import hashlib
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from template_matching_api.file_storage import (
+    READ_CHUNK_SIZE,
+    StoredTemplate,
+    TemplateDigest,
+    TemplateTooLargeError,
+)
+
 DT_STORAGE = {}
+DT_DERIVATIVES: dict[tuple[int, str, str], bytes] = {}
+DT_UPLOADS: dict[str, bytearray] = {}
 
 
 class InMemoryTemplateStorage:
     def save(self, template_id: int, file_bytes: bytes) -> None:
+        self._drop_derivatives(template_id)
         DT_STORAGE[template_id] = file_bytes
 
+    def save_stream(
+        self, template_id: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> StoredTemplate:
+        digest = TemplateDigest(max_size)
+        file_bytes = b""
+        for chunk in chunks:
+            digest.update(chunk)
+            file_bytes += chunk
+        self._drop_derivatives(template_id)
+        DT_STORAGE[template_id] = file_bytes
+        return digest.result()
+
     def load(self, template_id: int) -> bytes:
         file_bytes = DT_STORAGE.get(template_id)
         if file_bytes is None:
@@ -12,8 +38,58 @@ class InMemoryTemplateStorage:
 
         return file_bytes
 
+    def size(self, template_id: int) -> int:
+        return len(self.load(template_id))
+
+    def iter_range(
+        self, template_id: int, start: int = 0, end: int | None = None, chunk_size: int = READ_CHUNK_SIZE
+    ) -> Iterator[bytes]:
+        file_bytes = self.load(template_id)[start:end]
+        for offset in range(0, len(file_bytes), chunk_size):
+            yield file_bytes[offset : offset + chunk_size]
+
+    def local_path(self, template_id: int) -> Path | None:
+        return None
+
     def delete(self, template_id: int) -> None:
         if template_id in DT_STORAGE:
             del DT_STORAGE[template_id]
+            self._drop_derivatives(template_id)
         else:
             raise FileNotFoundError()
+
+    def save_derivative(self, template_id: int, version: str, name: str, file_bytes: bytes) -> None:
+        DT_DERIVATIVES[(template_id, version, name)] = file_bytes
+
+    def load_derivative(self, template_id: int, version: str, name: str) -> bytes:
+        file_bytes = DT_DERIVATIVES.get((template_id, version, name))
+        if file_bytes is None:
+            raise FileNotFoundError()
+
+        return file_bytes
+
+    def write_upload_chunk(
+        self, upload_id: str, offset: int, chunks: Iterable[bytes], max_size: int | None = None
+    ) -> int:
+        upload = DT_UPLOADS.setdefault(upload_id, bytearray())
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            if max_size is not None and written > max_size:
+                raise TemplateTooLargeError(max_size)
+            upload[offset + written - len(chunk) : offset + written] = chunk
+        return written
+
+    def finalize_upload(self, upload_id: str, template_id: int, size: int) -> StoredTemplate:
+        file_bytes = bytes(DT_UPLOADS.pop(upload_id)[:size])
+        self._drop_derivatives(template_id)
+        DT_STORAGE[template_id] = file_bytes
+        return StoredTemplate(sha256=hashlib.sha256(file_bytes).hexdigest(), size=len(file_bytes))
+
+    def delete_upload(self, upload_id: str) -> None:
+        DT_UPLOADS.pop(upload_id, None)
+
+    @staticmethod
+    def _drop_derivatives(template_id: int) -> None:
+        for key in [key for key in DT_DERIVATIVES if key[0] == template_id]:
+            del DT_DERIVATIVES[key]
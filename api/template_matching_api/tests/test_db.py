@@ -0,0 +1,63 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from pytest import MonkeyPatch
+from sqlalchemy import text
+
+from template_matching_api import db
+from template_matching_api.db import get_db
+from template_matching_api.settings import Settings
+
+
+def test_create_db_engine_sets_sqlite_pragmas(tmp_path: Path) -> None:
+    settings = Settings(
+        db_url=f"sqlite+pysqlite:///{tmp_path / 'test.db'}",
+        sqlite_busy_timeout_ms=1234,
+        sqlite_mmap_size=4096,
+    )
+    engine = db.create_db_engine(settings)
+    with engine.connect() as connection:
+        assert connection.scalar(text("PRAGMA journal_mode")) == "wal"
+        # NORMAL
+        assert connection.scalar(text("PRAGMA synchronous")) == 1
+        assert connection.scalar(text("PRAGMA busy_timeout")) == 1234
+        assert connection.scalar(text("PRAGMA mmap_size")) == 4096
+    assert engine.pool.size() == settings.db_pool_size  # type: ignore[attr-defined]
+    engine.dispose()
+
+
+def test_get_db_is_shared(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    settings = Settings(db_url=f"sqlite+pysqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(db, "get_settings", lambda: settings)
+    monkeypatch.setattr(db, "_engine", None)
+
+    engine = get_db()
+    assert get_db() is engine
+    assert not engine.echo
+
+    db.dispose_db()
+    assert get_db() is not engine
+    db.dispose_db()
+
+
+def test_get_async_db_url(tmp_path: Path) -> None:
+    location = tmp_path / "test.db"
+    for db_url in (f"sqlite:///{location}", f"sqlite+pysqlite:///{location}"):
+        assert Settings(db_url=db_url).get_async_db_url() == f"sqlite+aiosqlite:///{location}"
+    assert Settings(db_url="sqlite://").get_async_db_url() == "sqlite+aiosqlite://"
+    async_db_url = "postgresql+asyncpg://db/matching"
+    assert Settings(db_url="postgresql://db/matching", async_db_url=async_db_url).get_async_db_url() == async_db_url
+    with pytest.raises(ValueError, match="TEMPLATE_MATCHING_ASYNC_DB_URL"):
+        Settings(db_url="postgresql://db/matching").get_async_db_url()
+
+
+def test_create_async_db_engine_from_plain_sqlite_url(tmp_path: Path) -> None:
+    engine = db.create_async_db_engine(Settings(db_url=f"sqlite:///{tmp_path / 'test.db'}"))
+
+    async def journal_mode() -> str:
+        async with engine.connect() as connection:
+            return str(await connection.scalar(text("PRAGMA journal_mode")))
+
+    assert asyncio.run(journal_mode()) == "wal"
+    asyncio.run(engine.dispose())
@@ -0,0 +1,117 @@
+import asyncio
+import io
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from template_matching_api.derivatives import (
+    GRAYSCALE_NAME,
+    PYRAMID_NAME,
+    THUMBNAIL_SIZES,
+    UnsupportedImageError,
+    closest_thumbnail_size,
+    generate_derivatives,
+    is_image_file_type,
+    store_derivatives,
+    thumbnail_name,
+)
+from template_matching_api.file_storage import (
+    AsyncDocumentTemplateStorage,
+    ContentAddressedTemplateStorage,
+    DocumentTemplateStorage,
+)
+
+
+def image_bytes(width: int, height: int, image_format: str = "PNG") -> bytes:
+    gradient = np.linspace(0, 255, width * height, dtype=np.uint8).reshape(height, width)
+    buffer = io.BytesIO()
+    Image.fromarray(np.stack([gradient] * 3, axis=-1)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def test_generate_derivatives() -> None:
+    derivatives = generate_derivatives(image_bytes(300, 150))
+
+    for size in THUMBNAIL_SIZES:
+        with Image.open(io.BytesIO(derivatives[thumbnail_name(size)])) as thumbnail:
+            assert thumbnail.format == "WEBP"
+            assert thumbnail.size == (min(size, 300), min(size // 2, 150))
+
+    grayscale = np.load(io.BytesIO(derivatives[GRAYSCALE_NAME]))
+    assert grayscale.dtype == np.float32
+    assert grayscale.shape == (150, 300)
+    assert grayscale.min() >= 0 and grayscale.max() <= 1
+
+    with np.load(io.BytesIO(derivatives[PYRAMID_NAME])) as pyramid:
+        assert [pyramid[f"level_{idx}"].shape for idx in range(len(pyramid.files))] == [
+            (150, 300), (75, 150), (37, 75), (18, 37)
+        ]
+        np.testing.assert_array_equal(pyramid["level_0"], grayscale)
+        np.testing.assert_allclose(pyramid["level_1"][0, 0], grayscale[:2, :2].mean(), rtol=1e-6)
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    def __init__(self) -> None:
+        super().__init__(max_workers=1)
+        self.submitted_args: list[tuple[Any, ...]] = []
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future[Any]:
+        self.submitted_args.append(args)
+        return super().submit(fn, *args, **kwargs)
+
+
+@pytest.mark.parametrize("storage_class", [DocumentTemplateStorage, ContentAddressedTemplateStorage])
+def test_store_derivatives_reads_the_stored_file(tmp_path: Path, storage_class: type[DocumentTemplateStorage]) -> None:
+    storage = storage_class(root=tmp_path)
+    storage.save(1, image_bytes(64, 32))
+
+    with RecordingExecutor() as executor:
+        derivatives = asyncio.run(store_derivatives(AsyncDocumentTemplateStorage(storage), executor, 1, "v1"))
+
+    # The worker is sent the location of the file rather than its content
+    assert executor.submitted_args == [(storage.local_path(1),)]
+    assert np.load(io.BytesIO(derivatives[GRAYSCALE_NAME])).shape == (32, 64)
+    assert storage.load_derivative(1, "v1", GRAYSCALE_NAME) == derivatives[GRAYSCALE_NAME]
+
+
+@pytest.mark.parametrize(
+    "file_type, expected",
+    [("image/png", True), ("image", True), (None, True), ("application/octet-stream", True), ("application/pdf", False)],
+)
+def test_is_image_file_type(file_type: str | None, expected: bool) -> None:
+    assert is_image_file_type(file_type) == expected
+
+
+def test_generate_derivatives_unsupported_image() -> None:
+    with pytest.raises(UnsupportedImageError):
+        generate_derivatives(b"not an image")
+
+
+@pytest.mark.parametrize("size, expected", [(1, 64), (64, 64), (65, 128), (512, 512), (4000, 512)])
+def test_closest_thumbnail_size(size: int, expected: int) -> None:
+    assert closest_thumbnail_size(size) == expected
+
+
+@pytest.mark.parametrize("storage_class", [DocumentTemplateStorage, ContentAddressedTemplateStorage])
+def test_derivatives_are_dropped_with_the_original(
+    tmp_path: Path, storage_class: type[DocumentTemplateStorage]
+) -> None:
+    storage = storage_class(root=tmp_path)
+    storage.save(1, b"abc")
+    storage.save_derivative(1, "v1", "thumbnail.webp", b"thumbnail")
+    assert storage.load_derivative(1, "v1", "thumbnail.webp") == b"thumbnail"
+
+    storage.save(1, b"def")
+
+    with pytest.raises(FileNotFoundError):
+        storage.load_derivative(1, "v1", "thumbnail.webp")
+
+    storage.save_derivative(1, "v2", "thumbnail.webp", b"thumbnail")
+    storage.delete(1)
+
+    with pytest.raises(FileNotFoundError):
+        storage.load_derivative(1, "v2", "thumbnail.webp")
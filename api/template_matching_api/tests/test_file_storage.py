@@ -0,0 +1,340 @@
+import hashlib
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+from sqlalchemy.orm import sessionmaker, Session
+
+from template_matching_api.db_model import DocumentTemplate
+from template_matching_api.file_storage import (
+    CacheStats,
+    CachedTemplateStorage,
+    ContentAddressedTemplateStorage,
+    DocumentTemplateStorage,
+    StoredTemplate,
+    TemplateTooLargeError,
+    UploadInProgressError,
+)
+from template_matching_api.tests.storage import InMemoryTemplateStorage
+
+
+def test_save_stream(tmp_path: Path) -> None:
+    storage = DocumentTemplateStorage(root=tmp_path)
+    chunks = [b"abc", b"def", b"g"]
+
+    stored = storage.save_stream(1, chunks, max_size=7)
+
+    assert stored.sha256 == hashlib.sha256(b"abcdefg").hexdigest()
+    assert stored.size == 7
+    assert storage.load(1) == b"abcdefg"
+    assert [p.name for p in storage._get_location_for_template(1).parent.iterdir()] == ["template_file"]
+
+
+def test_save_stream_too_large_keeps_previous_file(tmp_path: Path) -> None:
+    storage = DocumentTemplateStorage(root=tmp_path)
+    storage.save(1, b"old")
+
+    with pytest.raises(TemplateTooLargeError):
+        storage.save_stream(1, iter([b"abc", b"def"]), max_size=4)
+
+    assert storage.load(1) == b"old"
+    assert [p.name for p in storage._get_location_for_template(1).parent.iterdir()] == ["template_file"]
+
+
+def test_templates_are_sharded_into_buckets(tmp_path: Path) -> None:
+    storage = DocumentTemplateStorage(root=tmp_path)
+
+    for template_id in range(1, 201):
+        storage.save(template_id, b"abc")
+
+    template_locations = list((tmp_path / "templates").glob("shards/??/??/*/template_file"))
+    assert len(template_locations) == 200
+    assert len({location.parent.parent for location in template_locations}) > 150
+    assert [p.name for p in (tmp_path / "templates").iterdir()] == ["shards"]
+
+
+def _move_to_legacy_layout(storage: DocumentTemplateStorage, template_id: int) -> Path:
+    location = storage._get_location_for_template(template_id)
+    legacy_location = storage._get_legacy_location_for_template(template_id)
+    legacy_location.parent.mkdir(parents=True)
+    if location.is_symlink():
+        # Links of the content addressed backend are relative to their directory
+        legacy_location.symlink_to(os.path.relpath(location.resolve(), legacy_location.parent))
+        location.unlink()
+    else:
+        location.rename(legacy_location)
+    location.parent.rmdir()
+    return legacy_location
+
+
+@pytest.mark.parametrize("storage_class", [DocumentTemplateStorage, ContentAddressedTemplateStorage])
+def test_reads_fall_back_to_legacy_layout(tmp_path: Path, storage_class: type[DocumentTemplateStorage]) -> None:
+    storage = storage_class(root=tmp_path)
+    storage.save(1, b"abc")
+    legacy_location = _move_to_legacy_layout(storage, 1)
+
+    assert storage.load(1) == b"abc"
+    assert storage.size(1) == 3
+    assert b"".join(storage.iter_range(1, 1)) == b"bc"
+    assert storage.local_path(1) == legacy_location
+
+    storage.save(1, b"defg")
+
+    assert storage.load(1) == b"defg"
+    assert storage.local_path(1) == storage._get_location_for_template(1)
+    assert not legacy_location.parent.exists()
+
+    storage.delete(1)
+
+    with pytest.raises(FileNotFoundError):
+        storage.load(1)
+
+
+@pytest.mark.parametrize("storage_class", [DocumentTemplateStorage, ContentAddressedTemplateStorage])
+def test_migrate_legacy_layout(tmp_path: Path, storage_class: type[DocumentTemplateStorage]) -> None:
+    storage = storage_class(root=tmp_path)
+    for template_id in range(1, 11):
+        storage.save(template_id, f"template {template_id % 3}".encode())
+        _move_to_legacy_layout(storage, template_id)
+    assert sorted(storage.iter_legacy_template_ids()) == list(range(1, 11))
+
+    assert storage.migrate_legacy_layout() == 10
+
+    assert list(storage.iter_legacy_template_ids()) == []
+    assert storage.migrate_legacy_layout() == 0
+    assert [p.name for p in (tmp_path / "templates").iterdir()] == ["shards"]
+    for template_id in range(1, 11):
+        assert storage.local_path(template_id) == storage._get_location_for_template(template_id)
+        assert storage.load(template_id) == f"template {template_id % 3}".encode()
+
+
+def _blob_files(root: Path) -> list[Path]:
+    return [path for path in (root / "blobs").glob("??/??/*") if path.is_file() and path.name != ".lock"]
+
+
+def test_content_addressed_storage_deduplicates(tmp_path: Path) -> None:
+    storage = ContentAddressedTemplateStorage(root=tmp_path)
+
+    first = storage.save_stream(1, [b"logo"])
+    second = storage.save_stream(2, [b"lo", b"go"])
+
+    assert first == second
+    blobs = _blob_files(tmp_path)
+    assert [blob.name for blob in blobs] == [first.sha256]
+    assert blobs[0].relative_to(tmp_path / "blobs").parts[:2] == (first.sha256[:2], first.sha256[2:4])
+    assert storage.load(1) == storage.load(2) == b"logo"
+    assert storage.size(2) == 4
+    assert b"".join(storage.iter_range(1, 1, 3)) == b"og"
+
+
+def _save_template(
+    storage: ContentAddressedTemplateStorage, session: Session, template_id: int, chunks: list[bytes]
+) -> StoredTemplate:
+    """Store the file and record its hash in the template's row afterwards, like the upload endpoints"""
+    stored = storage.save_stream(template_id, chunks)
+    template = session.get(DocumentTemplate, template_id) or _template_row(template_id)
+    template.template_sha256 = stored.sha256
+    session.add(template)
+    session.commit()
+    return stored
+
+
+def _template_row(template_id: int) -> DocumentTemplate:
+    return DocumentTemplate(
+        id=template_id,
+        name=f"template {template_id}",
+        template_filename="template.png",
+        template_file_type="image/png",
+        uploaded_at=datetime.now(),
+    )
+
+
+def _delete_template(storage: ContentAddressedTemplateStorage, session: Session, template_id: int) -> None:
+    session.delete(session.get_one(DocumentTemplate, template_id))
+    session.commit()
+    storage.delete(template_id)
+
+
+def test_content_addressed_storage_collects_unreferenced_blobs(
+    tmp_path: Path, session: Session, sessionmaker_f: sessionmaker[Session]
+) -> None:
+    storage = ContentAddressedTemplateStorage(
+        root=tmp_path, session_maker=sessionmaker_f, blob_grace_period=timedelta(0)
+    )
+    shared = _save_template(storage, session, 1, [b"logo"])
+    _save_template(storage, session, 2, [b"logo"])
+
+    _delete_template(storage, session, 1)
+    assert [blob.name for blob in _blob_files(tmp_path)] == [shared.sha256]
+    with pytest.raises(FileNotFoundError):
+        storage.load(1)
+
+    # Re-uploading different bytes releases the previous blob
+    replaced = _save_template(storage, session, 2, [b"letterhead"])
+    assert [blob.name for blob in _blob_files(tmp_path)] == [replaced.sha256]
+    assert storage.load(2) == b"letterhead"
+
+    _delete_template(storage, session, 2)
+    assert _blob_files(tmp_path) == []
+    assert storage.collect_garbage() == 0
+
+
+def test_content_addressed_storage_counts_references_in_the_db(
+    tmp_path: Path, session: Session, sessionmaker_f: sessionmaker[Session]
+) -> None:
+    storage = ContentAddressedTemplateStorage(root=tmp_path, session_maker=sessionmaker_f)
+    stored = _save_template(storage, session, 1, [b"logo"])
+    # Stored by a template whose row is not committed yet, e.g. an upload in progress
+    storage.save_stream(2, [b"logo"])
+    # Reference markers of earlier versions are ignored
+    refs_location = storage._get_location_for_blob(stored.sha256).with_name(f"{stored.sha256}.refs")
+    refs_location.mkdir()
+
+    _delete_template(storage, session, 1)
+    assert storage.collect_garbage() == 0
+    assert storage.load(2) == b"logo"
+    assert not refs_location.exists()
+
+    # Rows committed after the grace period keep the blob as well
+    storage = ContentAddressedTemplateStorage(
+        root=tmp_path, session_maker=sessionmaker_f, blob_grace_period=timedelta(0)
+    )
+    session.add(_template_row(2))
+    session.get_one(DocumentTemplate, 2).template_sha256 = stored.sha256
+    session.commit()
+    assert storage.collect_garbage() == 0
+    assert storage.load(2) == b"logo"
+
+    session.delete(session.get_one(DocumentTemplate, 2))
+    session.commit()
+    assert storage.collect_garbage() == 1
+    assert _blob_files(tmp_path) == []
+
+
+def test_content_addressed_storage_over_local_files(
+    tmp_path: Path, session: Session, sessionmaker_f: sessionmaker[Session]
+) -> None:
+    local = DocumentTemplateStorage(root=tmp_path)
+    for template_id in range(1, 5):
+        local.save(template_id, b"logo")
+        session.add(_template_row(template_id))
+    session.commit()
+    _move_to_legacy_layout(local, 4)
+    storage = ContentAddressedTemplateStorage(
+        root=tmp_path, session_maker=sessionmaker_f, blob_grace_period=timedelta(0)
+    )
+
+    assert storage.load(1) == b"logo"
+    re_uploaded = _save_template(storage, session, 1, [b"letterhead"])
+    _save_template(storage, session, 2, [b"letterhead"])
+    assert storage.load(1) == storage.load(2) == b"letterhead"
+    _delete_template(storage, session, 3)
+    with pytest.raises(FileNotFoundError):
+        storage.load(3)
+
+    # Imported into a blob by the migration, which records the hash of the template
+    assert storage.migrate_legacy_layout() == 1
+    assert storage.load(4) == b"logo"
+    assert storage._get_location_for_template(4).is_symlink()
+    logo_sha256 = hashlib.sha256(b"logo").hexdigest()
+    assert sorted(blob.name for blob in _blob_files(tmp_path)) == sorted([re_uploaded.sha256, logo_sha256])
+    session.expire_all()
+    assert session.get_one(DocumentTemplate, 4).template_sha256 == logo_sha256
+    assert storage.collect_garbage() == 0
+
+    for template_id in (1, 2, 4):
+        _delete_template(storage, session, template_id)
+    assert _blob_files(tmp_path) == []
+    assert storage.collect_garbage() == 0
+
+
+def test_content_addressed_storage_too_large(tmp_path: Path) -> None:
+    storage = ContentAddressedTemplateStorage(root=tmp_path)
+
+    with pytest.raises(TemplateTooLargeError):
+        storage.save_stream(1, [b"abc", b"def"], max_size=4)
+
+    assert _blob_files(tmp_path) == []
+    assert list((tmp_path / "blobs" / ".incoming").iterdir()) == []
+
+
+def test_cached_storage_lru_bounded_by_bytes() -> None:
+    backend = InMemoryTemplateStorage()
+    for template_id in range(3):
+        backend.save(template_id, bytes([template_id]) * 4)
+    storage = CachedTemplateStorage(backend, max_bytes=8)
+
+    assert storage.load(0) == b"\x00" * 4
+    assert storage.load(1) == b"\x01" * 4
+    assert storage.load(0) == b"\x00" * 4
+    # Template 1 is the least recently used one and gets evicted
+    assert storage.load(2) == b"\x02" * 4
+    assert storage.stats() == CacheStats(
+        hits=1, misses=3, evictions=1, entries=2, size_bytes=8, max_bytes=8
+    )
+
+    backend.save(0, b"changed behind the cache's back")
+    assert storage.load(0) == b"\x00" * 4
+    assert storage.stats().hits == 2
+
+
+def test_cached_storage_skips_files_larger_than_cache() -> None:
+    backend = InMemoryTemplateStorage()
+    backend.save(1, b"0123456789")
+    storage = CachedTemplateStorage(backend, max_bytes=8)
+
+    assert storage.load(1) == b"0123456789"
+    assert b"".join(storage.iter_range(1, 2, 5)) == b"234"
+    assert storage.stats().entries == 0
+
+
+def test_cached_storage_invalidates_on_save_and_delete() -> None:
+    storage = CachedTemplateStorage(InMemoryTemplateStorage(), max_bytes=1024)
+    storage.save(1, b"old")
+    assert storage.load(1) == b"old"
+
+    storage.save_stream(1, [b"n", b"ew"])
+    assert storage.load(1) == b"new"
+    assert b"".join(storage.iter_range(1, 1)) == b"ew"
+    assert storage.stats().hits == 1
+
+    storage.delete(1)
+    assert storage.stats().entries == 0
+    with pytest.raises(FileNotFoundError):
+        storage.load(1)
+
+
+@pytest.mark.parametrize("storage_class", [DocumentTemplateStorage, ContentAddressedTemplateStorage])
+def test_resumable_upload(tmp_path: Path, storage_class: type[DocumentTemplateStorage]) -> None:
+    storage = storage_class(root=tmp_path)
+    storage.save(1, b"previous")
+
+    assert storage.write_upload_chunk("upload", 0, [b"abc", b"de"], max_size=9) == 5
+    # A chunk retried after a lost response overwrites the same bytes
+    assert storage.write_upload_chunk("upload", 3, [b"de"], max_size=6) == 2
+    with pytest.raises(TemplateTooLargeError):
+        storage.write_upload_chunk("upload", 5, [b"fghi", b"jk"], max_size=4)
+    assert storage.write_upload_chunk("upload", 5, [b"fghi"], max_size=4) == 4
+
+    stored = storage.finalize_upload("upload", 1, 9)
+
+    assert stored.sha256 == hashlib.sha256(b"abcdefghi").hexdigest()
+    assert stored.size == 9
+    assert storage.load(1) == b"abcdefghi"
+    assert list((tmp_path / "uploads").iterdir()) == []
+
+
+def test_resumable_upload_chunks_are_exclusive(tmp_path: Path) -> None:
+    storage = DocumentTemplateStorage(root=tmp_path)
+
+    def chunks() -> Iterator[bytes]:
+        yield b"abc"
+        with pytest.raises(UploadInProgressError):
+            storage.write_upload_chunk("upload", 0, [b"xyz"])
+        yield b"def"
+
+    assert storage.write_upload_chunk("upload", 0, chunks()) == 6
+    storage.delete_upload("upload")
+    assert list((tmp_path / "uploads").iterdir()) == []
@@ -0,0 +1,147 @@
+import asyncio
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from template_matching_api.api_models.template_matching_job import JobState, TemplateMatchingJobEvent
+from template_matching_api.db_model import TemplateMatchingJob
+from template_matching_api.job_events import JobEventBroker, Subscription, Topic, iter_sse_events, wait_for_job_state
+from template_matching_api.jobs.queue import ClaimedJob, create_shards
+from template_matching_api.tests.api.endpoints.test_document_template import with_document_templates
+from template_matching_api.tests.api.endpoints.test_template_matching_job import with_template_matching_jobs
+from template_matching_api.tests.api.endpoints.test_workspace import with_workspaces
+
+
+def test_subscription_keeps_latest_event_per_job() -> None:
+    async def receive() -> list[TemplateMatchingJobEvent]:
+        subscription = Subscription(Topic(job_id=1))
+        assert await subscription.next_events(timeout=0.01) == []
+        for job_state in (JobState.SUBMITTED, JobState.RUNNING):
+            subscription.push(TemplateMatchingJobEvent(id=1, workspace_id=None, job_state=job_state))
+        subscription.push(TemplateMatchingJobEvent(id=2, workspace_id=None, job_state=JobState.FAILED))
+        return await subscription.next_events()
+
+    assert [(event.id, event.job_state) for event in asyncio.run(receive())] == [
+        (1, JobState.RUNNING),
+        (2, JobState.FAILED),
+    ]
+
+
+def test_broker_publishes_state_changes(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    async_sessionmaker_f: async_sessionmaker[AsyncSession],
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[0]
+    workspace_id = job.workspace_id
+    expected_initial = TemplateMatchingJobEvent(
+        id=job.id, workspace_id=workspace_id, job_state=job.job_state, job_id=job.job_id
+    )
+    broker = JobEventBroker(poll_interval_seconds=0.01)
+
+    def change_state() -> None:
+        job.job_state, job.job_id = JobState.RUNNING, "run-1"
+        session.commit()
+        create_shards(session, ClaimedJob(id=job.id, run_id="run-1", worker_id="worker-1"), [[1], [2]])
+        session.commit()
+
+    async def subscribe() -> tuple[list[TemplateMatchingJobEvent], list[TemplateMatchingJobEvent]]:
+        job_topic, workspace_topic = Topic(job_id=job.id), Topic(workspace_id=workspace_id)
+        async with broker.subscribe(async_sessionmaker_f, job_topic) as by_job:
+            async with broker.subscribe(async_sessionmaker_f, workspace_topic) as by_workspace:
+                initial = await by_job.next_events()
+                assert await by_workspace.next_events() == initial
+                # Published once, every subscriber receives it
+                assert await by_job.next_events(timeout=0.05) == []
+
+                await asyncio.to_thread(change_state)
+                changed: list[TemplateMatchingJobEvent] = []
+                while not changed or changed[-1].shards_total == 0:
+                    changed.extend(await by_job.next_events())
+                assert broker.num_subscriptions == 2
+        # Stops polling without subscribers
+        assert broker._watcher is not None
+        await asyncio.wait_for(broker._watcher, 5)
+        return initial, changed
+
+    initial, changed = asyncio.run(subscribe())
+    assert initial == [expected_initial]
+    assert changed[-1].job_state == JobState.RUNNING
+    assert (changed[-1].shards_total, changed[-1].shards_succeeded) == (2, 0)
+
+
+def test_broker_publishes_deleted_jobs(async_sessionmaker_f: async_sessionmaker[AsyncSession]) -> None:
+    broker = JobEventBroker(poll_interval_seconds=0.01)
+
+    async def subscribe() -> list[TemplateMatchingJobEvent]:
+        async with broker.subscribe(async_sessionmaker_f, Topic(job_id=99999)) as subscription:
+            events = await subscription.next_events()
+            # Only once
+            assert await subscription.next_events(timeout=0.05) == []
+        await broker.close()
+        return events
+
+    assert asyncio.run(subscribe()) == [
+        TemplateMatchingJobEvent(id=99999, workspace_id=None, job_state=None, deleted=True)
+    ]
+
+
+def test_iter_sse_events(
+    with_template_matching_jobs: list[TemplateMatchingJob], async_sessionmaker_f: async_sessionmaker[AsyncSession]
+) -> None:
+    job = with_template_matching_jobs[0]
+    broker = JobEventBroker(poll_interval_seconds=0.01)
+
+    async def read() -> list[bytes]:
+        stream = iter_sse_events(broker, async_sessionmaker_f, Topic(job_id=job.id), keepalive_seconds=0.05)
+        chunks = [await anext(stream)]
+        # Keepalives until the first poll published the job
+        while chunks[-1] == b": keepalive\n\n":
+            chunks.append(await anext(stream))
+        chunks.append(await anext(stream))
+        await stream.aclose()
+        await broker.close()
+        return chunks[-2:]
+
+    event, keepalive = asyncio.run(read())
+    assert event.startswith(b"event: job\ndata: {")
+    assert event.endswith(b"\n\n")
+    assert TemplateMatchingJobEvent.model_validate_json(event.split(b"data: ")[1]).id == job.id
+    assert keepalive == b": keepalive\n\n"
+    assert broker.num_subscriptions == 0
+
+
+def test_wait_for_job_state(
+    with_template_matching_jobs: list[TemplateMatchingJob],
+    async_sessionmaker_f: async_sessionmaker[AsyncSession],
+    session: Session,
+) -> None:
+    job = with_template_matching_jobs[0]
+    job.job_state = JobState.SUBMITTED
+    session.commit()
+    broker = JobEventBroker(poll_interval_seconds=0.01)
+
+    def start_job() -> None:
+        job.job_state = JobState.RUNNING
+        session.commit()
+
+    async def wait() -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await wait_for_job_state(broker, async_sessionmaker_f, job.id, JobState.RUNNING, timeout=0.05)
+        assert loop.time() - started >= 0.05
+
+        waiting = asyncio.create_task(
+            wait_for_job_state(broker, async_sessionmaker_f, job.id, JobState.RUNNING, timeout=30)
+        )
+        await asyncio.to_thread(start_job)
+        await asyncio.wait_for(waiting, 5)
+        assert broker.num_subscriptions == 0
+
+        # Deleted jobs are not waited for
+        await asyncio.wait_for(
+            wait_for_job_state(broker, async_sessionmaker_f, 99999, JobState.RUNNING, timeout=30), 5
+        )
+        await broker.close()
+
+    asyncio.run(wait())
@@ -0,0 +1,88 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.jobs.template_matching_job import mock_job_result_columns
+from template_matching_api.result_queries import InvalidCursorError, ResultQuery, select_results
+from template_matching_api.result_storage import FILE_TYPES, JobResultColumns, count_rows
+
+
+@pytest.fixture
+def columns() -> JobResultColumns:
+    return mock_job_result_columns(
+        [4, 2, 9],
+        DataSpecification(date_from=date(2024, 3, 1), date_to=date(2024, 3, 10)),
+        num_samples=50,
+        rng=np.random.default_rng(1),
+    )
+
+
+def test_select_all(columns: JobResultColumns) -> None:
+    page = select_results(columns, ResultQuery(), "run")
+    assert page.next_cursor is None
+    assert [(template_id, count_rows(rows)) for template_id, rows in page.selection] == [(4, 50), (2, 50), (9, 50)]
+
+
+def test_top_k(columns: JobResultColumns) -> None:
+    page = select_results(columns, ResultQuery(top_k=5), "run")
+    for template_id, rows in page.selection:
+        scores = columns.score[rows]
+        assert len(scores) == 5
+        assert (np.diff(scores) <= 0).all()
+        template_scores = columns.score[columns.template_id == template_id]
+        assert scores.tolist() == sorted(template_scores.tolist(), reverse=True)[:5]
+
+
+def test_filters(columns: JobResultColumns) -> None:
+    query = ResultQuery(min_score=0.5, file_type=FileType.PDF, date_from=date(2024, 3, 3), date_to=date(2024, 3, 5))
+    page = select_results(columns, query, "run")
+
+    selected = np.concatenate([np.asarray(rows) for _template_id, rows in page.selection])
+    expected = np.flatnonzero(
+        (columns.score >= 0.5)
+        & (columns.file_type == FILE_TYPES.index(FileType.PDF))
+        & (columns.created_at >= np.datetime64("2024-03-03"))
+        & (columns.created_at < np.datetime64("2024-03-06"))
+    )
+    assert selected.tolist() == expected.tolist()
+
+
+@pytest.mark.parametrize("query", [ResultQuery(), ResultQuery(top_k=20, min_score=0.1)])
+@pytest.mark.parametrize("limit", [1, 7, 20, 50])
+def test_pagination(columns: JobResultColumns, query: ResultQuery, limit: int) -> None:
+    expected = [
+        (template_id, row)
+        for template_id, rows in select_results(columns, query, "run").selection
+        for row in np.arange(columns.num_results)[rows].tolist()
+    ]
+
+    paged = []
+    cursor = None
+    while True:
+        page = select_results(columns, query, "run", cursor, limit)
+        page_rows = [
+            (template_id, row)
+            for template_id, rows in page.selection
+            for row in np.arange(columns.num_results)[rows].tolist()
+        ]
+        assert len(page_rows) <= limit
+        paged.extend(page_rows)
+        if page.next_cursor is None:
+            break
+        cursor = page.next_cursor
+    assert paged == expected
+
+
+def test_invalid_cursor(columns: JobResultColumns) -> None:
+    cursor = select_results(columns, ResultQuery(), "run", limit=10).next_cursor
+    assert cursor is not None
+
+    with pytest.raises(InvalidCursorError):
+        select_results(columns, ResultQuery(), "other-run", cursor, limit=10)
+    with pytest.raises(InvalidCursorError):
+        select_results(columns, ResultQuery(top_k=3), "run", cursor, limit=10)
+    with pytest.raises(InvalidCursorError):
+        select_results(columns, ResultQuery(), "run", "not a cursor", limit=10)
@@ -0,0 +1,62 @@
+from datetime import date
+
+import numpy as np
+import pytest
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.api_models.template_matching_job import TemplateMatchingJobResults
+from template_matching_api.jobs.template_matching_job import mock_job_result_columns
+from template_matching_api.result_stats import StatsQuery, compute_result_stats
+from template_matching_api.result_storage import FILE_TYPES, JobResultColumns
+
+
+@pytest.fixture
+def columns() -> JobResultColumns:
+    return mock_job_result_columns(
+        [7, 3, 5],
+        DataSpecification(date_from=date(2024, 5, 1), date_to=date(2024, 5, 7)),
+        rng=np.random.default_rng(2),
+    )
+
+
+def test_compute_result_stats(columns: JobResultColumns) -> None:
+    query = StatsQuery(bins=4, percentiles=(0, 25, 50, 99.5, 100))
+    stats = compute_result_stats(columns, query)
+
+    scores = np.asarray(columns.score, dtype=np.float64)
+    assert stats.count == columns.num_results
+    assert stats.min_score == scores.min()
+    assert stats.max_score == scores.max()
+    assert stats.mean_score == pytest.approx(scores.mean())
+    assert [p.score for p in stats.percentiles] == pytest.approx(np.percentile(scores, query.percentiles).tolist())
+    assert stats.histogram.bin_edges == [0, 0.25, 0.5, 0.75, 1]
+    assert stats.histogram.counts == np.histogram(scores, bins=4, range=(0, 1))[0].tolist()
+    assert stats.count_per_file_type == {
+        file_type: int((columns.file_type == idx).sum()) for idx, file_type in enumerate(FILE_TYPES)
+    }
+    assert sum(stats.count_per_day.values()) == columns.num_results
+    assert set(stats.count_per_day) <= {date(2024, 5, day) for day in range(1, 8)}
+
+    assert [template_stats.template_id for template_stats in stats.per_template] == [7, 3, 5]
+    for template_stats, (_template_id, rows) in zip(stats.per_template, columns.iter_templates()):
+        template_scores = scores[rows]
+        assert template_stats.count == len(template_scores)
+        assert template_stats.max_score == template_scores.max()
+        assert template_stats.mean_score == pytest.approx(template_scores.mean())
+        assert [p.score for p in template_stats.percentiles] == pytest.approx(
+            np.percentile(template_scores, query.percentiles).tolist()
+        )
+        assert template_stats.histogram.counts == np.histogram(template_scores, bins=4, range=(0, 1))[0].tolist()
+
+
+def test_compute_result_stats_without_results() -> None:
+    columns = JobResultColumns.from_results(TemplateMatchingJobResults(results_per_template=[], total_run_time=1))
+    stats = compute_result_stats(columns, StatsQuery())
+
+    assert stats.count == 0
+    assert stats.mean_score is None
+    assert all(p.score is None for p in stats.percentiles)
+    assert stats.histogram.counts == [0] * 10
+    assert stats.count_per_file_type == {FileType.PDF: 0, FileType.IMAGE: 0}
+    assert stats.count_per_day == {}
@@ -0,0 +1,172 @@
+import json
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from template_matching_api.api_models.sample import ExtendedSampleResult, FileType
+from template_matching_api.api_models.template_matching_job import (
+    TemplateMatchingJobResults,
+    TemplateMatchingJobTempLateResults,
+)
+from template_matching_api.result_storage import (
+    JobResultColumns,
+    JobResultStorage,
+    ResultsNotFoundError,
+    concat_columns,
+    encode_results,
+    iter_encoded_results,
+    iter_ndjson_results,
+)
+
+
+@pytest.fixture
+def results() -> TemplateMatchingJobResults:
+    return TemplateMatchingJobResults(
+        results_per_template=[
+            TemplateMatchingJobTempLateResults(
+                template_id=template_id,
+                sample_results=[
+                    ExtendedSampleResult(
+                        sample_id=template_id * 10 + idx,
+                        score=idx / 4,
+                        file_type=FileType.PDF if idx % 2 else FileType.IMAGE,
+                        created_at=datetime(2024, 1, idx + 1, 12, 30),
+                    )
+                    for idx in range(num_samples)
+                ],
+            )
+            for template_id, num_samples in ((3, 2), (1, 0), (2, 3))
+        ],
+        total_run_time=1234,
+    )
+
+
+def test_save_and_load(tmp_path: Path, results: TemplateMatchingJobResults) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    storage.save(1, "run-1", JobResultColumns.from_results(results))
+
+    columns = storage.load(1, "run-1")
+    assert isinstance(columns.score, np.memmap)
+    assert columns.num_results == 5
+    assert columns.total_run_time == 1234
+    assert [(template_id, rows.stop - rows.start) for template_id, rows in columns.iter_templates()] == [
+        (3, 2), (1, 0), (2, 3)
+    ]
+    assert columns.template_id.tolist() == [3, 3, 2, 2, 2]
+    assert columns.sample_id[4] == 22
+    assert not list((tmp_path / "results" / "1").glob(".run-*"))
+
+
+def test_encode_results(tmp_path: Path, results: TemplateMatchingJobResults) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    storage.save(1, "run-1", JobResultColumns.from_results(results))
+
+    assert TemplateMatchingJobResults.model_validate_json(encode_results(storage.load(1, "run-1"))) == results
+
+
+def test_encode_results_in_chunks(results: TemplateMatchingJobResults) -> None:
+    columns = JobResultColumns.from_results(results)
+
+    chunks = list(iter_encoded_results(columns, chunk_rows=2))
+    assert TemplateMatchingJobResults.model_validate_json(b"".join(chunks)) == results
+    assert b"".join(chunks) == encode_results(columns)
+
+
+def test_iter_ndjson_results(results: TemplateMatchingJobResults) -> None:
+    columns = JobResultColumns.from_results(results)
+
+    lines = b"".join(iter_ndjson_results(columns, record="chunk", chunk_rows=2)).splitlines()
+    chunks = [json.loads(line) for line in lines]
+    assert [(chunk["template_id"], len(chunk["sample_results"])) for chunk in chunks] == [
+        (3, 2), (1, 0), (2, 2), (2, 1)
+    ]
+
+    sample_lines = list(iter_ndjson_results(columns, record="sample", chunk_rows=2))
+    # Rendered lazily, one chunk of lines at a time
+    assert len(sample_lines) == 3
+    samples = [json.loads(line) for line in b"".join(sample_lines).splitlines()]
+    assert [(sample["template_id"], sample["sample_id"]) for sample in samples] == [
+        (3, 30), (3, 31), (2, 20), (2, 21), (2, 22)
+    ]
+    expected = results.results_per_template[0].sample_results[0].model_dump(mode="json")
+    assert samples[0] == {"template_id": 3, **expected}
+
+
+def test_load_missing_run(tmp_path: Path) -> None:
+    with pytest.raises(ResultsNotFoundError):
+        JobResultStorage(root=tmp_path).load(1, "run-1")
+
+
+def test_save_same_run_twice_keeps_first(tmp_path: Path, results: TemplateMatchingJobResults) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    storage.save(1, "run-1", JobResultColumns.from_results(results))
+    storage.save(1, "run-1", JobResultColumns.from_results(TemplateMatchingJobResults(
+        results_per_template=[], total_run_time=1
+    )))
+    assert storage.load(1, "run-1").total_run_time == 1234
+
+
+def test_prune_and_delete(tmp_path: Path, results: TemplateMatchingJobResults) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    columns = JobResultColumns.from_results(results)
+    storage.save(1, "run-1", columns)
+    storage.save(1, "run-2", columns)
+    storage.save(2, "run-3", columns)
+
+    storage.prune(1, keep_run_id="run-2")
+    with pytest.raises(ResultsNotFoundError):
+        storage.load(1, "run-1")
+    storage.load(1, "run-2")
+
+    storage.delete(1)
+    with pytest.raises(ResultsNotFoundError):
+        storage.load(1, "run-2")
+    storage.load(2, "run-3")
+
+
+def test_link_run(tmp_path: Path, results: TemplateMatchingJobResults) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    storage.save(1, "run-1", JobResultColumns.from_results(results))
+    storage.link_run(1, "run-1", 2, "run-2")
+
+    assert encode_results(storage.load(2, "run-2")) == encode_results(storage.load(1, "run-1"))
+    # The linked run outlives the results it was linked from
+    storage.delete(1)
+    assert storage.load(2, "run-2").total_run_time == 1234
+
+    with pytest.raises(ResultsNotFoundError):
+        storage.link_run(1, "run-1", 3, "run-3")
+    with pytest.raises(ResultsNotFoundError):
+        storage.load(3, "run-3")
+
+
+def test_concat_columns(results: TemplateMatchingJobResults) -> None:
+    columns = JobResultColumns.from_results(results)
+    first = JobResultColumns.from_results(
+        TemplateMatchingJobResults(results_per_template=results.results_per_template[:1], total_run_time=1000)
+    )
+    rest = JobResultColumns.from_results(
+        TemplateMatchingJobResults(results_per_template=results.results_per_template[1:], total_run_time=234)
+    )
+    assert encode_results(concat_columns([first, rest])) == encode_results(columns)
+    assert concat_columns([]).templates.tolist() == []
+
+
+def test_save_load_and_prune_partials(tmp_path: Path, results: TemplateMatchingJobResults) -> None:
+    storage = JobResultStorage(root=tmp_path)
+    columns = JobResultColumns.from_results(results)
+    assert storage.load_partial(1, "key-1") is None
+    storage.save_partial(1, "key-1", columns)
+    storage.save_partial(1, "key-2", columns)
+    storage.save(1, "run-1", columns)
+
+    partial = storage.load_partial(1, "key-1")
+    assert partial is not None
+    assert encode_results(partial) == encode_results(columns)
+    # Pruning runs keeps the partial results
+    storage.prune(1, keep_run_id="run-2")
+    storage.prune_partials(1, keep_keys=["key-2"])
+    assert storage.load_partial(1, "key-1") is None
+    assert storage.load_partial(1, "key-2") is not None
@@ -0,0 +1,188 @@
+import os
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from pytest import MonkeyPatch
+
+from template_matching_api.api_models.data_specification import DataSpecification
+from template_matching_api.api_models.sample import FileType
+from template_matching_api.result_storage import FILE_TYPES
+from template_matching_api.sample_corpus import MANIFEST_DTYPE, LocalSampleCorpus
+
+
+def test_iter_batches(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path)
+    for sample_id in range(1, 6):
+        corpus.add(sample_id, FileType.IMAGE, date(2024, 5, 1), np.full((4, 6), sample_id / 10, dtype=np.float32))
+    corpus.add(6, FileType.IMAGE, date(2024, 5, 2), np.zeros((8, 8), dtype=np.float32))
+    corpus.add(7, FileType.PDF, date(2024, 5, 1), np.zeros((4, 6), dtype=np.float32))
+    corpus.add(8, FileType.IMAGE, date(2024, 4, 30), np.zeros((4, 6), dtype=np.float32))
+
+    spec = DataSpecification(file_type=FileType.IMAGE, date_from=date(2024, 5, 1), date_to=date(2024, 5, 2))
+    batches = list(corpus.iter_batches(spec, batch_size=2))
+    # Batches only stack samples of the same size
+    assert [batch.sample_id.tolist() for batch in batches] == [[1, 2], [3, 4], [5], [6]]
+    assert [batch.images.shape for batch in batches] == [(2, 4, 6), (2, 4, 6), (1, 4, 6), (1, 8, 8)]
+    np.testing.assert_allclose(batches[0].images[1], 0.2)
+    assert set(batches[0].file_type.tolist()) == {FILE_TYPES.index(FileType.IMAGE)}
+    assert batches[-1].created_at.tolist()[0].date() == date(2024, 5, 2)
+
+    all_file_types = DataSpecification(date_from=date(2024, 5, 1), date_to=date(2024, 5, 1))
+    assert sorted(
+        sample_id for batch in corpus.iter_batches(all_file_types, batch_size=8) for sample_id in batch.sample_id
+    ) == [1, 2, 3, 4, 5, 7]
+
+
+def test_incremental_ingestion(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path)
+    rng = np.random.default_rng(0)
+    day = date(2024, 5, 1)
+    first = [rng.random((4, 4), dtype=np.float32) for _ in range(3)]
+    corpus.add_samples(FileType.PDF, day, [1, 2, 3], [*first[:2], rng.random((5, 4), dtype=np.float32)])
+    manifest_location = corpus.manifest_location(FileType.PDF, day)
+    manifest_before = manifest_location.read_bytes()
+    corpus.add_samples(FileType.PDF, day, [4, 5], [first[2], rng.random((4, 4), dtype=np.float32)])
+
+    # Appended, the records and segments of earlier ingestions are left alone
+    assert manifest_location.read_bytes().startswith(manifest_before)
+    manifest = corpus.load_manifest(FileType.PDF, day)
+    assert manifest["count"].tolist() == [2, 1, 2]
+    assert [tuple(size) for size in zip(manifest["height"], manifest["width"])] == [(4, 4), (5, 4), (4, 4)]
+    assert len(list((tmp_path / "PDF" / day.isoformat()).glob("*.npy"))) == 2 * len(manifest)
+    # Read once until it changes
+    assert corpus.load_manifest(FileType.PDF, day) is manifest
+
+    spec = DataSpecification(date_from=day, date_to=day)
+    [four_by_four, five_by_four] = corpus.iter_batches(spec, batch_size=8)
+    assert four_by_four.sample_id.tolist() == [1, 2, 4, 5]
+    np.testing.assert_array_equal(four_by_four.images[2], first[2])
+    assert five_by_four.sample_id.tolist() == [3]
+
+    # A record still being appended is skipped
+    with open(manifest_location, "ab") as manifest_file:
+        manifest_file.write(b"\0" * (MANIFEST_DTYPE.itemsize - 1))
+    assert len(corpus.load_manifest(FileType.PDF, day)) == 3
+
+
+def test_compaction(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path, compaction_fanout=4, segment_grace_period=timedelta(0))
+    day = date(2024, 5, 1)
+    spec = DataSpecification(date_from=day, date_to=day)
+    for sample_id in range(1, 11):
+        corpus.add(sample_id, FileType.IMAGE, day, np.full((2, 3), sample_id, dtype=np.float32))
+    corpus.add(11, FileType.IMAGE, day, np.zeros((3, 3), dtype=np.float32))
+
+    # Segments of a tier are merged once there are `compaction_fanout` of them, other sizes are left alone
+    assert corpus.load_manifest(FileType.IMAGE, day)["count"].tolist() == [4, 4, 1, 1, 1]
+    [batch, other_size] = corpus.iter_batches(spec, batch_size=16)
+    assert batch.sample_id.tolist() == list(range(1, 11))
+    np.testing.assert_array_equal(batch.images[:, 0, 0], np.arange(1, 11))
+    assert other_size.sample_id.tolist() == [11]
+
+    for sample_id in range(12, 18):
+        corpus.add(sample_id, FileType.IMAGE, day, np.full((2, 3), sample_id, dtype=np.float32))
+    assert corpus.load_manifest(FileType.IMAGE, day)["count"].tolist() == [16, 1]
+    assert [batch.sample_id.tolist() for batch in corpus.iter_batches(spec, batch_size=32)] == [
+        [*range(1, 11), *range(12, 18)], [11]
+    ]
+    # Replaced segments are removed once their grace period is over
+    assert len(list((tmp_path / "IMAGE" / day.isoformat()).glob("*.npy"))) == 2 * 2
+
+
+def test_compaction_keeps_segments_for_readers(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path, compaction_fanout=2)
+    day = date(2024, 5, 1)
+    corpus.add(1, FileType.IMAGE, day, np.zeros((2, 2), dtype=np.float32))
+    batches = corpus.iter_batches(DataSpecification(date_from=day, date_to=day), batch_size=1)
+    assert next(batches).sample_id.tolist() == [1]
+
+    corpus.add(2, FileType.IMAGE, day, np.zeros((2, 2), dtype=np.float32))
+    assert corpus.load_manifest(FileType.IMAGE, day)["count"].tolist() == [2]
+    # Started before the compaction, the iteration still reads the replaced segment
+    assert [batch.sample_id.tolist() for batch in batches] == []
+    assert len(list((tmp_path / "IMAGE" / day.isoformat()).glob("*.npy"))) == 2 * 3
+
+
+def test_version(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path)
+    image = np.zeros((2, 2), dtype=np.float32)
+    spec = DataSpecification(file_type=FileType.IMAGE, date_from=date(2024, 5, 1), date_to=date(2024, 5, 2))
+    empty = corpus.version(spec)
+    corpus.add(1, FileType.IMAGE, date(2024, 5, 1), image)
+    version = corpus.version(spec)
+    assert version != empty
+
+    # Samples of other partitions do not change it
+    corpus.add(2, FileType.PDF, date(2024, 5, 1), image)
+    corpus.add(3, FileType.IMAGE, date(2024, 5, 3), image)
+    assert corpus.version(spec) == version
+
+    corpus.add(4, FileType.IMAGE, date(2024, 5, 2), image)
+    assert corpus.version(spec) not in (empty, version)
+
+
+def test_open_ended_specification(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path)
+    image = np.zeros((2, 2), dtype=np.float32)
+    corpus.add(1, FileType.IMAGE, date.today() - timedelta(days=365), image)
+    corpus.add(2, FileType.IMAGE, date.today(), image)
+    corpus.add(3, FileType.IMAGE, date(2024, 5, 1), image)
+
+    # Missing bounds are not limited to the last 30 days
+    assert [batch.sample_id.tolist() for batch in corpus.iter_batches(DataSpecification(), batch_size=8)] == [[3, 1, 2]]
+    until = DataSpecification(date_to=date(2024, 5, 1))
+    assert [batch.sample_id.tolist() for batch in corpus.iter_batches(until, batch_size=8)] == [[3]]
+    since = DataSpecification(date_from=date(2024, 5, 2))
+    assert [batch.sample_id.tolist() for batch in corpus.iter_batches(since, batch_size=8)] == [[1, 2]]
+
+
+def test_days_are_listed_until_a_partition_is_added(tmp_path: Path, monkeypatch: MonkeyPatch) -> None:
+    corpus = LocalSampleCorpus(tmp_path)
+    image = np.zeros((2, 2), dtype=np.float32)
+    for day in range(1, 11):
+        corpus.add(day, FileType.IMAGE, date(2024, 6, day), image)
+    spec = DataSpecification(file_type=FileType.IMAGE, date_from=date(2024, 6, 3), date_to=date(2024, 6, 4))
+    assert len(corpus.select_segments(spec)) == 2
+
+    listed: list[str] = []
+    scandir = os.scandir
+
+    def listing_scandir(path: Path) -> Iterator[os.DirEntry[str]]:
+        listed.append(str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", listing_scandir)
+    # Samples ingested into existing partitions do not list the days again
+    assert len(corpus.select_segments(spec)) == 2
+    corpus.add(11, FileType.IMAGE, date(2024, 6, 3), image)
+    assert len(corpus.select_segments(spec)) == 3
+    assert listed == []
+
+    corpus.add(12, FileType.IMAGE, date(2024, 6, 11), image)
+    assert len(corpus.select_segments(DataSpecification(date_from=date(2024, 6, 10)))) == 2
+    assert listed == [str(tmp_path / FileType.IMAGE.value)]
+
+
+def test_only_selected_partitions_are_read(tmp_path: Path) -> None:
+    corpus = LocalSampleCorpus(tmp_path)
+    image = np.zeros((2, 2), dtype=np.float32)
+    for day in range(1, 31):
+        for file_type in FileType:
+            corpus.add(day * 10 + FILE_TYPES.index(file_type), file_type, date(2024, 6, day), image)
+    # Other partitions are never opened, they could as well be missing
+    for partition in tmp_path.iterdir():
+        if partition.is_dir() and partition.name != FileType.IMAGE.value:
+            for day_partition in partition.iterdir():
+                for segment_file in day_partition.iterdir():
+                    segment_file.unlink()
+    for segment_file in (tmp_path / FileType.IMAGE.value / "2024-06-01").iterdir():
+        segment_file.unlink()
+
+    spec = DataSpecification(file_type=FileType.IMAGE, date_from=date(2024, 6, 2), date_to=date(2024, 6, 4))
+    assert len(corpus.select_segments(spec)) == 3
+    image_code = FILE_TYPES.index(FileType.IMAGE)
+    assert [batch.sample_id.tolist() for batch in corpus.iter_batches(spec, batch_size=8)] == [
+        [20 + image_code, 30 + image_code, 40 + image_code]
+    ]
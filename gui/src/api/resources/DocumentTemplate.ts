@@ -11,6 +11,8 @@ interface DocumentTemplateBase {
 export interface DocumentTemplateOut extends DocumentTemplateBase {
   id: number;
   created_at: string;
+  template_sha256: string | null;
+  template_size: number | null;
 }
 
 export interface DocumentTemplateJSONIn extends DocumentTemplateBase {}
@@ -23,6 +25,14 @@ export interface DocumentTemplateUpdate {
   name: string;
 }
 
+export interface DocumentTemplateBatchItem {
+  template: DocumentTemplateOut;
+  thumbnail: Blob | null;
+}
+
+// Most ids the batch endpoint accepts per request, see `DocumentTemplateBatchIn`
+export const BATCH_MAX_IDS = 1000;
+
 export default class DocumentTemplateApi {
   client: ApiClient;
   pathPrefix: string;
@@ -76,4 +86,45 @@ export default class DocumentTemplateApi {
   downloadTemplateFile(templateId: number | string): Promise<Blob> {
     return this.client.getBlob(`${this.pathPrefix}${templateId}/download`);
   }
+
+  // Metadata and thumbnails of the given templates, at most `BATCH_MAX_IDS`, in one
+  // length-prefixed binary response
+  async batch(
+    templateIds: number[],
+    thumbnailSize: number,
+  ): Promise<DocumentTemplateBatchItem[]> {
+    const body: ArrayBuffer = await this.client.post(
+      `${this.pathPrefix}batch`,
+      { ids: templateIds, thumbnail_size: thumbnailSize },
+      { responseType: 'arraybuffer' },
+    );
+    const view = new DataView(body);
+    const decoder = new TextDecoder();
+    const items: DocumentTemplateBatchItem[] = [];
+    let offset = 0;
+    while (offset < body.byteLength) {
+      const metadataLength = view.getUint32(offset);
+      const metadata = JSON.parse(
+        decoder.decode(new Uint8Array(body, offset + 4, metadataLength)),
+      );
+      offset += 4 + metadataLength;
+      const thumbnailLength = view.getUint32(offset);
+      items.push({
+        template: metadata.template,
+        thumbnail: metadata.thumbnail_media_type
+          ? new Blob([new Uint8Array(body, offset + 4, thumbnailLength)], {
+              type: metadata.thumbnail_media_type,
+            })
+          : null,
+      });
+      offset += 4 + thumbnailLength;
+    }
+    return items;
+  }
+
+  downloadThumbnail(templateId: number | string, size: number): Promise<Blob> {
+    return this.client.getBlob(
+      `${this.pathPrefix}${templateId}/thumbnail?size=${size}`,
+    );
+  }
 }